@@ -1,4 +1,4 @@
-import pickle
+import os
 from enum import Enum
 from typing import Any, Dict, Mapping, Optional, Sequence, Union
 
@@ -16,6 +16,7 @@ from app.chatbot import get_chatbot_executor
 from app.checkpoint import PostgresCheckpoint
 from app.llms import get_ollama_llm
 from app.retrieval import get_retrieval_executor
+from app.serde import CheckpointSerializer
 from app.tools import (
     RETRIEVAL_DESCRIPTION,
     TOOLS,
@@ -36,7 +37,24 @@ class LLMType(str, Enum):
 
 DEFAULT_SYSTEM_MESSAGE = "You are a helpful assistant."
 
-CHECKPOINTER = PostgresCheckpoint(serde=pickle, at=CheckpointAt.END_OF_STEP)
+CHECKPOINTER = PostgresCheckpoint(
+    serde=CheckpointSerializer(),
+    at=CheckpointAt.END_OF_STEP,
+    delta=os.environ.get("CHECKPOINT_DELTA", "false").lower() == "true",
+    snapshot_interval=int(os.environ.get("CHECKPOINT_SNAPSHOT_INTERVAL", 10)),
+    cache_latest=os.environ.get("CHECKPOINT_CACHE", "false").lower() == "true",
+    cache_size=int(os.environ.get("CHECKPOINT_CACHE_SIZE", 1024)),
+    notify=os.environ.get("CHECKPOINT_CACHE_NOTIFY", "false").lower() == "true",
+    write_behind=os.environ.get("CHECKPOINT_WRITE_BEHIND", "false").lower() == "true",
+    write_behind_max=int(os.environ.get("CHECKPOINT_WRITE_BEHIND_MAX", 50)),
+    offload_threshold=(
+        int(os.environ["CHECKPOINT_OFFLOAD_THRESHOLD"])
+        if os.environ.get("CHECKPOINT_OFFLOAD_THRESHOLD")
+        else None
+    ),
+    summarize=os.environ.get("CHECKPOINT_SUMMARIZE", "true").lower() == "true",
+    search=os.environ.get("CHECKPOINT_SEARCH", "true").lower() == "true",
+)
 
 class ConfigurableSystem(RunnableBinding):
     mode: str
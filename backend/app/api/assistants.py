@@ -1,7 +1,7 @@
-from typing import Annotated, List
+from typing import Annotated, List, Optional, Union
 from uuid import uuid4
 
-from fastapi import APIRouter, HTTPException, Path
+from fastapi import APIRouter, HTTPException, Path, Query, Response
 from pydantic import BaseModel, Field
 
 import app.storage as storage
@@ -23,9 +23,33 @@ AssistantID = Annotated[str, Path(description="The ID of the assistant.")]
 
 
 @router.get("/")
-async def list_assistants(user: AuthedUser) -> List[Assistant]:
-    """List all assistants for the current user."""
-    return await storage.list_assistants(user["user_id"])
+async def list_assistants(
+    user: AuthedUser,
+    response: Response,
+    limit: Optional[int] = Query(
+        None, ge=1, description="The maximum number of assistants to return."
+    ),
+    cursor: Optional[str] = Query(
+        None, description="The X-Next-Cursor header of the previous page."
+    ),
+    fields: Optional[List[str]] = Query(
+        None, description="Only return these fields, and the ID and updated_at."
+    ),
+) -> Union[List[Assistant], List[dict]]:
+    """List the assistants of the current user, most recently updated first.
+
+    When there may be more assistants, the cursor of the next page is returned in
+    the X-Next-Cursor header.
+    """
+    try:
+        assistants, next_cursor = await storage.list_assistants(
+            user["user_id"], limit=limit, cursor=cursor, fields=fields
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return assistants
 
 
 @router.get("/public/")
@@ -1,20 +1,56 @@
-from typing import Any, Dict, Optional, Sequence, Union
+from functools import lru_cache
+from typing import Any, Dict, Optional, Sequence, Type, Union
 
-from fastapi import APIRouter, BackgroundTasks, HTTPException
+from fastapi import APIRouter, HTTPException
 from fastapi.exceptions import RequestValidationError
 from pydantic import ValidationError
 from langchain_core.messages import AnyMessage
 from langchain_core.runnables import RunnableConfig
 from pydantic import BaseModel, Field
 from sse_starlette import EventSourceResponse
+from starlette.background import BackgroundTask
 
 from app.agent import agent
 from app.auth.handlers import AuthedUser
 import app.storage as storage
+from app.run_queue import RUN_QUEUE, RunQueueFull, ThreadBusy
+from app.schema import Run
 from app.stream import astream_state, to_sse
 
 router = APIRouter()
 
+# The `type` alternative is the only configurable key that changes the
+# schemas of the agent, the other keys only change field values. The default
+# type is first. `agent` binds its types around the alternatives.
+AGENT_TYPES = (agent.bound.default_key, *agent.bound.alternatives)
+
+
+@lru_cache(maxsize=16)
+def _input_schema(agent_type: str) -> Type[BaseModel]:
+    """The input model of an agent type.
+
+    Building it walks the configurable alternatives and creates a pydantic
+    model, which is too slow to do for every run.
+    """
+    return agent.get_input_schema({"configurable": {"type": agent_type}})
+
+
+@lru_cache(maxsize=1)
+def _schemas() -> dict[str, dict]:
+    """The JSON schemas served by the schema endpoints."""
+    return {
+        "input": agent.get_input_schema().schema(),
+        "output": agent.get_output_schema().schema(),
+        "config": agent.config_schema().schema(),
+    }
+
+
+def warm_schemas() -> None:
+    """Build the schemas ahead of the first requests."""
+    for agent_type in AGENT_TYPES:
+        _input_schema(agent_type)
+    _schemas()
+
 
 class CreateRunPayload(BaseModel):
     """Payload for creating a run."""
@@ -27,11 +63,11 @@ class CreateRunPayload(BaseModel):
 
 
 async def _run_input_and_config(payload: CreateRunPayload, user_id: str):
-    thread = await storage.get_thread(user_id, payload.thread_id)
+    thread, assistant = await storage.get_thread_and_assistant(
+        user_id, payload.thread_id
+    )
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
-
-    assistant = await storage.get_assistant(user_id, str(thread["assistant_id"]))
     if not assistant:
         raise HTTPException(status_code=404, detail="Assistant not found")
 
@@ -48,7 +84,8 @@ async def _run_input_and_config(payload: CreateRunPayload, user_id: str):
 
     try:
         if payload.input is not None:
-            agent.get_input_schema(config).validate(payload.input)
+            agent_type = config["configurable"].get("type") or AGENT_TYPES[0]
+            _input_schema(agent_type).validate(payload.input)
     except ValidationError as e:
         raise RequestValidationError(e.errors(), body=payload)
 
@@ -56,15 +93,21 @@ async def _run_input_and_config(payload: CreateRunPayload, user_id: str):
 
 
 @router.post("")
-async def create_run(
-    payload: CreateRunPayload,
-    user: AuthedUser,
-    background_tasks: BackgroundTasks,
-):
-    """Create a run."""
+async def create_run(payload: CreateRunPayload, user: AuthedUser) -> Run:
+    """Queue a run. Poll GET /runs/{run_id} for its status."""
     input_, config = await _run_input_and_config(payload, user["user_id"])
-    background_tasks.add_task(agent.ainvoke, input_, config)
-    return {"status": "ok"}  # TODO add a run id
+    try:
+        return await RUN_QUEUE.enqueue(
+            user["user_id"], config["configurable"]["thread_id"], input_, config
+        )
+    except RunQueueFull:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many runs are waiting to start",
+            headers={"Retry-After": "10"},
+        )
+    except ThreadBusy:
+        raise HTTPException(status_code=409, detail="Thread has a run in progress")
 
 
 @router.post("/stream")
@@ -74,23 +117,51 @@ async def stream_run(
 ):
     """Create a run."""
     input_, config = await _run_input_and_config(payload, user["user_id"])
-
-    return EventSourceResponse(to_sse(astream_state(agent, input_, config)))
+    try:
+        run = await RUN_QUEUE.begin_stream(
+            user["user_id"], config["configurable"]["thread_id"], input_, config
+        )
+    except ThreadBusy:
+        raise HTTPException(status_code=409, detail="Thread has a run in progress")
+    # the run is cancelled if the client disconnects, see RunQueue.stream
+    return EventSourceResponse(
+        to_sse(RUN_QUEUE.stream(run["run_id"], astream_state(agent, input_, config))),
+        headers={"X-Run-Id": str(run["run_id"])},
+        background=BackgroundTask(RUN_QUEUE.end_stream, run["run_id"]),
+    )
 
 
 @router.get("/input_schema")
 async def input_schema() -> dict:
     """Return the input schema of the runnable."""
-    return agent.get_input_schema().schema()
+    return _schemas()["input"]
 
 
 @router.get("/output_schema")
 async def output_schema() -> dict:
     """Return the output schema of the runnable."""
-    return agent.get_output_schema().schema()
+    return _schemas()["output"]
 
 
 @router.get("/config_schema")
 async def config_schema() -> dict:
     """Return the config schema of the runnable."""
-    return agent.config_schema().schema()
+    return _schemas()["config"]
+
+
+@router.get("/{run_id}")
+async def get_run(user: AuthedUser, run_id: str) -> Run:
+    """Get a run."""
+    run = await RUN_QUEUE.get(user["user_id"], run_id)
+    if not run:
+        raise HTTPException(status_code=404, detail="Run not found")
+    return run
+
+
+@router.post("/{run_id}/cancel")
+async def cancel_run(user: AuthedUser, run_id: str) -> Run:
+    """Cancel a run. It is cancelling until it has stopped."""
+    run = await RUN_QUEUE.cancel(user["user_id"], run_id)
+    if not run:
+        raise HTTPException(status_code=404, detail="Run not found")
+    return run
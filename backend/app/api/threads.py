@@ -1,13 +1,16 @@
+from datetime import datetime
 from typing import Annotated, Any, Dict, List, Optional, Sequence, Union
 from uuid import uuid4
 
-from fastapi import APIRouter, HTTPException, Path
+from fastapi import APIRouter, HTTPException, Path, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from langchain.schema.messages import AnyMessage
 from pydantic import BaseModel, Field
 
 import app.storage as storage
+import app.transfer as transfer
 from app.auth.handlers import AuthedUser
-from app.schema import Thread
+from app.schema import Thread, ThreadSearchHit
 
 router = APIRouter()
 
@@ -29,10 +32,104 @@ class ThreadPostRequest(BaseModel):
     config: Optional[Dict[str, Any]] = None
 
 
+class ThreadForkRequest(BaseModel):
+    """Payload for forking a thread."""
+
+    name: Optional[str] = Field(
+        None, description="The name of the new thread. Defaults to the source's."
+    )
+    thread_ts: Optional[datetime] = Field(
+        None,
+        description="The thread_ts of the state to fork from. "
+        "Defaults to the latest state.",
+    )
+
+
 @router.get("/")
-async def list_threads(user: AuthedUser) -> List[Thread]:
-    """List all threads for the current user."""
-    return await storage.list_threads(user["user_id"])
+async def list_threads(
+    user: AuthedUser,
+    response: Response,
+    limit: Optional[int] = Query(
+        None, ge=1, description="The maximum number of threads to return."
+    ),
+    cursor: Optional[str] = Query(
+        None, description="The X-Next-Cursor header of the previous page."
+    ),
+    fields: Optional[List[str]] = Query(
+        None, description="Only return these fields, and the ID and updated_at."
+    ),
+) -> Union[List[Thread], List[dict]]:
+    """List the threads of the current user, most recently updated first.
+
+    When there may be more threads, the cursor of the next page is returned in
+    the X-Next-Cursor header.
+    """
+    try:
+        threads, next_cursor = await storage.list_threads(
+            user["user_id"], limit=limit, cursor=cursor, fields=fields
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return threads
+
+
+@router.get("/search")
+async def search_threads(
+    user: AuthedUser,
+    response: Response,
+    q: str = Query(
+        ...,
+        min_length=1,
+        description='Words to search for. Supports "quoted phrases", or and -word.',
+    ),
+    limit: int = Query(
+        20, ge=1, le=100, description="The maximum number of threads to return."
+    ),
+    cursor: Optional[str] = Query(
+        None, description="The X-Next-Cursor header of the previous page."
+    ),
+) -> List[ThreadSearchHit]:
+    """Search the messages of the threads of the current user.
+
+    Returns the matching threads, best match first, each with a snippet of
+    its best matching message. When there may be more threads, the cursor of
+    the next page is returned in the X-Next-Cursor header.
+    """
+    try:
+        hits, next_cursor = await storage.search_threads(
+            user["user_id"], q, limit=limit, cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return hits
+
+
+@router.get("/export")
+async def export_threads(user: AuthedUser) -> StreamingResponse:
+    """Export the threads of the current user with their history, as NDJSON."""
+    return StreamingResponse(
+        transfer.export_threads(user["user_id"]),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="threads.ndjson"'},
+    )
+
+
+@router.post("/import")
+async def import_threads(user: AuthedUser, request: Request) -> Dict[str, int]:
+    """Import threads exported with /threads/export into the current user.
+
+    Threads that already exist are skipped, with their checkpoints. Returns
+    the number of threads, checkpoints and blobs imported, and of threads and
+    checkpoints skipped.
+    """
+    try:
+        return await transfer.import_threads(user["user_id"], request.stream())
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
 
 @router.get("/{tid}/state")
@@ -41,10 +138,9 @@ async def get_thread_state(
     tid: ThreadID,
 ):
     """Get state for a thread."""
-    thread = await storage.get_thread(user["user_id"], tid)
+    thread, assistant = await storage.get_thread_and_assistant(user["user_id"], tid)
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
-    assistant = await storage.get_assistant(user["user_id"], thread["assistant_id"])
     if not assistant:
         raise HTTPException(status_code=400, detail="Thread has no assistant")
     return await storage.get_thread_state(
@@ -61,10 +157,9 @@ async def add_thread_state(
     payload: ThreadPostRequest,
 ):
     """Add state to a thread."""
-    thread = await storage.get_thread(user["user_id"], tid)
+    thread, assistant = await storage.get_thread_and_assistant(user["user_id"], tid)
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
-    assistant = await storage.get_assistant(user["user_id"], thread["assistant_id"])
     if not assistant:
         raise HTTPException(status_code=400, detail="Thread has no assistant")
     return await storage.update_thread_state(
@@ -79,19 +174,53 @@ async def add_thread_state(
 async def get_thread_history(
     user: AuthedUser,
     tid: ThreadID,
+    limit: Optional[int] = Query(
+        None, ge=1, description="The maximum number of states to return."
+    ),
+    before: Optional[datetime] = Query(
+        None,
+        description="Only return states older than this thread_ts, "
+        "eg. the thread_ts of the last state of the previous page.",
+    ),
+    metadata_only: bool = Query(
+        False, description="Only return the config, parent and next of each state."
+    ),
 ):
-    """Get all past states for a thread."""
-    thread = await storage.get_thread(user["user_id"], tid)
+    """Get past states for a thread, newest first."""
+    thread, assistant = await storage.get_thread_and_assistant(user["user_id"], tid)
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
-    assistant = await storage.get_assistant(user["user_id"], thread["assistant_id"])
     if not assistant:
         raise HTTPException(status_code=400, detail="Thread has no assistant")
     return await storage.get_thread_history(
         user_id=user["user_id"],
         thread_id=tid,
         assistant=assistant,
+        limit=limit,
+        before=before,
+        metadata_only=metadata_only,
+    )
+
+
+@router.post("/{tid}/fork")
+async def fork_thread(
+    user: AuthedUser,
+    tid: ThreadID,
+    payload: ThreadForkRequest,
+) -> Thread:
+    """Create a new thread that continues from a state of this thread."""
+    thread = await storage.get_thread(user["user_id"], tid)
+    if not thread:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    forked = await storage.fork_thread(
+        user["user_id"],
+        thread,
+        thread_ts=payload.thread_ts,
+        name=payload.name or thread["name"],
     )
+    if not forked:
+        raise HTTPException(status_code=404, detail="Thread state not found")
+    return forked
 
 
 @router.get("/{tid}")
@@ -1,14 +1,17 @@
+import hashlib
+import time
 from abc import ABC, abstractmethod
 from functools import lru_cache
 from typing import Annotated
 
 import jwt
-import requests
 from fastapi import Depends, HTTPException, Request
 from fastapi.security.http import HTTPBearer
 
 import app.storage as storage
+from app.auth.jwks import JWKSCache
 from app.auth.settings import AuthType, settings
+from app.cache import TTLCache
 from app.schema import User
 
 
@@ -17,6 +20,12 @@ class AuthHandler(ABC):
     async def __call__(self, request: Request) -> User:
         """Auth handler that returns a user object or raises an HTTPException."""
 
+    async def start(self) -> None:
+        """Prepare the handler when the app starts, eg. fetch keys."""
+
+    async def stop(self) -> None:
+        """Release what `start` acquired when the app shuts down."""
+
 
 class NOOPAuth(AuthHandler):
     _default_sub = "static-default-user-id"
@@ -28,31 +37,46 @@ class NOOPAuth(AuthHandler):
 
 
 class JWTAuthBase(AuthHandler):
+    def __init__(self) -> None:
+        # claims of verified tokens by token hash, so clients sending the same
+        # token on every request only have its signature checked once
+        self._verified: TTLCache[bytes, dict] = TTLCache(
+            maxsize=settings.token_cache_size, ttl=settings.token_cache_ttl
+        )
+
     async def __call__(self, request: Request) -> User:
         http_bearer = await HTTPBearer()(request)
         token = http_bearer.credentials
 
-        try:
-            payload = self.decode_token(token, self.get_decode_key(token))
-        except jwt.PyJWTError as e:
-            raise HTTPException(status_code=401, detail=str(e))
+        token_hash = hashlib.sha256(token.encode()).digest()
+        if (payload := self._verified.get(token_hash)) is None:
+            try:
+                # decoded once, for handlers to pick the key and algorithm
+                unverified = jwt.api_jwt.decode_complete(
+                    token, options={"verify_signature": False}
+                )
+                decode_key = await self.get_decode_key(unverified)
+                payload = self.decode_token(token, decode_key, unverified)
+            except jwt.PyJWTError as e:
+                raise HTTPException(status_code=401, detail=str(e))
+            self._verified.set(token_hash, payload, ttl=payload["exp"] - time.time())
 
         user, _ = await storage.get_or_create_user(payload["sub"])
         return user
 
     @abstractmethod
-    def decode_token(self, token: str, decode_key: str) -> dict:
-        ...
+    def decode_token(self, token: str, decode_key: str, unverified: dict) -> dict:
+        """Verify a token. `unverified` is its header and payload, unverified."""
 
     @abstractmethod
-    def get_decode_key(self, token: str) -> str:
+    async def get_decode_key(self, unverified: dict) -> str:
         ...
 
 
 class JWTAuthLocal(JWTAuthBase):
     """Auth handler that uses a hardcoded decode key from env."""
 
-    def decode_token(self, token: str, decode_key: str) -> dict:
+    def decode_token(self, token: str, decode_key: str, unverified: dict) -> dict:
         return jwt.decode(
             token,
             decode_key,
@@ -62,44 +86,47 @@ class JWTAuthLocal(JWTAuthBase):
             options={"require": ["exp", "iss", "aud", "sub"]},
         )
 
-    def get_decode_key(self, token: str) -> str:
+    async def get_decode_key(self, unverified: dict) -> str:
         return settings.jwt_local.decode_key
 
 
 class JWTAuthOIDC(JWTAuthBase):
-    """Auth handler that uses OIDC discovery to get the decode key."""
+    """Auth handler that uses OIDC discovery to get the decode key.
+
+    Only tokens of the configured issuer are accepted, so a token can't make
+    the server fetch keys from a URL of its choosing.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.jwks = JWKSCache(
+            ttl=settings.jwt_oidc.jwks_ttl,
+            min_refetch_interval=settings.jwt_oidc.jwks_min_refetch_interval,
+        )
+
+    async def start(self) -> None:
+        await self.jwks.prefetch([settings.jwt_oidc.iss])
+        self.jwks.start()
+
+    async def stop(self) -> None:
+        await self.jwks.stop()
 
-    def decode_token(self, token: str, decode_key: str) -> dict:
-        alg = self._decode_complete_unverified(token)["header"]["alg"]
+    def decode_token(self, token: str, decode_key: str, unverified: dict) -> dict:
         return jwt.decode(
             token,
             decode_key,
             issuer=settings.jwt_oidc.iss,
             audience=settings.jwt_oidc.aud,
-            algorithms=[alg.upper()],
+            algorithms=[unverified["header"]["alg"].upper()],
             options={"require": ["exp", "iss", "aud", "sub"]},
         )
 
-    def get_decode_key(self, token: str) -> str:
-        unverified = self._decode_complete_unverified(token)
+    async def get_decode_key(self, unverified: dict) -> str:
         issuer = unverified["payload"].get("iss")
+        if issuer != settings.jwt_oidc.iss:
+            raise jwt.InvalidIssuerError("Invalid issuer")
         kid = unverified["header"].get("kid")
-        return self._get_jwk_client(issuer).get_signing_key(kid).key
-
-    @lru_cache
-    def _decode_complete_unverified(self, token: str) -> dict:
-        return jwt.api_jwt.decode_complete(token, options={"verify_signature": False})
-
-    @lru_cache
-    def _get_jwk_client(self, issuer: str) -> jwt.PyJWKClient:
-        """
-        lru_cache ensures a single instance of PyJWKClient per issuer. This is
-        so that we can take advantage of jwks caching (and invalidation) handled
-        by PyJWKClient.
-        """
-        url = issuer.rstrip("/") + "/.well-known/openid-configuration"
-        config = requests.get(url).json()
-        return jwt.PyJWKClient(config["jwks_uri"], cache_jwk_set=True)
+        return (await self.jwks.get_signing_key(issuer, kid)).key
 
 
 @lru_cache(maxsize=1)
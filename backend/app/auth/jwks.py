@@ -0,0 +1,138 @@
+import asyncio
+import re
+import time
+from typing import Iterable, Optional
+
+import httpx
+import jwt
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+_MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class _IssuerKeys:
+    def __init__(self) -> None:
+        self.jwks_uri: Optional[str] = None
+        self.keys: dict[Optional[str], jwt.PyJWK] = {}
+        self.fetched_at = float("-inf")
+        self.expires_at = float("-inf")
+        self.lock = asyncio.Lock()
+
+
+class JWKSCache:
+    """Signing keys of OIDC issuers, fetched without blocking the event loop.
+
+    Keys are fetched on first use, or ahead of time with `prefetch`, and
+    refreshed in the background before they expire once `start` is called.
+    They expire after the max-age of the JWKS response, or `ttl` seconds.
+    A token signed with an unknown key triggers a refetch, at most every
+    `min_refetch_interval` seconds per issuer, to pick up rotated keys.
+    """
+
+    def __init__(
+        self,
+        *,
+        ttl: float = 3600,
+        min_refetch_interval: float = 60,
+        refresh_margin: float = 60,
+        timeout: float = 10,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ) -> None:
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.refresh_margin = refresh_margin
+        self._client = httpx.AsyncClient(timeout=timeout, transport=transport)
+        self._issuers: dict[str, _IssuerKeys] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def get_signing_key(self, issuer: str, kid: Optional[str]) -> jwt.PyJWK:
+        """The key of an issuer with this ID.
+
+        Raises:
+            jwt.PyJWKClientError: If the keys can't be fetched or the issuer
+                has no such key.
+        """
+        keys = self._issuers.setdefault(issuer, _IssuerKeys())
+        if kid not in keys.keys or keys.expires_at < time.monotonic():
+            # the issuer may have rotated its keys. Refetches are rate limited,
+            # so neither made up key IDs nor an unreachable issuer cause a
+            # request per token.
+            await self._fetch(issuer, keys, min_age=self.min_refetch_interval)
+        if (key := keys.keys.get(kid)) is None:
+            raise jwt.PyJWKClientError(f"Unable to find a signing key for kid {kid}")
+        return key
+
+    async def prefetch(self, issuers: Iterable[str]) -> None:
+        for issuer in issuers:
+            keys = self._issuers.setdefault(issuer, _IssuerKeys())
+            try:
+                await self._fetch(issuer, keys)
+            except jwt.PyJWKClientError as e:
+                logger.warn("Could not prefetch signing keys", error=str(e))
+
+    def start(self) -> None:
+        """Refresh the keys of known issuers in the background."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._client.aclose()
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            next_refresh = now + self.ttl
+            for issuer, keys in list(self._issuers.items()):
+                refresh_at = keys.expires_at - self.refresh_margin
+                if refresh_at <= now:
+                    try:
+                        await self._fetch(issuer, keys)
+                    except jwt.PyJWKClientError as e:
+                        logger.warn("Could not refresh signing keys", error=str(e))
+                        # retry soon, the current keys are still served until
+                        # they expire
+                        refresh_at = now + self.min_refetch_interval
+                    else:
+                        refresh_at = keys.expires_at - self.refresh_margin
+                next_refresh = min(next_refresh, refresh_at)
+            await asyncio.sleep(max(next_refresh - time.monotonic(), 1))
+
+    async def _fetch(
+        self, issuer: str, keys: _IssuerKeys, *, min_age: float = 0
+    ) -> None:
+        fetched_at = keys.fetched_at
+        async with keys.lock:
+            if keys.fetched_at != fetched_at:
+                # fetched by another request while this one waited
+                return
+            if time.monotonic() - keys.fetched_at < min_age:
+                return
+            try:
+                if keys.jwks_uri is None:
+                    url = issuer.rstrip("/") + "/.well-known/openid-configuration"
+                    response = await self._client.get(url)
+                    response.raise_for_status()
+                    keys.jwks_uri = response.json()["jwks_uri"]
+                response = await self._client.get(keys.jwks_uri)
+                response.raise_for_status()
+                jwk_set = jwt.PyJWKSet.from_dict(response.json())
+            except (httpx.HTTPError, ValueError, KeyError, jwt.PyJWTError) as e:
+                keys.fetched_at = time.monotonic()
+                raise jwt.PyJWKClientError(
+                    f"Failed to fetch signing keys of {issuer}: {e}"
+                ) from e
+            match = _MAX_AGE.search(response.headers.get("cache-control", ""))
+            ttl = int(match.group(1)) if match else self.ttl
+            keys.keys = {key.key_id: key for key in jwk_set.keys}
+            keys.fetched_at = time.monotonic()
+            keys.expires_at = keys.fetched_at + ttl
+            logger.info("Fetched signing keys", issuer=issuer, keys=len(keys.keys))
@@ -40,13 +40,22 @@ class JWTSettingsLocal(JWTSettingsBase):
 
 
 class JWTSettingsOIDC(JWTSettingsBase):
-    ...
+    # Seconds signing keys are used for when the issuer's JWKS response has no
+    # max-age.
+    jwks_ttl: float = 3600
+    # Least seconds between refetches of the signing keys on an unknown key ID.
+    jwks_min_refetch_interval: float = 60
 
 
 class Settings(BaseSettings):
     auth_type: AuthType
     jwt_local: Optional[JWTSettingsLocal] = None
     jwt_oidc: Optional[JWTSettingsOIDC] = None
+    # Verified tokens are remembered until they expire, but at most this many
+    # seconds, so a token signed with a key the issuer has since dropped isn't
+    # accepted for long.
+    token_cache_size: int = 10000
+    token_cache_ttl: float = 300
 
     @root_validator(pre=True)
     def check_jwt_settings(cls, values):
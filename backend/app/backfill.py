@@ -0,0 +1,144 @@
+import asyncio
+from typing import Optional
+
+import structlog
+from pydantic import BaseSettings
+
+from app.checkpoint import PostgresCheckpoint
+from app.lifespan import get_pg_pool, get_pg_session_pool
+
+logger = structlog.get_logger(__name__)
+
+# Only one process backfills at a time.
+_LOCK_KEY = "opengpts:backfill"
+
+_COMPLETED = "SELECT name FROM backfill"
+
+_COMPLETE = "INSERT INTO backfill (name) VALUES ($1) ON CONFLICT (name) DO NOTHING"
+
+
+class BackfillSettings(BaseSettings):
+    # Backfills are a maintenance run, started with BACKFILL_ENABLED=true.
+    enabled: bool = False
+    threads_per_page: int = 100
+    # Pause between threads, so the worker doesn't compete with live traffic.
+    pause: float = 0.01
+
+    class Config:
+        env_prefix = "backfill_"
+
+
+async def backfill_summaries(
+    checkpointer: PostgresCheckpoint, settings: BackfillSettings
+) -> int:
+    """Summarize the threads written before summaries were kept.
+
+    Returns the number of threads looked at. Threads without checkpoints are
+    looked at again on every run.
+    """
+    count = 0
+    cursor = None
+    while True:
+        async with get_pg_pool().acquire() as conn:
+            thread_ids = await conn.fetch(
+                "SELECT thread_id FROM thread WHERE last_run_at IS NULL "
+                "AND ($1::uuid IS NULL OR thread_id > $1) "
+                "ORDER BY thread_id LIMIT $2",
+                cursor,
+                settings.threads_per_page,
+            )
+        for row in thread_ids:
+            await checkpointer.arefresh_summary(str(row["thread_id"]))
+            await asyncio.sleep(settings.pause)
+        count += len(thread_ids)
+        if len(thread_ids) < settings.threads_per_page:
+            return count
+        cursor = thread_ids[-1]["thread_id"]
+
+
+async def backfill_search(
+    checkpointer: PostgresCheckpoint, settings: BackfillSettings
+) -> int:
+    """Index the messages of the threads written before the search index.
+
+    Returns the number of threads looked at. Threads without messages to
+    index are looked at again on every run.
+    """
+    count = 0
+    cursor = None
+    while True:
+        async with get_pg_pool().acquire() as conn:
+            thread_ids = await conn.fetch(
+                "SELECT thread_id FROM thread t "
+                "WHERE NOT EXISTS "
+                "(SELECT 1 FROM thread_search s WHERE s.thread_id = t.thread_id) "
+                "AND ($1::uuid IS NULL OR thread_id > $1) "
+                "ORDER BY thread_id LIMIT $2",
+                cursor,
+                settings.threads_per_page,
+            )
+        for row in thread_ids:
+            await checkpointer.areindex(str(row["thread_id"]))
+            await asyncio.sleep(settings.pause)
+        count += len(thread_ids)
+        if len(thread_ids) < settings.threads_per_page:
+            return count
+        cursor = thread_ids[-1]["thread_id"]
+
+
+async def backfill_blob_refs(
+    checkpointer: PostgresCheckpoint, settings: BackfillSettings
+) -> int:
+    """Record the blobs referenced by checkpoints written before references
+    were kept, without which unreferenced blobs aren't deleted.
+
+    Returns the number of checkpoints updated.
+    """
+    count = 0
+    while True:
+        updated = await checkpointer.abackfill_blob_refs(settings.threads_per_page)
+        count += updated
+        if updated < settings.threads_per_page:
+            return count
+        await asyncio.sleep(settings.pause)
+
+
+async def _run(checkpointer: PostgresCheckpoint, settings: BackfillSettings) -> None:
+    try:
+        async with get_pg_session_pool().acquire() as conn:
+            if not await conn.fetchval(
+                "SELECT pg_try_advisory_lock(hashtext($1))", _LOCK_KEY
+            ):
+                return
+            try:
+                completed = {row["name"] for row in await conn.fetch(_COMPLETED)}
+                backfills = [
+                    ("summaries", backfill_summaries, checkpointer.summarize),
+                    ("search", backfill_search, checkpointer.search),
+                    ("blob_refs", backfill_blob_refs, True),
+                ]
+                for name, backfill, enabled in backfills:
+                    if not enabled or name in completed:
+                        continue
+                    count = await backfill(checkpointer, settings)
+                    await conn.execute(_COMPLETE, name)
+                    logger.info("Backfill completed", backfill=name, count=count)
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock(hashtext($1))", _LOCK_KEY)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception("Backfill failed")
+
+
+def start_backfill(
+    checkpointer: PostgresCheckpoint, settings: Optional[BackfillSettings] = None
+) -> Optional[asyncio.Task]:
+    """Start filling in derived data of existing threads in the background.
+
+    Only the backfills that haven't completed before are run.
+    """
+    settings = settings or BackfillSettings()
+    if not settings.enabled:
+        return None
+    return asyncio.create_task(_run(checkpointer, settings))
@@ -0,0 +1,128 @@
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, Optional, TypeVar
+from uuid import uuid4
+
+import asyncpg
+import structlog
+
+from app.listener import Listener
+from app.schema import Assistant
+
+logger = structlog.get_logger(__name__)
+
+_NOTIFY_CHANNEL = "assistants"
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """A bounded LRU of values that expire `ttl` seconds after being set."""
+
+    def __init__(self, *, maxsize: int = 1024, ttl: float = 60) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items: OrderedDict[K, tuple[float, V]] = OrderedDict()
+
+    def get(self, key: K) -> Optional[V]:
+        if (item := self._items.get(key)) is None:
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key: K, value: V, *, ttl: Optional[float] = None) -> None:
+        """Set a value, expiring after the lesser of `ttl` and the cache's."""
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        self._items[key] = (time.monotonic() + ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def pop(self, key: K) -> None:
+        self._items.pop(key, None)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+
+class AssistantCache:
+    """Assistant rows by ID, for at most `ttl` seconds.
+
+    Rows are only served while the listener is running: writes go through
+    `ainvalidate`, which evicts the assistant here and, with NOTIFY on the
+    `assistants` channel, in every other process. The TTL bounds how stale a
+    row can get if a notification is missed anyway.
+    """
+
+    def __init__(self, *, maxsize: int = 1024, ttl: float = 60) -> None:
+        self.ttl = ttl
+        self._rows: TTLCache[str, Assistant] = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._listener = Listener(
+            _NOTIFY_CHANNEL,
+            self._on_notify,
+            on_connect=self._rows.clear,
+            on_lost=self._on_listener_lost,
+        )
+        self._instance_id = uuid4().hex
+        self.version = 0
+        """Incremented on every eviction. Pass it from before a read to `put`."""
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self._listener.connected
+
+    def get(self, user_id: str, assistant_id: str) -> Optional[Assistant]:
+        """The assistant if it is cached and visible to the user."""
+        if not self.enabled or (assistant := self._rows.get(assistant_id)) is None:
+            return None
+        if str(assistant["user_id"]) != user_id and not assistant["public"]:
+            return None
+        return assistant
+
+    def put(self, assistant: Assistant, version: int) -> None:
+        # skipped if an assistant was written while this one was being read
+        if not self.enabled or version != self.version:
+            return
+        self._rows.set(str(assistant["assistant_id"]), assistant)
+
+    def clear(self) -> None:
+        self._rows.clear()
+
+    async def ainvalidate(self, conn: asyncpg.Connection, assistant_id: str) -> None:
+        """Evict an assistant that was just written, in every process."""
+        self._evict(assistant_id)
+        await conn.execute(
+            "SELECT pg_notify($1, $2)",
+            _NOTIFY_CHANNEL,
+            f"{self._instance_id}:{assistant_id}",
+        )
+
+    async def start_listener(self) -> None:
+        if self.ttl > 0:
+            await self._listener.start()
+
+    async def stop_listener(self) -> None:
+        await self._listener.stop()
+        self._rows.clear()
+
+    def _on_notify(self, conn, pid: int, channel: str, payload: str) -> None:
+        instance_id, assistant_id = payload.split(":", 1)
+        if instance_id != self._instance_id:
+            self._evict(assistant_id)
+
+    def _evict(self, assistant_id: str) -> None:
+        self.version += 1
+        self._rows.pop(assistant_id)
+
+    def _on_listener_lost(self) -> None:
+        logger.warn("Assistant cache listener connection lost, clearing cache.")
+        # rows being read now may miss an eviction, see `put`
+        self.version += 1
+        self._rows.clear()
@@ -1,8 +1,15 @@
-import pickle
-from datetime import datetime
-from typing import AsyncIterator, Optional
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta, timezone
+from hashlib import sha256
+from typing import Any, AsyncIterator, Callable, NamedTuple, Optional, Union
+from uuid import UUID, uuid4
 
-from langchain_core.messages import BaseMessage
+import asyncpg
+import structlog
+from typing_extensions import TypedDict
+
+from langchain_core.messages import BaseMessage, FunctionMessage, ToolMessage
 from langchain_core.runnables import ConfigurableFieldSpec, RunnableConfig
 from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.checkpoint.base import (
@@ -11,27 +18,463 @@ from langgraph.checkpoint.base import (
     CheckpointThreadTs,
     CheckpointTuple,
     SerializerProtocol,
+    copy_checkpoint,
+)
+
+from app.lifespan import get_pg_pool, get_pg_read_pool
+from app.listener import Listener
+from app.metrics import CHECKPOINT_METRICS, CheckpointMetrics, CheckpointOp
+from app.queries import register
+from app.search import (
+    INDEX as _SEARCH_INDEX,
+    message_text,
+    searchable_messages,
+    thread_messages,
+)
+from app.serde import BlobRef, CheckpointSerializer
+
+logger = structlog.get_logger(__name__)
+
+
+def _to_datetime(ts: Union[str, datetime, None]) -> Optional[datetime]:
+    if ts is None or isinstance(ts, datetime):
+        return ts
+    return datetime.fromisoformat(ts)
+
+
+class _Latest(NamedTuple):
+    """The latest checkpoint of a thread known to this process."""
+
+    ts: datetime
+    parent_ts: Optional[datetime]
+    checkpoint: Checkpoint
+    depth: int
+    """Number of delta rows between this checkpoint and the last full snapshot."""
+    parent_thread_id: Optional[str] = None
+    """Thread of the parent, if it is not this thread (ie. for forks)."""
+
+
+def diff(base: Checkpoint, checkpoint: Checkpoint) -> dict:
+    """Encode the channel values of `checkpoint` that changed since `base`.
+
+    List channels which only grew since the base (eg. message lists) are
+    stored as the prefix length plus the appended tail.
+    """
+    changed: dict[str, Any] = {}
+    extended: dict[str, tuple[int, list]] = {}
+    base_values = base["channel_values"]
+    for key, value in checkpoint["channel_values"].items():
+        old = base_values.get(key)
+        version = checkpoint["channel_versions"].get(key)
+        if key in base_values and base["channel_versions"].get(key) == version:
+            continue
+        if (
+            isinstance(value, list)
+            and isinstance(old, list)
+            and len(value) >= len(old)
+            and all(a is b or a == b for a, b in zip(old, value))
+        ):
+            extended[key] = (len(old), value[len(old) :])
+        else:
+            changed[key] = value
+    return {
+        "v": checkpoint["v"],
+        "ts": checkpoint["ts"],
+        "channel_versions": checkpoint["channel_versions"],
+        "versions_seen": checkpoint["versions_seen"],
+        "changed": changed,
+        "extended": extended,
+        "deleted": [
+            key for key in base_values if key not in checkpoint["channel_values"]
+        ],
+    }
+
+
+def apply_delta(checkpoint: Checkpoint, delta: dict) -> Checkpoint:
+    """Apply a delta produced by `diff` on top of its base checkpoint."""
+    values = {
+        key: value
+        for key, value in checkpoint["channel_values"].items()
+        if key not in delta["deleted"]
+    }
+    for key, (prefix, tail) in delta["extended"].items():
+        values[key] = values[key][:prefix] + tail
+    values.update(delta["changed"])
+    return Checkpoint(
+        v=delta["v"],
+        ts=delta["ts"],
+        channel_values=values,
+        channel_versions=delta["channel_versions"],
+        versions_seen=delta["versions_seen"],
+    )
+
+
+# Walks parent_ts from the anchor row back to the closest full snapshot. The
+# chain continues into the source thread at the first checkpoint of a fork,
+# whose parent_thread_id is set.
+_CHAIN_QUERY = """
+WITH RECURSIVE chain AS (
+    {anchor}
+    UNION ALL
+    SELECT c.thread_id, c.thread_ts, c.parent_ts, c.parent_thread_id, c.delta, c.checkpoint
+    FROM checkpoints c JOIN chain
+        ON c.thread_id = coalesce(chain.parent_thread_id, chain.thread_id)
+        AND c.thread_ts = chain.parent_ts
+    WHERE chain.delta
 )
+SELECT checkpoint, thread_ts, parent_ts, delta, parent_thread_id FROM chain ORDER BY thread_ts"""
+
+_CHAIN_AT = register(
+    "checkpoint_chain_at",
+    _CHAIN_QUERY.format(
+        anchor="SELECT thread_id, thread_ts, parent_ts, parent_thread_id, delta, checkpoint FROM checkpoints WHERE thread_id = $1 AND thread_ts = $2"
+    ),
+)
+
+_CHAIN_LATEST = register(
+    "checkpoint_chain_latest",
+    _CHAIN_QUERY.format(
+        anchor="(SELECT thread_id, thread_ts, parent_ts, parent_thread_id, delta, checkpoint FROM checkpoints WHERE thread_id = $1 ORDER BY thread_ts DESC LIMIT 1)"
+    ),
+)
+
+# The first checkpoint of a fork is a delta without a blob: it is the same as
+# its parent, which is in the source thread. It is created after the source
+# checkpoint, so that chains stay ordered by thread_ts.
+_FORK = """
+INSERT INTO checkpoints (thread_id, thread_ts, parent_ts, parent_thread_id, checkpoint, delta, blob_refs)
+SELECT $1::text, greatest($4::timestamptz, thread_ts + interval '1 microsecond'), thread_ts, thread_id, NULL, true, '{}'
+FROM checkpoints
+WHERE thread_id = $2 AND ($3::timestamptz IS NULL OR thread_ts = $3)
+ORDER BY thread_ts DESC LIMIT 1
+RETURNING thread_ts"""
+
+
+# Pregel only passes the config on to `alist`, so history options can be set
+# through these configurable keys.
+CONFIG_KEY_BEFORE = "checkpoint_before"
+CONFIG_KEY_LIMIT = "checkpoint_limit"
+CONFIG_KEY_METADATA_ONLY = "checkpoint_metadata_only"
+
+# A delta is only written while its parent still exists. The parent may have
+# been pruned by another process since it was cached, in which case nothing is
+# written and the caller stores a full snapshot instead. $6 are the blobs the
+# checkpoint refers to.
+_PUT = """
+INSERT INTO checkpoints (thread_id, thread_ts, parent_ts, checkpoint, delta, blob_refs)
+SELECT $1::text, $2::timestamptz, $3::timestamptz, $4::bytea, $5::boolean, $6::text[]
+WHERE NOT $5 OR EXISTS (
+    SELECT 1 FROM checkpoints WHERE thread_id = $1 AND thread_ts = $3
+)
+ON CONFLICT (thread_id, thread_ts)
+DO UPDATE SET checkpoint = EXCLUDED.checkpoint, parent_ts = EXCLUDED.parent_ts, delta = EXCLUDED.delta, blob_refs = EXCLUDED.blob_refs
+RETURNING thread_id"""
+register("checkpoint_put", _PUT)
+
+_NOTIFY_CHANNEL = "checkpoints"
+
+# Same as _PUT, and tells other processes which thread changed. The payload is
+# "<instance id>:<thread id>" so a process can ignore its own writes.
+_PUT_NOTIFY = f"""
+WITH put AS ({_PUT})
+SELECT pg_notify('{_NOTIFY_CHANNEL}', $7 || ':' || thread_id) FROM put"""
+register("checkpoint_put_notify", _PUT_NOTIFY)
+
+# The checkpoints of a thread, newest first, without their blobs.
+_METADATA = (
+    "SELECT c.thread_ts, c.parent_ts, c.delta, c.size, f.parent_thread_id "
+    "FROM checkpoints c LEFT JOIN LATERAL ("
+    "SELECT parent_thread_id FROM checkpoints "
+    "WHERE c.size IS NULL AND thread_id = c.thread_id "
+    "AND thread_ts = c.thread_ts"
+    ") f ON true "
+    "WHERE c.thread_id = $1 "
+    "AND ($2::timestamptz IS NULL OR c.thread_ts < $2) "
+    "ORDER BY c.thread_ts DESC LIMIT $3"
+)
+
+_BLOBS = register(
+    "checkpoint_blobs",
+    "SELECT hash, data FROM checkpoint_blobs WHERE hash = ANY($1::text[])",
+)
+
+# created_at is when a blob was last stored, which is bumped when it is stored
+# again, so that a blob about to be referenced isn't collected.
+_STORE_BLOBS = """
+INSERT INTO checkpoint_blobs (hash, data, created_at)
+SELECT hash, data, now() FROM unnest($1::text[], $2::bytea[]) AS b(hash, data)
+ON CONFLICT (hash) DO UPDATE SET created_at = EXCLUDED.created_at"""
+
+# Deletes the blobs no checkpoint refers to, that weren't stored since $1.
+# Checkpoints written before references were kept could refer to any blob, so
+# nothing is deleted until they are backfilled. The references of each blob are
+# looked up in the GIN index on blob_refs.
+_COLLECT_BLOBS = """
+DELETE FROM checkpoint_blobs b
+WHERE b.created_at < $1
+    AND NOT EXISTS (SELECT 1 FROM checkpoints WHERE blob_refs IS NULL)
+    AND NOT EXISTS (
+        SELECT 1 FROM checkpoints c WHERE c.blob_refs @> ARRAY[b.hash]
+    )"""
+
+# Keeps the preview columns of a thread in step with its latest checkpoint.
+# An older checkpoint, written late, doesn't overwrite a newer summary.
+_SUMMARY = register(
+    "checkpoint_summary",
+    "UPDATE thread SET last_message = $2, message_count = $3, last_run_at = $4 "
+    "WHERE thread_id = $1 AND (last_run_at IS NULL OR last_run_at <= $4)",
+)
+
+# Characters of the last message kept in the thread summary.
+SUMMARY_SNIPPET_LENGTH = 200
+
+# Writes the checkpoints queued in write-behind mode in one statement. Only the
+# first row can be a delta of a checkpoint written earlier, the others are
+# deltas of rows in the same batch. The blobs of each row are passed joined by
+# spaces, as arrays of arrays must be rectangular. $7 is the parent that the
+# first row needs, if any.
+_PUT_MANY = """
+INSERT INTO checkpoints (thread_id, thread_ts, parent_ts, checkpoint, delta, blob_refs)
+SELECT $1::text, r.thread_ts, r.parent_ts, r.checkpoint, r.delta, string_to_array(r.refs, ' ')
+FROM unnest($2::timestamptz[], $3::timestamptz[], $4::bytea[], $5::boolean[], $6::text[])
+    AS r(thread_ts, parent_ts, checkpoint, delta, refs)
+WHERE $7::timestamptz IS NULL OR EXISTS (
+    SELECT 1 FROM checkpoints WHERE thread_id = $1 AND thread_ts = $7
+)
+ON CONFLICT (thread_id, thread_ts)
+DO UPDATE SET checkpoint = EXCLUDED.checkpoint, parent_ts = EXCLUDED.parent_ts, delta = EXCLUDED.delta, blob_refs = EXCLUDED.blob_refs"""
+
+
+class CheckpointMetadata(TypedDict):
+    thread_ts: datetime
+    """The timestamp of the checkpoint."""
+    parent_ts: Optional[datetime]
+    """The timestamp of the checkpoint it was created from."""
+    delta: bool
+    """Whether only the changes since the parent are stored."""
+    size: Optional[int]
+    """Size of the stored blob in bytes. For deltas, only the delta's size.
+    None for the first checkpoint of a fork, which has no blob."""
+    parent_thread_id: Optional[str]
+    """The thread of the parent, for the first checkpoint of a fork."""
+
+
+class _Pending(NamedTuple):
+    """Checkpoints of a thread queued in write-behind mode, oldest first."""
 
-from app.lifespan import get_pg_pool
+    rows: list[tuple[datetime, Optional[datetime], bytes, bool, str]]
+    # kept to store a snapshot instead if the parent of the first row is gone
+    first: Checkpoint
+    # offloaded tool outputs the rows refer to, by hash
+    blobs: dict[str, bytes]
+    # arguments of _SUMMARY for the last row, if the thread has a summary
+    summary: list
+    # text of the messages to add to the search index, by message ID
+    search: dict[str, str]
+    # hashes of the indexed messages once the rows are written, by message ID
+    indexed: dict[str, int]
 
 
-def loads(value: bytes) -> Checkpoint:
-    loaded: Checkpoint = pickle.loads(value)
-    for key, value in loaded["channel_values"].items():
-        if isinstance(value, list) and all(isinstance(v, BaseMessage) for v in value):
-            loaded["channel_values"][key] = [v.__class__(**v.__dict__) for v in value]
-    return loaded
+def _count_messages(checkpoint: Checkpoint) -> int:
+    return sum(
+        len(value)
+        for value in checkpoint["channel_values"].values()
+        if isinstance(value, list)
+    )
+
+
+def _summary(
+    thread_id: str, ts: datetime, checkpoint: Checkpoint
+) -> Optional[tuple[UUID, Optional[str], int, datetime]]:
+    """Arguments of _SUMMARY for a checkpoint, None if it can't have a thread."""
+    try:
+        thread_uuid = UUID(thread_id)
+    except ValueError:
+        return None
+    messages = thread_messages(checkpoint["channel_values"])
+    last = next(
+        (
+            " ".join(text.split())[:SUMMARY_SNIPPET_LENGTH]
+            for message in reversed(messages)
+            if isinstance(message, BaseMessage) and (text := message_text(message))
+        ),
+        None,
+    )
+    return thread_uuid, last, len(messages), ts
+
+
+def _map_messages(obj: dict, fn: Callable[[BaseMessage], BaseMessage]) -> dict:
+    """Apply `fn` to the messages of a checkpoint, or of a delta from `diff`."""
+
+    def _map(value: Any) -> Any:
+        if not isinstance(value, list):
+            return value
+        return [fn(v) if isinstance(v, BaseMessage) else v for v in value]
+
+    mapped = dict(obj)
+    for field in ("channel_values", "changed"):
+        if field in obj:
+            mapped[field] = {k: _map(v) for k, v in obj[field].items()}
+    if "extended" in obj:
+        mapped["extended"] = {
+            k: (prefix, _map(tail)) for k, (prefix, tail) in obj["extended"].items()
+        }
+    return mapped
+
+
+def _refs(obj: dict) -> list[str]:
+    """The blobs a checkpoint, or a delta from `diff`, refers to."""
+    refs: set[str] = set()
+
+    def _collect(message: BaseMessage) -> BaseMessage:
+        if isinstance(message.content, BlobRef):
+            refs.add(message.content.hash)
+        return message
+
+    _map_messages(obj, _collect)
+    return sorted(refs)
+
+
+def _replay(loads: Callable[[bytes], Any], rows: list) -> list[Checkpoint]:
+    """Rebuild every checkpoint of a chain returned by `_CHAIN_QUERY`."""
+    if not rows or rows[0][3]:
+        raise ValueError("Checkpoint delta chain does not start at a full snapshot.")
+    checkpoints = [loads(rows[0][0])]
+    for row in rows[1:]:
+        if row[0] is None:
+            # the first checkpoint of a fork
+            checkpoints.append({**checkpoints[-1], "ts": row[1].isoformat()})
+        else:
+            checkpoints.append(apply_delta(checkpoints[-1], loads(row[0])))
+    return checkpoints
+
+
+def _parent_config(
+    thread_id: str,
+    parent_ts: Optional[datetime],
+    parent_thread_id: Optional[str] = None,
+) -> Optional[RunnableConfig]:
+    return (
+        {
+            "configurable": {
+                "thread_id": parent_thread_id or thread_id,
+                "thread_ts": parent_ts,
+            }
+        }
+        if parent_ts
+        else None
+    )
+
+
+def _tuple(
+    thread_id: str,
+    thread_ts: datetime,
+    parent_ts: Optional[datetime],
+    checkpoint: Checkpoint,
+    parent_thread_id: Optional[str] = None,
+) -> CheckpointTuple:
+    return CheckpointTuple(
+        {
+            "configurable": {
+                "thread_id": thread_id,
+                "thread_ts": thread_ts,
+            }
+        },
+        checkpoint,
+        _parent_config(thread_id, parent_ts, parent_thread_id),
+    )
 
 
 class PostgresCheckpoint(BaseCheckpointSaver):
+    serde = CheckpointSerializer()
+
     def __init__(
         self,
         *,
         serde: Optional[SerializerProtocol] = None,
         at: Optional[CheckpointAt] = None,
+        delta: bool = False,
+        snapshot_interval: int = 10,
+        cache_latest: bool = False,
+        cache_size: int = 1024,
+        notify: bool = False,
+        write_behind: bool = False,
+        write_behind_max: int = 50,
+        offload_threshold: Optional[int] = None,
+        blob_recheck_interval: float = 3600,
+        summarize: bool = False,
+        search: bool = False,
+        metrics: Optional[CheckpointMetrics] = None,
     ) -> None:
+        """
+        Args:
+            delta: Store only the channel values that changed since the parent
+                checkpoint, instead of the whole checkpoint on every step.
+            snapshot_interval: In delta mode, write a full checkpoint after this
+                many consecutive deltas to bound how far a read has to replay.
+            cache_latest: Serve reads of the latest checkpoint of a thread from
+                memory when this process wrote or read it last.
+            cache_size: Number of threads for which the latest checkpoint is
+                kept in memory, for `cache_latest` and as the base of deltas.
+            notify: Announce every write on the `checkpoints` channel with
+                NOTIFY, and evict threads written by other processes from the
+                cache. Needed for `cache_latest` when running several workers,
+                and to read history from replicas.
+            write_behind: Queue checkpoints in memory instead of writing each
+                one as it is put. Queued checkpoints are written by `aflush`,
+                before any read of their thread, and whenever a thread has
+                `write_behind_max` of them. Whoever runs the graph must call
+                `aflush` when the run ends; queued checkpoints are lost if the
+                process dies before that.
+            offload_threshold: Store the content of tool messages larger than
+                this many bytes once, in the `checkpoint_blobs` table, and keep
+                only a reference to it in checkpoints. Disabled when None.
+            blob_recheck_interval: Seconds for which a blob stored by this
+                process is assumed to still exist, and isn't stored again.
+                `acollect_blobs` keeps blobs stored for twice as long.
+            summarize: Keep the last message, message count and last run time
+                of the `thread` row of a thread in step with its checkpoints.
+            search: Add the text of new and changed messages to the full-text
+                search index of threads as checkpoints are written.
+            metrics: Where the size and timings of every read and write are
+                recorded. Defaults to the process-wide `CHECKPOINT_METRICS`.
+        """
         super().__init__(serde=serde, at=at)
+        self.delta = delta
+        self.snapshot_interval = snapshot_interval
+        self.cache_latest = cache_latest
+        self.cache_size = cache_size
+        self.notify = notify
+        self.write_behind = write_behind
+        self.write_behind_max = write_behind_max
+        self.offload_threshold = offload_threshold
+        self.blob_recheck_interval = blob_recheck_interval
+        self.summarize = summarize
+        self.search = search
+        self.metrics = CHECKPOINT_METRICS if metrics is None else metrics
+        # offloaded tool messages by id, with their replacement and blob,
+        # so the content of a message is serialized and hashed only once
+        self._offloaded: OrderedDict[
+            int, tuple[BaseMessage, BaseMessage, str, bytes]
+        ] = OrderedDict()
+        # when each blob was last stored by this process
+        self._stored_blobs: OrderedDict[str, float] = OrderedDict()
+        self._pending: dict[str, _Pending] = {}
+        self._latest: OrderedDict[str, _Latest] = OrderedDict()
+        # when each thread was last written, by this process or one that
+        # notified it, and the time before which every thread was written
+        self._written: OrderedDict[str, float] = OrderedDict()
+        self._written_before = time.monotonic()
+        # hashes of the indexed messages of a thread, by message ID, so only
+        # new and changed ones are written
+        self._indexed: OrderedDict[str, dict[str, int]] = OrderedDict()
+        self._listener = Listener(
+            _NOTIFY_CHANNEL,
+            self._on_notify,
+            on_connect=self._on_listener_connected,
+            on_lost=self._on_listener_lost,
+        )
+        self._instance_id = uuid4().hex
 
     @property
     def config_specs(self) -> list[ConfigurableFieldSpec]:
@@ -53,95 +496,675 @@ class PostgresCheckpoint(BaseCheckpointSaver):
     def put(self, config: RunnableConfig, checkpoint: Checkpoint) -> RunnableConfig:
         raise NotImplementedError
 
-    async def alist(self, config: RunnableConfig) -> AsyncIterator[CheckpointTuple]:
-        async with get_pg_pool().acquire() as db, db.transaction():
-            thread_id = config["configurable"]["thread_id"]
-            async for value in db.cursor(
-                "SELECT checkpoint, thread_ts, parent_ts FROM checkpoints WHERE thread_id = $1 ORDER BY thread_ts DESC",
-                thread_id,
-            ):
-                yield CheckpointTuple(
-                    {
-                        "configurable": {
-                            "thread_id": thread_id,
-                            "thread_ts": value[1],
-                        }
-                    },
-                    loads(value[0]),
-                    {
-                        "configurable": {
-                            "thread_id": thread_id,
-                            "thread_ts": value[2],
-                        }
-                    }
-                    if value[2]
-                    else None,
-                )
+    async def start_listener(self) -> None:
+        """Start evicting threads written by other processes from the cache."""
+        if self.notify:
+            await self._listener.start()
+
+    async def stop_listener(self) -> None:
+        await self._listener.stop()
+
+    def _on_notify(self, conn, pid: int, channel: str, payload: str) -> None:
+        instance_id, thread_id = payload.split(":", 1)
+        if instance_id != self._instance_id:
+            self._latest.pop(thread_id, None)
+            self._wrote(thread_id)
+
+    def _on_listener_connected(self) -> None:
+        # threads may have been written while nothing was listening
+        self._latest.clear()
+        self._written_before = time.monotonic()
+
+    def _on_listener_lost(self) -> None:
+        # Writes from other processes can no longer be seen, so stop trusting
+        # the cache until the listener reconnects.
+        logger.warn("Checkpoint cache listener connection lost, clearing cache.")
+        self._latest.clear()
+
+    def _cached(self, thread_id: str) -> Optional[_Latest]:
+        if not self.cache_latest or (self.notify and not self._listener.connected):
+            return None
+        if latest := self._latest.get(thread_id):
+            self._latest.move_to_end(thread_id)
+        return latest
+
+    def _remember(
+        self,
+        thread_id: str,
+        ts: datetime,
+        parent_ts: Optional[datetime],
+        checkpoint: Checkpoint,
+        depth: int,
+        parent_thread_id: Optional[str] = None,
+    ) -> None:
+        if not self.delta and not self.cache_latest:
+            return
+        self._latest[thread_id] = _Latest(
+            ts, parent_ts, copy_checkpoint(checkpoint), depth, parent_thread_id
+        )
+        self._latest.move_to_end(thread_id)
+        while len(self._latest) > self.cache_size:
+            self._latest.popitem(last=False)
+
+    def _wrote(self, thread_id: str) -> None:
+        self._written[thread_id] = time.monotonic()
+        self._written.move_to_end(thread_id)
+        while len(self._written) > self.cache_size:
+            _, self._written_before = self._written.popitem(last=False)
+
+    def _unindexed(
+        self, thread_id: str, checkpoint: Checkpoint
+    ) -> tuple[dict[str, str], dict[str, int]]:
+        """Messages that changed since the last checkpoint indexed, by ID.
+
+        Messages queued in write-behind mode count as indexed. Also returns the
+        hashes of every message, for `_mark_indexed` once they are written.
+        """
+        try:
+            UUID(thread_id)
+        except ValueError:
+            # can't have a thread row
+            return {}, {}
+        texts = searchable_messages(checkpoint["channel_values"])
+        hashes = {id: hash(text) for id, text in texts.items()}
+        pending = self._pending.get(thread_id)
+        if pending is not None and pending.indexed:
+            indexed = pending.indexed
+        else:
+            indexed = self._indexed.get(thread_id, {})
+        return {
+            id: text for id, text in texts.items() if indexed.get(id) != hashes[id]
+        }, hashes
+
+    def _mark_indexed(self, thread_id: str, hashes: dict[str, int]) -> None:
+        self._indexed.pop(thread_id, None)
+        self._indexed[thread_id] = hashes
+        while len(self._indexed) > self.cache_size:
+            self._indexed.popitem(last=False)
+
+    def _offload(self, message: BaseMessage, blobs: dict[str, bytes]) -> BaseMessage:
+        if not isinstance(message, (ToolMessage, FunctionMessage)) or isinstance(
+            message.content, BlobRef
+        ):
+            return message
+        if (offloaded := self._offloaded.get(id(message))) is not None:
+            self._offloaded.move_to_end(id(message))
+            _, replacement, hash, data = offloaded
+            blobs[hash] = data
+            return replacement
+        data = self.serde.dumps({"content": message.content})
+        if len(data) <= self.offload_threshold:
+            return message
+        hash = sha256(data).hexdigest()
+        replacement = message.copy(update={"content": BlobRef(hash=hash)})
+        # the message is kept so its id is not reused while it is in here
+        self._offloaded[id(message)] = (message, replacement, hash, data)
+        while len(self._offloaded) > self.cache_size:
+            self._offloaded.popitem(last=False)
+        blobs[hash] = data
+        return replacement
+
+    def _dumps(self, obj: dict, blobs: dict[str, bytes]) -> tuple[bytes, list[str]]:
+        """Serialize a checkpoint or delta, offloading large tool outputs.
+
+        Returns the blob and the hashes of the offloaded contents it refers to.
+        The offloaded contents are added to `blobs`, which must be stored
+        before the returned blob.
+        """
+        if self.offload_threshold is not None:
+            obj = _map_messages(obj, lambda m: self._offload(m, blobs))
+        return self.serde.dumps(obj), _refs(obj)
+
+    async def _store_blobs(
+        self, conn: asyncpg.Connection, blobs: dict[str, bytes]
+    ) -> None:
+        now = time.monotonic()
+        new = {
+            hash: data
+            for hash, data in blobs.items()
+            if now - self._stored_blobs.get(hash, float("-inf"))
+            >= self.blob_recheck_interval
+        }
+        if not new:
+            return
+        await conn.execute(_STORE_BLOBS, list(new), list(new.values()))
+        for hash in new:
+            self._stored_blobs.pop(hash, None)
+            self._stored_blobs[hash] = now
+        while len(self._stored_blobs) > self.cache_size:
+            self._stored_blobs.popitem(last=False)
+
+    async def _resolve(
+        self, conn: asyncpg.Connection, checkpoint: Checkpoint
+    ) -> Checkpoint:
+        """Replace references to offloaded tool outputs with their content."""
+        if not (refs := set(_refs(checkpoint))):
+            return checkpoint
+        rows = await conn.fetch(_BLOBS, list(refs))
+        contents = {
+            row["hash"]: self.serde.loads(row["data"])["content"] for row in rows
+        }
+        if missing := refs - contents.keys():
+            raise ValueError(f"Checkpoint refers to missing blobs {sorted(missing)}.")
+
+        def _load(message: BaseMessage) -> BaseMessage:
+            if not isinstance(message.content, BlobRef):
+                return message
+            return message.copy(update={"content": contents[message.content.hash]})
+
+        return _map_messages(checkpoint, _load)
+
+    def _encode(
+        self,
+        thread_id: str,
+        parent_ts: Optional[datetime],
+        checkpoint: Checkpoint,
+        blobs: dict[str, bytes],
+    ) -> tuple[bytes, list[str], Optional[datetime], int]:
+        """Returns the blob to store, the blobs it refers to, its parent_ts and
+        its delta depth.
+
+        A delta is only written when the base it is computed against is known
+        to be the stored parent. When the caller did not say which checkpoint
+        it started from, the last checkpoint seen for the thread is used as the
+        parent.
+        """
+        base = self._latest.get(thread_id) if self.delta else None
+        if (
+            base is not None
+            and (parent_ts is None or parent_ts == base.ts)
+            and base.depth + 1 < self.snapshot_interval
+        ):
+            blob, refs = self._dumps(diff(base.checkpoint, checkpoint), blobs)
+            return blob, refs, base.ts, base.depth + 1
+        return *self._dumps(checkpoint, blobs), parent_ts, 0
+
+    async def alist(
+        self,
+        config: RunnableConfig,
+        *,
+        before: Union[str, datetime, None] = None,
+        limit: Optional[int] = None,
+        metadata_only: bool = False,
+    ) -> AsyncIterator[CheckpointTuple]:
+        """List the checkpoints of a thread, newest first.
+
+        Args:
+            before: Only list checkpoints older than this thread_ts.
+            limit: Maximum number of checkpoints to list.
+            metadata_only: Don't rebuild message objects. The channel values
+                of the listed checkpoints are left in their serialized form.
+
+        Each option can also be set with the matching `CONFIG_KEY_*` key in
+        `config["configurable"]`. History is read from a replica only if it has
+        every write to the thread, see `_history_pool`, so it includes every
+        checkpoint written before the call.
+        """
+        configurable = config["configurable"]
+        thread_id = configurable["thread_id"]
+        flushed = thread_id in self._pending
+        await self.aflush(thread_id)
+        before = _to_datetime(before or configurable.get(CONFIG_KEY_BEFORE))
+        limit = limit or configurable.get(CONFIG_KEY_LIMIT)
+        # offloaded tool outputs are only read when messages are rebuilt
+        resolve = not (metadata_only or configurable.get(CONFIG_KEY_METADATA_ONLY))
+        if resolve:
+            loads = self.serde.loads
+        else:
+            loads = getattr(self.serde, "loads_raw", self.serde.loads)
+        op = CheckpointOp("list", thread_id)
+        try:
+            pool = self._history_pool(thread_id, flushed)
+            async with pool.acquire() as db, db.transaction():
+                replayed: dict[datetime, Checkpoint] = {}
+                cursor = db.cursor(
+                    "SELECT checkpoint, thread_ts, parent_ts, delta, parent_thread_id "
+                    "FROM checkpoints "
+                    "WHERE thread_id = $1 AND ($2::timestamptz IS NULL OR thread_ts < $2) "
+                    "ORDER BY thread_ts DESC LIMIT $3",
+                    thread_id,
+                    before,
+                    limit,
+                ).__aiter__()
+                while True:
+                    try:
+                        with op.db():
+                            value = await cursor.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    op.bytes += len(value[0] or b"")
+                    if value[1] in replayed:
+                        checkpoint = replayed.pop(value[1])
+                    elif value[3]:
+                        with op.db():
+                            rows = await db.fetch(_CHAIN_AT, thread_id, value[1])
+                        op.bytes += sum(len(row[0] or b"") for row in rows)
+                        with op.serde():
+                            checkpoints = _replay(loads, rows)
+                        for row, replayed_checkpoint in zip(rows, checkpoints):
+                            replayed[row[1]] = replayed_checkpoint
+                        checkpoint = replayed.pop(value[1])
+                    else:
+                        with op.serde():
+                            checkpoint = loads(value[0])
+                    if resolve:
+                        with op.db():
+                            checkpoint = await self._resolve(db, checkpoint)
+                    op.messages += _count_messages(checkpoint)
+                    yield _tuple(thread_id, value[1], value[2], checkpoint, value[4])
+        finally:
+            self.metrics.record(op)
+
+    def _history_pool(self, thread_id: str, flushed: bool) -> asyncpg.Pool:
+        """A replica that has every write to a thread, or else the primary.
+
+        Writes by other processes are only known from their notifications, so
+        replicas are only read in notify mode while the listener runs.
+        """
+        if flushed or not self.notify or not self._listener.connected:
+            return get_pg_pool()
+        written = max(self._written.get(thread_id, 0), self._written_before)
+        return get_pg_read_pool(since=written)
 
     async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
         thread_id = config["configurable"]["thread_id"]
         thread_ts = config["configurable"].get("thread_ts")
+        if not thread_ts and (latest := self._cached(thread_id)):
+            op = CheckpointOp("get_cached", thread_id)
+            op.messages = _count_messages(latest.checkpoint)
+            self.metrics.record(op)
+            return _tuple(
+                thread_id,
+                latest.ts,
+                latest.parent_ts,
+                copy_checkpoint(latest.checkpoint),
+                latest.parent_thread_id,
+            )
+        await self.aflush(thread_id)
+        op = CheckpointOp("get", thread_id)
         async with get_pg_pool().acquire() as conn:
-            if thread_ts:
-                if value := await conn.fetchrow(
-                    "SELECT checkpoint, parent_ts FROM checkpoints WHERE thread_id = $1 AND thread_ts = $2",
-                    thread_id,
-                    datetime.fromisoformat(thread_ts),
-                ):
-                    return CheckpointTuple(
-                        config,
-                        loads(value[0]),
-                        {
-                            "configurable": {
-                                "thread_id": thread_id,
-                                "thread_ts": value[1],
-                            }
-                        }
-                        if value[1]
-                        else None,
-                    )
-            else:
-                if value := await conn.fetchrow(
-                    "SELECT checkpoint, thread_ts, parent_ts FROM checkpoints WHERE thread_id = $1 ORDER BY thread_ts DESC LIMIT 1",
-                    thread_id,
-                ):
-                    return CheckpointTuple(
-                        {
-                            "configurable": {
-                                "thread_id": thread_id,
-                                "thread_ts": value[1],
-                            }
-                        },
-                        loads(value[0]),
-                        {
-                            "configurable": {
-                                "thread_id": thread_id,
-                                "thread_ts": value[2],
-                            }
-                        }
-                        if value[2]
-                        else None,
+            with op.db():
+                if thread_ts:
+                    rows = await conn.fetch(
+                        _CHAIN_AT, thread_id, _to_datetime(thread_ts)
                     )
+                else:
+                    rows = await conn.fetch(_CHAIN_LATEST, thread_id)
+            if not rows:
+                self.metrics.record(op)
+                return None
+            op.bytes = sum(len(row[0] or b"") for row in rows)
+            with op.serde():
+                checkpoint = _replay(self.serde.loads, rows)[-1]
+            with op.db():
+                checkpoint = await self._resolve(conn, checkpoint)
+        op.messages = _count_messages(checkpoint)
+        self.metrics.record(op)
+        ts, parent_ts, parent_thread_id = rows[-1][1], rows[-1][2], rows[-1][4]
+        if thread_ts:
+            return CheckpointTuple(
+                config,
+                checkpoint,
+                _parent_config(thread_id, parent_ts, parent_thread_id),
+            )
+        self._remember(
+            thread_id, ts, parent_ts, checkpoint, len(rows) - 1, parent_thread_id
+        )
+        return _tuple(thread_id, ts, parent_ts, checkpoint, parent_thread_id)
 
     async def aput(self, config: RunnableConfig, checkpoint: Checkpoint) -> None:
         thread_id = config["configurable"]["thread_id"]
-        async with get_pg_pool().acquire() as conn:
-            await conn.execute(
-                """
-                INSERT INTO checkpoints (thread_id, thread_ts, parent_ts, checkpoint)
-                VALUES ($1, $2, $3, $4) 
-                ON CONFLICT (thread_id, thread_ts) 
-                DO UPDATE SET checkpoint = EXCLUDED.checkpoint;""",
+        thread_ts = datetime.fromisoformat(checkpoint["ts"])
+        op = CheckpointOp("put", thread_id)
+        op.messages = _count_messages(checkpoint)
+        blobs: dict[str, bytes] = {}
+        with op.serde():
+            blob, refs, parent_ts, depth = self._encode(
                 thread_id,
-                datetime.fromisoformat(checkpoint["ts"]),
-                datetime.fromisoformat(checkpoint.get("parent_ts"))
-                if checkpoint.get("parent_ts")
-                else None,
-                pickle.dumps(checkpoint),
+                _to_datetime(
+                    checkpoint.get("parent_ts")
+                    or config["configurable"].get("thread_ts")
+                ),
+                checkpoint,
+                blobs,
             )
+        op.bytes = len(blob)
+        summary = _summary(thread_id, thread_ts, checkpoint) if self.summarize else None
+        search, indexed = (
+            self._unindexed(thread_id, checkpoint) if self.search else ({}, {})
+        )
+        if self.write_behind:
+            self.metrics.record(op)
+            if thread_id not in self._pending:
+                self._pending[thread_id] = _Pending(
+                    [], copy_checkpoint(checkpoint), {}, [], {}, {}
+                )
+            self._pending[thread_id].blobs.update(blobs)
+            if summary:
+                self._pending[thread_id].summary[:] = summary
+            self._pending[thread_id].search.update(search)
+            if self.search:
+                self._pending[thread_id].indexed.clear()
+                self._pending[thread_id].indexed.update(indexed)
+            rows = self._pending[thread_id].rows
+            rows.append((thread_ts, parent_ts, blob, depth > 0, " ".join(refs)))
+            # remembered before the flush, which may take a while, so that the
+            # next checkpoint is encoded against this one
+            self._remember(thread_id, thread_ts, parent_ts, checkpoint, depth)
+            if len(rows) >= self.write_behind_max:
+                await self.aflush(thread_id)
+            return {
+                "configurable": {
+                    "thread_id": thread_id,
+                    "thread_ts": checkpoint["ts"],
+                }
+            }
+        async with get_pg_pool().acquire() as conn:
+            with op.db():
+                await self._store_blobs(conn, blobs)
+            for _ in range(2):
+                with op.db():
+                    written = await conn.fetchrow(
+                        _PUT_NOTIFY if self.notify else _PUT,
+                        thread_id,
+                        thread_ts,
+                        parent_ts,
+                        blob,
+                        depth > 0,
+                        refs,
+                        *((self._instance_id,) if self.notify else ()),
+                    )
+                if written is not None:
+                    break
+                # the base of the delta was pruned, store a snapshot instead
+                with op.serde():
+                    (blob, refs), depth = self._dumps(checkpoint, blobs), 0
+                op.bytes = len(blob)
+            if summary:
+                with op.db():
+                    await conn.execute(_SUMMARY, *summary)
+            if search:
+                with op.db():
+                    await conn.execute(
+                        _SEARCH_INDEX,
+                        thread_id,
+                        list(search),
+                        list(search.values()),
+                        thread_ts,
+                    )
+        self.metrics.record(op)
+        self._wrote(thread_id)
+        if self.search:
+            self._mark_indexed(thread_id, indexed)
+        self._remember(thread_id, thread_ts, parent_ts, checkpoint, depth)
         return {
             "configurable": {
                 "thread_id": thread_id,
                 "thread_ts": checkpoint["ts"],
             }
         }
+
+    async def afork(
+        self,
+        source_thread_id: str,
+        thread_id: str,
+        thread_ts: Union[str, datetime, None] = None,
+    ) -> Optional[RunnableConfig]:
+        """Start `thread_id` from a checkpoint of another thread.
+
+        Forks the latest checkpoint of `source_thread_id`, or the one at
+        `thread_ts`. Nothing is copied: the new thread's first checkpoint
+        refers to the source one. Returns its config, or None if the source
+        checkpoint doesn't exist.
+        """
+        await self.aflush(source_thread_id)
+        async with get_pg_pool().acquire() as conn:
+            forked_ts = await conn.fetchval(
+                _FORK,
+                thread_id,
+                source_thread_id,
+                _to_datetime(thread_ts),
+                datetime.now(timezone.utc),
+            )
+        if forked_ts is None:
+            return None
+        await self.aforget([thread_id])
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "thread_ts": forked_ts,
+            }
+        }
+
+    async def arefresh_summary(self, thread_id: str) -> None:
+        """Set the summary of a thread from its latest checkpoint.
+
+        For threads whose checkpoints weren't written with `summarize`.
+        """
+        latest = await self.aget_tuple({"configurable": {"thread_id": thread_id}})
+        if latest is None:
+            return
+        ts = _to_datetime(latest.config["configurable"]["thread_ts"])
+        if (summary := _summary(thread_id, ts, latest.checkpoint)) is not None:
+            async with get_pg_pool().acquire() as conn:
+                await conn.execute(_SUMMARY, *summary)
+
+    async def areindex(self, thread_id: str) -> None:
+        """Add the messages of the latest checkpoint of a thread to the search
+        index, for threads whose checkpoints weren't written with `search`."""
+        latest = await self.aget_tuple({"configurable": {"thread_id": thread_id}})
+        if latest is None:
+            return
+        self._indexed.pop(thread_id, None)
+        search, indexed = self._unindexed(thread_id, latest.checkpoint)
+        if search:
+            async with get_pg_pool().acquire() as conn:
+                await conn.execute(
+                    _SEARCH_INDEX,
+                    thread_id,
+                    list(search),
+                    list(search.values()),
+                    _to_datetime(latest.config["configurable"]["thread_ts"]),
+                )
+        self._mark_indexed(thread_id, indexed)
+
+    async def aforget(self, thread_ids: list[str]) -> None:
+        """Evict threads whose checkpoints were written around the checkpointer.
+
+        From the cache of this process, and of every other one in notify mode.
+        """
+        if self.notify and thread_ids:
+            async with get_pg_pool().acquire() as conn:
+                await conn.executemany(
+                    "SELECT pg_notify($1, $2)",
+                    [
+                        (_NOTIFY_CHANNEL, f"{self._instance_id}:{thread_id}")
+                        for thread_id in thread_ids
+                    ],
+                )
+        for thread_id in thread_ids:
+            self._latest.pop(thread_id, None)
+            self._wrote(thread_id)
+
+    async def alist_metadata(
+        self,
+        thread_id: str,
+        *,
+        before: Union[str, datetime, None] = None,
+        limit: Optional[int] = None,
+    ) -> list[CheckpointMetadata]:
+        """List the checkpoints of a thread without reading them, newest first.
+
+        Answered from the primary key index alone, which includes these
+        columns. Only the first checkpoint of a fork, which has no blob, is
+        looked up in the table for its parent thread. Read from a replica as
+        by `alist`.
+        """
+        flushed = thread_id in self._pending
+        await self.aflush(thread_id)
+        async with self._history_pool(thread_id, flushed).acquire() as conn:
+            return await conn.fetch(_METADATA, thread_id, _to_datetime(before), limit)
+
+    async def aflush(self, thread_id: Optional[str] = None) -> None:
+        """Write the checkpoints queued in write-behind mode.
+
+        Flushes a single thread, or every thread when `thread_id` is None.
+        """
+        if not self._pending:
+            return
+        if thread_id is None:
+            for thread_id in list(self._pending):
+                await self.aflush(thread_id)
+            return
+        if (pending := self._pending.pop(thread_id, None)) is None:
+            return
+        # a checkpoint put twice is written once, with its last value
+        rows = list({row[0]: row for row in pending.rows}.values())
+        op = CheckpointOp("flush", thread_id)
+        async with get_pg_pool().acquire() as conn:
+            with op.db():
+                await self._store_blobs(conn, pending.blobs)
+            for _ in range(2):
+                required = rows[0][1] if rows[0][3] else None
+                with op.db():
+                    status = await conn.execute(
+                        _PUT_MANY, thread_id, *map(list, zip(*rows)), required
+                    )
+                if status != "INSERT 0 0":
+                    break
+                # the base of the first delta was pruned, store a snapshot
+                # (its tool outputs were offloaded with the queued delta)
+                with op.serde():
+                    blob, refs = self._dumps(pending.first, pending.blobs)
+                    rows[0] = (*rows[0][:2], blob, False, " ".join(refs))
+            if pending.summary:
+                with op.db():
+                    await conn.execute(_SUMMARY, *pending.summary)
+            if pending.search:
+                with op.db():
+                    await conn.execute(
+                        _SEARCH_INDEX,
+                        thread_id,
+                        list(pending.search),
+                        list(pending.search.values()),
+                        rows[-1][0],
+                    )
+            if self.notify:
+                with op.db():
+                    await conn.execute(
+                        "SELECT pg_notify($1, $2)",
+                        _NOTIFY_CHANNEL,
+                        f"{self._instance_id}:{thread_id}",
+                    )
+        op.bytes = sum(len(row[2]) for row in rows)
+        self.metrics.record(op)
+        self._wrote(thread_id)
+        if pending.indexed:
+            self._mark_indexed(thread_id, pending.indexed)
+
+    async def aprune(
+        self,
+        thread_id: str,
+        *,
+        keep_last: int,
+        min_age: timedelta,
+        batch_size: int = 500,
+    ) -> int:
+        """Delete old checkpoints of a thread. Returns the number deleted.
+
+        Keeps the newest `keep_last` checkpoints, every checkpoint younger than
+        `min_age`, and branch points, ie. checkpoints that are the parent of
+        more than one checkpoint or that other threads were forked from. Kept
+        deltas whose parent is deleted are
+        rewritten as full snapshots first, so every kept checkpoint can still
+        be read.
+        """
+        cutoff = datetime.now(timezone.utc) - min_age
+        await self.aflush(thread_id)
+        async with get_pg_pool().acquire() as conn:
+            rows = await conn.fetch(_METADATA, thread_id, None, None)
+            children = Counter(row["parent_ts"] for row in rows if row["parent_ts"])
+            forked = {
+                row["parent_ts"]
+                for row in await conn.fetch(
+                    "SELECT parent_ts FROM checkpoints WHERE parent_thread_id = $1",
+                    thread_id,
+                )
+            }
+            delete = {
+                row["thread_ts"]
+                for row in rows[keep_last:]
+                if row["thread_ts"] < cutoff
+                and children[row["thread_ts"]] < 2
+                and row["thread_ts"] not in forked
+            }
+            if not delete:
+                return 0
+            for row in reversed(rows):
+                if (
+                    row["delta"]
+                    and row["thread_ts"] not in delete
+                    and row["parent_ts"] in delete
+                ):
+                    chain = await conn.fetch(_CHAIN_AT, thread_id, row["thread_ts"])
+                    snapshot = _replay(self.serde.loads, chain)[-1]
+                    await conn.execute(
+                        "UPDATE checkpoints SET checkpoint = $3, delta = false, blob_refs = $4 WHERE thread_id = $1 AND thread_ts = $2",
+                        thread_id,
+                        row["thread_ts"],
+                        self.serde.dumps(snapshot),
+                        _refs(snapshot),
+                    )
+            delete = sorted(delete)
+            for i in range(0, len(delete), batch_size):
+                await conn.execute(
+                    "DELETE FROM checkpoints WHERE thread_id = $1 AND thread_ts = ANY($2::timestamptz[])",
+                    thread_id,
+                    delete[i : i + batch_size],
+                )
+        self._wrote(thread_id)
+        return len(delete)
+
+    async def acollect_blobs(self, *, min_age: timedelta) -> int:
+        """Delete the offloaded tool outputs no checkpoint refers to anymore.
+
+        Returns the number deleted. Blobs stored in the last `min_age`, or
+        twice `blob_recheck_interval` if longer, are kept, as a checkpoint
+        about to be written may refer to them.
+        """
+        min_age = max(min_age, timedelta(seconds=2 * self.blob_recheck_interval))
+        async with get_pg_pool().acquire() as conn:
+            status = await conn.execute(
+                _COLLECT_BLOBS, datetime.now(timezone.utc) - min_age
+            )
+        return int(status.split()[-1])
+
+    async def abackfill_blob_refs(self, limit: int) -> int:
+        """Record which blobs checkpoints written before references were kept
+        refer to, so that `acollect_blobs` can run.
+
+        Updates at most `limit` checkpoints, returns the number updated.
+        """
+        async with get_pg_pool().acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT thread_id, thread_ts, checkpoint FROM checkpoints "
+                "WHERE blob_refs IS NULL LIMIT $1",
+                limit,
+            )
+            if not rows:
+                return 0
+            await conn.execute(
+                "UPDATE checkpoints c SET blob_refs = string_to_array(r.refs, ' ') "
+                "FROM unnest($1::text[], $2::timestamptz[], $3::text[]) "
+                "AS r(thread_id, thread_ts, refs) "
+                "WHERE c.thread_id = r.thread_id AND c.thread_ts = r.thread_ts",
+                [row["thread_id"] for row in rows],
+                [row["thread_ts"] for row in rows],
+                [
+                    " ".join(_refs(self.serde.loads(row["checkpoint"])))
+                    if row["checkpoint"] is not None
+                    else ""
+                    for row in rows
+                ],
+            )
+        return len(rows)
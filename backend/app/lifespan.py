@@ -1,18 +1,51 @@
+import asyncio
 import os
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
+from typing import Optional
 
 import asyncpg
 import orjson
 import structlog
 from fastapi import FastAPI
 
+from app.queries import pool_options, transaction_pooling
+from app.replicas import ReplicaSet, ReplicaSettings
+
 _pg_pool = None
+_pg_session_pool = None
+_replicas: Optional[ReplicaSet] = None
+
+# Connections held for the life of the process, for session state: the
+# listeners of the checkpoint cache, the assistant cache and the run queue,
+# and the advisory locks of threads, retention and backfills.
+SESSION_CONNECTIONS = 6
 
 
 def get_pg_pool() -> asyncpg.pool.Pool:
     return _pg_pool
 
 
+def get_pg_session_pool() -> asyncpg.pool.Pool:
+    """The pool of connections held for LISTEN and session advisory locks.
+
+    The main pool, unless it goes through pgbouncer in transaction mode, which
+    doesn't keep a server connection for a client between transactions.
+    """
+    return _pg_session_pool
+
+
+def get_pg_read_pool(since: Optional[float] = None) -> asyncpg.pool.Pool:
+    """A replica for reads that may lag behind writes, or else the primary.
+
+    Only for reads that don't need to see the caller's own recent writes, or
+    that only need to see writes committed before the `time.monotonic()` in
+    `since`.
+    """
+    if _replicas is not None and (pool := _replicas.pick(since)) is not None:
+        return pool
+    return _pg_pool
+
+
 async def _init_connection(conn) -> None:
     await conn.set_type_codec(
         "json",
@@ -29,6 +62,8 @@ async def _init_connection(conn) -> None:
     await conn.set_type_codec(
         "uuid", encoder=lambda v: str(v), decoder=lambda v: v, schema="pg_catalog"
     )
+    # after the codecs, which prepared statements pick up when they are created
+    await conn.prepare_registered()
 
 
 @asynccontextmanager
@@ -75,8 +110,15 @@ async def lifespan(app: FastAPI):
     )
 
     # 2. 初始化 PostgreSQL 連接池
-    global _pg_pool
-
+    global _pg_pool, _pg_session_pool, _replicas
+
+    # 長期占用的 session 連線另外計算，不佔查詢用的連線數
+    max_size = int(os.environ.get("POSTGRES_POOL_MAX_SIZE", "10"))
+    if transaction_pooling() and not os.environ.get("POSTGRES_SESSION_HOST"):
+        raise RuntimeError(
+            "POSTGRES_POOL_MODE=transaction requires POSTGRES_SESSION_HOST, a "
+            "postgres or pgbouncer in session mode for LISTEN and advisory locks."
+        )
     _pg_pool = await asyncpg.create_pool(
         database=os.environ["POSTGRES_DB"],
         user=os.environ["POSTGRES_USER"],
@@ -84,12 +126,97 @@ async def lifespan(app: FastAPI):
         host=os.environ["POSTGRES_HOST"],
         port=os.environ["POSTGRES_PORT"],
         init=_init_connection,
+        max_size=max_size + (0 if transaction_pooling() else SESSION_CONNECTIONS),
+        **pool_options(),
+    )
+    if transaction_pooling():
+        _pg_session_pool = await asyncpg.create_pool(
+            database=os.environ["POSTGRES_DB"],
+            user=os.environ["POSTGRES_USER"],
+            password=os.environ["POSTGRES_PASSWORD"],
+            host=os.environ["POSTGRES_SESSION_HOST"],
+            port=os.environ.get("POSTGRES_SESSION_PORT", os.environ["POSTGRES_PORT"]),
+            min_size=0,
+            max_size=SESSION_CONNECTIONS,
+        )
+    else:
+        _pg_session_pool = _pg_pool
+
+    # 唯讀副本的連接池 (未設定 POSTGRES_REPLICA_HOSTS 時不建立)
+    _replicas = await ReplicaSet.create(
+        ReplicaSettings(),
+        primary=_pg_pool,
+        default_port=os.environ["POSTGRES_PORT"],
+        connect=lambda host, port: asyncpg.create_pool(
+            database=os.environ["POSTGRES_DB"],
+            user=os.environ["POSTGRES_USER"],
+            password=os.environ["POSTGRES_PASSWORD"],
+            host=host,
+            port=port,
+            init=_init_connection,
+            min_size=0,
+            **pool_options(),
+        ),
     )
+    if _replicas is not None:
+        _replicas.start()
+
+    # 3. 啟動 checkpoint 快取的跨 worker 失效監聽
+    # (app.agent 依賴此模組，所以在這裡才匯入)
+    from app.agent import CHECKPOINTER
+
+    await CHECKPOINTER.start_listener()
+
+    # 4. 啟動 assistant 快取的跨 worker 失效監聽
+    from app.storage import ASSISTANT_CACHE
+
+    await ASSISTANT_CACHE.start_listener()
+
+    # 5. 啟動 checkpoint 保留策略的背景清理任務 (未設定時不啟動)
+    from app.retention import start_retention
+
+    retention = start_retention(CHECKPOINTER)
+
+    # 6. 背景補齊既有 thread 的衍生資料 (僅 BACKFILL_ENABLED=true 的維護執行)
+    from app.backfill import start_backfill
+
+    backfill = start_backfill(CHECKPOINTER)
+
+    # 7. 預先取得 OIDC 簽章金鑰，並在背景於過期前更新
+    from app.auth.handlers import get_auth_handler
+
+    auth_handler = get_auth_handler()
+    await auth_handler.start()
+
+    # 8. 啟動本行程執行背景 run 的 worker
+    from app.run_queue import RUN_QUEUE
+
+    await RUN_QUEUE.start()
+
+    # 9. 預先建立 run 的輸入/輸出/設定 schema
+    from app.api.runs import warm_schemas
+
+    warm_schemas()
 
     yield  # 將控制權交回 FastAPI
 
     # 關閉邏輯：應用關閉時執行
+    for task in (retention, backfill):
+        if task is not None:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+    await RUN_QUEUE.stop()
+    await auth_handler.stop()
+    await CHECKPOINTER.aflush()
+    await CHECKPOINTER.stop_listener()
+    await ASSISTANT_CACHE.stop_listener()
+    if _replicas is not None:
+        await _replicas.close()
+        _replicas = None
+    if _pg_session_pool is not _pg_pool:
+        await _pg_session_pool.close()
     await _pg_pool.close()
-    _pg_pool = None
+    _pg_pool = _pg_session_pool = None
 
     
\ No newline at end of file
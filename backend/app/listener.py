@@ -0,0 +1,103 @@
+import asyncio
+from typing import Callable, Optional
+
+import asyncpg
+import structlog
+
+from app.lifespan import get_pg_session_pool
+
+logger = structlog.get_logger(__name__)
+
+
+class Listener:
+    """LISTEN on a channel on a connection of its own, reconnecting when the
+    connection is lost.
+
+    Notifications sent while there is no connection are missed, so `on_lost`
+    is called when the connection is lost, and `on_connect` every time it
+    listens again. Reconnects are retried with a delay that doubles up to
+    `max_delay` seconds.
+    """
+
+    def __init__(
+        self,
+        channel: str,
+        callback: Callable[[asyncpg.Connection, int, str, str], None],
+        *,
+        on_connect: Optional[Callable[[], None]] = None,
+        on_lost: Optional[Callable[[], None]] = None,
+        max_delay: float = 30,
+    ) -> None:
+        self.channel = channel
+        self.callback = callback
+        self.on_connect = on_connect
+        self.on_lost = on_lost
+        self.max_delay = max_delay
+        self._conn: Optional[asyncpg.Connection] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+
+    @property
+    def connected(self) -> bool:
+        return self._conn is not None
+
+    async def start(self) -> None:
+        if self._conn is None and self._reconnect_task is None:
+            await self._connect()
+
+    async def stop(self) -> None:
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            try:
+                await self._reconnect_task
+            except asyncio.CancelledError:
+                pass
+            self._reconnect_task = None
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        conn.remove_termination_listener(self._on_terminated)
+        await conn.remove_listener(self.channel, self.callback)
+        await get_pg_session_pool().release(conn)
+
+    async def _connect(self) -> None:
+        pool = get_pg_session_pool()
+        conn = await pool.acquire()
+        try:
+            await conn.add_listener(self.channel, self.callback)
+        except BaseException:
+            await pool.release(conn)
+            raise
+        conn.add_termination_listener(self._on_terminated)
+        self._conn = conn
+        if self.on_connect is not None:
+            self.on_connect()
+
+    def _on_terminated(self, conn: asyncpg.Connection) -> None:
+        logger.warn("Listener connection lost, reconnecting.", channel=self.channel)
+        self._conn = None
+        if self.on_lost is not None:
+            self.on_lost()
+        self._reconnect_task = asyncio.create_task(self._reconnect(conn))
+
+    async def _reconnect(self, lost: asyncpg.Connection) -> None:
+        # frees the pool's slot of the lost connection
+        await get_pg_session_pool().release(lost)
+        delay = 0.1
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self._connect()
+            except (
+                OSError,
+                asyncio.TimeoutError,
+                asyncpg.PostgresError,
+                asyncpg.InterfaceError,
+            ) as e:
+                logger.warn(
+                    "Listener reconnect failed", channel=self.channel, error=str(e)
+                )
+                delay = min(delay * 2, self.max_delay)
+            else:
+                logger.info("Listener reconnected", channel=self.channel)
+                self._reconnect_task = None
+                return
@@ -0,0 +1,118 @@
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator
+
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+_FIELDS = ("bytes", "serde_ms", "db_ms", "messages")
+
+
+class CheckpointOp:
+    """Measurements of one checkpointer call, eg. an `aput`."""
+
+    __slots__ = ("op", "thread_id", "bytes", "serde_ms", "db_ms", "messages")
+
+    def __init__(self, op: str, thread_id: str) -> None:
+        self.op = op
+        self.thread_id = thread_id
+        self.bytes = 0
+        """Size of the blobs written or read."""
+        self.serde_ms = 0.0
+        self.db_ms = 0.0
+        self.messages = 0
+        """Number of messages in the checkpoints written or read."""
+
+    @contextmanager
+    def serde(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.serde_ms += (time.perf_counter() - start) * 1000
+
+    @contextmanager
+    def db(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.db_ms += (time.perf_counter() - start) * 1000
+
+
+class CheckpointMetrics:
+    """Aggregates checkpointer calls per operation and per thread.
+
+    Every call is logged at debug level, and at info level when it is slower
+    than `slow_ms` or moves more than `large_bytes`. Totals are kept for the
+    `max_threads` most recently active threads, to find the threads that
+    drive storage and latency.
+    """
+
+    def __init__(
+        self,
+        *,
+        slow_ms: float = 100,
+        large_bytes: int = 1024 * 1024,
+        max_threads: int = 10000,
+    ) -> None:
+        self.slow_ms = slow_ms
+        self.large_bytes = large_bytes
+        self.max_threads = max_threads
+        self._ops: dict[str, dict[str, float]] = {}
+        self._threads: OrderedDict[str, dict[str, float]] = OrderedDict()
+
+    def record(self, op: CheckpointOp) -> None:
+        values = {field: getattr(op, field) for field in _FIELDS}
+        totals = self._ops.setdefault(
+            op.op, {"count": 0, **{field: 0 for field in _FIELDS}, "max_bytes": 0}
+        )
+        totals["count"] += 1
+        totals["max_bytes"] = max(totals["max_bytes"], op.bytes)
+        thread = self._threads.pop(op.thread_id, None) or {
+            "count": 0,
+            **{field: 0 for field in _FIELDS},
+        }
+        thread["count"] += 1
+        for field, value in values.items():
+            totals[field] += value
+            thread[field] += value
+        self._threads[op.thread_id] = thread
+        while len(self._threads) > self.max_threads:
+            self._threads.popitem(last=False)
+
+        log = (
+            logger.info
+            if op.serde_ms + op.db_ms > self.slow_ms or op.bytes > self.large_bytes
+            else logger.debug
+        )
+        log("Checkpoint operation", op=op.op, thread_id=op.thread_id, **values)
+
+    def snapshot(self, top: int = 20) -> dict:
+        """Totals per operation, and the threads with the most bytes and time."""
+
+        def _top(key) -> list[dict]:
+            threads = sorted(self._threads.items(), key=lambda t: key(t[1]))
+            return [
+                {"thread_id": thread_id, **totals}
+                for thread_id, totals in threads[::-1][:top]
+            ]
+
+        return {
+            "operations": self._ops,
+            "top_threads_by_bytes": _top(lambda t: t["bytes"]),
+            "top_threads_by_time": _top(lambda t: t["serde_ms"] + t["db_ms"]),
+        }
+
+    def reset(self) -> None:
+        self._ops.clear()
+        self._threads.clear()
+
+
+CHECKPOINT_METRICS = CheckpointMetrics(
+    slow_ms=float(os.environ.get("CHECKPOINT_METRICS_SLOW_MS", 100)),
+    large_bytes=int(os.environ.get("CHECKPOINT_METRICS_LARGE_BYTES", 1024 * 1024)),
+)
@@ -0,0 +1,119 @@
+"""Hot SQL statements, prepared once on every pooled connection.
+
+Modules register their most frequent statements with `register` when they
+are imported. `PreparedConnection`, the connection class of the pool,
+prepares them when a connection is opened. It then runs `execute`, `fetch`,
+`fetchrow` and `fetchval` of a registered statement through its prepared
+statement, skipping parse and plan.
+
+asyncpg also prepares and caches every statement it runs, but behind
+pgbouncer in transaction mode (POSTGRES_POOL_MODE=transaction) that cache
+has to be disabled. Only the registered statements stay prepared then. They
+are named, which pgbouncer supports from 1.21 with `max_prepared_statements`
+set. LISTEN and session advisory locks don't work through such a pool, so
+they use connections to POSTGRES_SESSION_HOST, see `get_pg_session_pool`.
+"""
+import os
+from typing import Any, Optional
+
+import asyncpg
+import structlog
+from asyncpg.prepared_stmt import PreparedStatement
+
+logger = structlog.get_logger(__name__)
+
+_QUERIES: dict[str, str] = {}
+
+
+def register(name: str, query: str) -> str:
+    """Prepare `query` on every connection from now on. Returns the query."""
+    if _QUERIES.get(name, query) != query:
+        raise ValueError(f"Query {name} is already registered.")
+    _QUERIES[name] = query
+    return query
+
+
+def transaction_pooling() -> bool:
+    """Whether connections go through pgbouncer in transaction mode."""
+    return os.environ.get("POSTGRES_POOL_MODE", "session").lower() == "transaction"
+
+
+def pool_options() -> dict[str, Any]:
+    """Options of `asyncpg.create_pool` for the configured pool mode."""
+    options: dict[str, Any] = {"connection_class": PreparedConnection}
+    if transaction_pooling():
+        options["statement_cache_size"] = 0
+    return options
+
+
+class PreparedConnection(asyncpg.Connection):
+    """A connection that runs registered queries as prepared statements."""
+
+    __slots__ = ("_prepared",)
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._prepared: dict[str, PreparedStatement] = {}
+
+    async def prepare_registered(self) -> None:
+        for name, query in _QUERIES.items():
+            if query in self._prepared:
+                continue
+            try:
+                self._prepared[query] = await self.prepare(
+                    query, name=f"opengpts_{name}"
+                )
+            except asyncpg.PostgresError as e:
+                # eg. a table that a pending migration creates
+                logger.warn("Could not prepare query", name=name, error=str(e))
+
+    def _forget(self, query: str) -> None:
+        # the schema changed since the query was prepared, asyncpg prepares it
+        # again as an ordinary query
+        logger.warn("Prepared query is outdated", query=query)
+        self._prepared.pop(query, None)
+
+    async def execute(self, query: str, *args, timeout: Optional[float] = None) -> str:
+        # without arguments asyncpg runs the query as a simple query, which may
+        # hold several statements; registered queries always take arguments
+        if args and (stmt := self._prepared.get(query)) is not None:
+            try:
+                await stmt.fetch(*args, timeout=timeout)
+                return stmt.get_statusmsg()
+            except asyncpg.exceptions.InvalidCachedStatementError:
+                self._forget(query)
+        return await super().execute(query, *args, timeout=timeout)
+
+    async def fetch(
+        self, query: str, *args, timeout: Optional[float] = None, **kwargs
+    ) -> list:
+        if (stmt := self._prepared.get(query)) is not None and not kwargs:
+            try:
+                return await stmt.fetch(*args, timeout=timeout)
+            except asyncpg.exceptions.InvalidCachedStatementError:
+                self._forget(query)
+        return await super().fetch(query, *args, timeout=timeout, **kwargs)
+
+    async def fetchrow(
+        self, query: str, *args, timeout: Optional[float] = None, **kwargs
+    ) -> Optional[asyncpg.Record]:
+        if (stmt := self._prepared.get(query)) is not None and not kwargs:
+            try:
+                return await stmt.fetchrow(*args, timeout=timeout)
+            except asyncpg.exceptions.InvalidCachedStatementError:
+                self._forget(query)
+        return await super().fetchrow(query, *args, timeout=timeout, **kwargs)
+
+    async def fetchval(
+        self,
+        query: str,
+        *args,
+        column: int = 0,
+        timeout: Optional[float] = None,
+    ) -> Any:
+        if (stmt := self._prepared.get(query)) is not None:
+            try:
+                return await stmt.fetchval(*args, column=column, timeout=timeout)
+            except asyncpg.exceptions.InvalidCachedStatementError:
+                self._forget(query)
+        return await super().fetchval(query, *args, column=column, timeout=timeout)
@@ -0,0 +1,167 @@
+import asyncio
+import itertools
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+import asyncpg
+import structlog
+from pydantic import BaseSettings
+
+logger = structlog.get_logger(__name__)
+
+_PRIMARY_LSN_QUERY = "SELECT pg_current_wal_lsn()::text"
+
+# Whether a replica has replayed the primary's WAL up to $1, and the seconds
+# since the last transaction it replayed. No row if it isn't in recovery.
+# Comparing with the primary's position, rather than what the replica has
+# received, sees that a replica which lost its connection falls behind.
+_LAG_QUERY = """
+SELECT pg_last_wal_replay_lsn() >= $1::pg_lsn,
+    extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+WHERE pg_is_in_recovery()"""
+
+
+class ReplicaSettings(BaseSettings):
+    # Comma separated host or host:port of streaming replicas of the primary,
+    # reached with the primary's credentials. Reads stay on the primary unless
+    # this is set.
+    hosts: str = ""
+    # Replicas further behind than this many seconds are not read from.
+    max_lag: float = 5
+    check_interval: float = 1
+
+    class Config:
+        env_prefix = "postgres_replica_"
+
+
+class ReplicaSet:
+    """Pools of read-only replicas, used while their lag is within `max_lag`.
+
+    Every replica is checked against the primary every `check_interval`
+    seconds. A replica that has replayed all of the primary's WAL has no lag,
+    otherwise its lag is the age of the last transaction it replayed. A
+    replica that is unreachable, too far behind, or not in recovery is skipped
+    until a later check finds it healthy again, so reads can always fall back
+    to the primary.
+    """
+
+    def __init__(
+        self,
+        pools: list[asyncpg.Pool],
+        *,
+        primary: asyncpg.Pool,
+        max_lag: float,
+        check_interval: float,
+    ) -> None:
+        self.pools = pools
+        self.primary = primary
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lags: list[Optional[float]] = [None] * len(pools)
+        """Lag of each replica at the last check, None if unusable."""
+        self.synced: list[Optional[float]] = [None] * len(pools)
+        """`time.monotonic()` before the last check that found each replica
+        had replayed all of the primary's WAL, ie. it has every transaction
+        committed before then."""
+        self._next = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    async def create(
+        cls,
+        settings: ReplicaSettings,
+        *,
+        primary: asyncpg.Pool,
+        default_port: str,
+        connect: Callable[..., Awaitable[asyncpg.Pool]],
+    ) -> Optional["ReplicaSet"]:
+        """Create the pools of the configured replicas, if there are any."""
+        hosts = [host.strip() for host in settings.hosts.split(",") if host.strip()]
+        if not hosts:
+            return None
+        pools = []
+        for host in hosts:
+            host, _, port = host.partition(":")
+            # connects lazily, so a replica that is down doesn't stop startup
+            pools.append(await connect(host=host, port=port or default_port))
+        replicas = cls(
+            pools,
+            primary=primary,
+            max_lag=settings.max_lag,
+            check_interval=settings.check_interval,
+        )
+        await replicas.check()
+        return replicas
+
+    def pick(self, since: Optional[float] = None) -> Optional[asyncpg.Pool]:
+        """A healthy replica, in turn, or None if none is.
+
+        Args:
+            since: Only pick replicas that have every transaction committed
+                before this `time.monotonic()`.
+        """
+        healthy = [
+            pool
+            for pool, lag, synced in zip(self.pools, self.lags, self.synced)
+            if self._usable(lag)
+            and (since is None or (synced is not None and synced > since))
+        ]
+        if not healthy:
+            return None
+        return healthy[next(self._next) % len(healthy)]
+
+    def _usable(self, lag: Optional[float]) -> bool:
+        return lag is not None and lag <= self.max_lag
+
+    async def check(self) -> None:
+        checked_at = time.monotonic()
+        lsn = await self._fetch(self.primary, _PRIMARY_LSN_QUERY)
+        for i, pool in enumerate(self.pools):
+            lag = None
+            if lsn is not None and (row := await self._fetch(pool, _LAG_QUERY, lsn)):
+                replayed, age = row
+                if replayed:
+                    lag, self.synced[i] = 0.0, checked_at
+                elif age is not None:
+                    lag = float(age)
+            if self._usable(lag) != self._usable(self.lags[i]):
+                logger.info("Replica health changed", replica=i, lag=lag)
+            self.lags[i] = lag
+
+    async def _fetch(self, pool: asyncpg.Pool, query: str, *args) -> Any:
+        """The first row of a query, or its only value. None if it fails."""
+        try:
+            async with pool.acquire(timeout=self.check_interval) as conn:
+                row = await conn.fetchrow(query, *args, timeout=self.check_interval)
+        except (
+            OSError,
+            asyncio.TimeoutError,
+            asyncpg.PostgresError,
+            asyncpg.InterfaceError,
+        ) as e:
+            logger.debug("Replica check failed", error=str(e))
+            return None
+        return row[0] if row is not None and len(row) == 1 else row
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for pool in self.pools:
+            await pool.close()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.check()
+            except Exception:
+                logger.exception("Replica check failed")
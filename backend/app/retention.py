@@ -0,0 +1,93 @@
+import asyncio
+from datetime import timedelta
+from typing import Optional
+
+import structlog
+from pydantic import BaseSettings
+
+from app.checkpoint import PostgresCheckpoint
+from app.lifespan import get_pg_pool, get_pg_session_pool
+
+logger = structlog.get_logger(__name__)
+
+# Only one process prunes at a time.
+_LOCK_KEY = "opengpts:checkpoint_retention"
+
+
+class RetentionSettings(BaseSettings):
+    # Retention is disabled unless this is set.
+    keep_last: Optional[int] = None
+    min_age: timedelta = timedelta(days=1)
+    interval: float = 3600
+    batch_size: int = 500
+    threads_per_page: int = 100
+    # Pause between threads, so the worker doesn't compete with live traffic.
+    pause: float = 0.05
+
+    class Config:
+        env_prefix = "checkpoint_retention_"
+
+
+async def prune_checkpoints(
+    checkpointer: PostgresCheckpoint, settings: RetentionSettings
+) -> int:
+    """Apply the retention policy to every thread. Returns the rows deleted."""
+    deleted = 0
+    cursor = ""
+    while True:
+        async with get_pg_pool().acquire() as conn:
+            thread_ids = await conn.fetch(
+                "SELECT thread_id FROM checkpoints WHERE thread_id > $1 "
+                "GROUP BY thread_id HAVING count(*) > $2 "
+                "ORDER BY thread_id LIMIT $3",
+                cursor,
+                settings.keep_last,
+                settings.threads_per_page,
+            )
+        for row in thread_ids:
+            deleted += await checkpointer.aprune(
+                row["thread_id"],
+                keep_last=settings.keep_last,
+                min_age=settings.min_age,
+                batch_size=settings.batch_size,
+            )
+            await asyncio.sleep(settings.pause)
+        if len(thread_ids) < settings.threads_per_page:
+            return deleted
+        cursor = thread_ids[-1]["thread_id"]
+
+
+async def _run(checkpointer: PostgresCheckpoint, settings: RetentionSettings) -> None:
+    while True:
+        try:
+            async with get_pg_session_pool().acquire() as conn:
+                locked = await conn.fetchval(
+                    "SELECT pg_try_advisory_lock(hashtext($1))", _LOCK_KEY
+                )
+                if locked:
+                    try:
+                        deleted = await prune_checkpoints(checkpointer, settings)
+                        logger.info("Pruned checkpoints", deleted=deleted)
+                        deleted = await checkpointer.acollect_blobs(
+                            min_age=settings.min_age
+                        )
+                        logger.info("Deleted unreferenced blobs", deleted=deleted)
+                    finally:
+                        await conn.execute(
+                            "SELECT pg_advisory_unlock(hashtext($1))", _LOCK_KEY
+                        )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Checkpoint retention failed")
+        await asyncio.sleep(settings.interval)
+
+
+def start_retention(
+    checkpointer: PostgresCheckpoint, settings: Optional[RetentionSettings] = None
+) -> Optional[asyncio.Task]:
+    """Start pruning checkpoints in the background, if retention is enabled."""
+    settings = settings or RetentionSettings()
+    if settings.keep_last is None:
+        return None
+    return asyncio.create_task(_run(checkpointer, settings))
@@ -0,0 +1,573 @@
+"""A durable queue of the runs created with POST /runs.
+
+Runs are rows of the `run` table. Every process runs up to `concurrency`
+workers, which claim the oldest pending run with FOR UPDATE SKIP LOCKED, so
+each run is executed by one worker even with many processes. A NOTIFY on the
+`runs` channel wakes the workers when a run is queued; they also poll every
+`poll_interval` seconds in case a notification is missed.
+
+Workers send heartbeats for the runs they execute. A running run without a
+heartbeat for `stale_after` seconds, eg. because its process was killed, is
+claimed again, up to `max_attempts` times. Runs interrupted by a shutdown
+go back to pending right away.
+
+Runs streamed with POST /runs/stream are recorded too, but executed by the
+request that streams them, and never claimed by a worker. Both kinds can be
+cancelled with `cancel`, which tells the process executing the run with a
+NOTIFY, and with its next heartbeat in case the notification is missed.
+
+One run of a thread executes at a time, in any process, so concurrent runs
+don't fork the thread's history. Runs lock their thread with `ThreadLocks`,
+and workers don't claim runs of threads with a run in progress. A unique
+index keeps a second run of a thread from being recorded as in progress.
+What a new run does while its thread is busy is up to `thread_policy`: queue
+(wait for the thread), reject (raise ThreadBusy) or interrupt (cancel the
+other runs).
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Literal, Optional
+
+import asyncpg
+import structlog
+from langchain_core.runnables import RunnableConfig
+from pydantic import BaseSettings
+
+from app.agent import CHECKPOINTER, agent
+from app.lifespan import get_pg_pool
+from app.listener import Listener
+from app.queries import register
+from app.schema import Run
+from app.serde import CheckpointSerializer, loads_untrusted
+from app.stream import MessagesStream
+from app.thread_locks import ThreadLocks
+
+logger = structlog.get_logger(__name__)
+
+_NOTIFY_CHANNEL = "runs"
+_CANCEL_PREFIX = "cancel:"
+# Runs of a thread are queued one at a time, so each sees the runs of the
+# thread queued before it. In a key space apart from `ThreadLocks`, which
+# locks the thread while a run executes.
+_ENQUEUE_LOCK_PREFIX = "opengpts:enqueue:"
+
+RUN_FIELDS = (
+    "run_id, thread_id, user_id, status, error, attempts, "
+    "created_at, started_at, finished_at"
+)
+
+_CLAIM = register(
+    "claim_run",
+    """
+UPDATE run SET status = 'running', attempts = attempts + 1,
+    started_at = now(), heartbeat_at = now()
+WHERE run_id = (
+    SELECT run_id FROM run
+    WHERE (status = 'pending'
+        OR (status = 'running' AND NOT streamed
+            AND heartbeat_at < now() - make_interval(secs => $1)
+            AND attempts < $2))
+        AND NOT EXISTS (
+            SELECT 1 FROM run busy
+            WHERE busy.thread_id = run.thread_id
+                AND busy.run_id <> run.run_id
+                AND busy.status IN ('running', 'cancelling'))
+    ORDER BY created_at
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING run_id, thread_id, input, config""",
+)
+
+# Queues a run, unless `max_pending` ($5) runs are pending or, if $6, the
+# thread has runs in progress.
+_ENQUEUE = f"""
+INSERT INTO run (thread_id, user_id, input, config)
+SELECT $1::uuid, $2::uuid, $3::bytea, $4::jsonb
+WHERE (SELECT count(*) FROM run WHERE status = 'pending') < $5
+    AND NOT ($6 AND EXISTS (
+        SELECT 1 FROM run WHERE thread_id = $1
+            AND status IN ('pending', 'running', 'cancelling')))
+RETURNING {RUN_FIELDS}"""
+
+_HEARTBEAT = """
+UPDATE run SET heartbeat_at = now() WHERE run_id = ANY($1::uuid[])
+RETURNING run_id, status"""
+
+# Runs whose process is gone. Streamed runs can't be resumed, their client
+# is gone too.
+_ABANDON = """
+UPDATE run SET
+    status = CASE WHEN status = 'cancelling' THEN 'cancelled' ELSE 'error' END,
+    error = CASE WHEN status = 'cancelling' THEN NULL ELSE 'Abandoned' END,
+    finished_at = now()
+WHERE status IN ('running', 'cancelling')
+    AND heartbeat_at < now() - make_interval(secs => $1)
+    AND (status = 'cancelling' OR streamed OR attempts >= $2)"""
+
+_FINISH = """
+UPDATE run SET status = $2, error = $3, finished_at = now()
+WHERE run_id = $1 AND status IN ('running', 'cancelling')"""
+
+_REQUEUE = """
+UPDATE run SET status = 'pending', started_at = NULL, attempts = attempts - $2
+WHERE run_id = $1 AND status = 'running'"""
+
+_INTERRUPT = """
+UPDATE run SET
+    status = CASE WHEN status = 'pending' THEN 'cancelled' ELSE 'cancelling' END,
+    finished_at = CASE WHEN status = 'pending' THEN now() END
+WHERE thread_id = $1 AND status IN ('pending', 'running')
+RETURNING run_id, status"""
+
+_CANCEL = f"""
+UPDATE run SET
+    status = CASE WHEN status = 'pending' THEN 'cancelled' ELSE 'cancelling' END,
+    finished_at = CASE WHEN status = 'pending' THEN now() END
+WHERE run_id = $1 AND user_id = $2 AND status IN ('pending', 'running')
+RETURNING {RUN_FIELDS}"""
+
+
+class RunSettings(BaseSettings):
+    # Runs each process executes at once. A process with 0 only queues runs.
+    concurrency: int = 4
+    # New runs are refused while this many are waiting to start.
+    max_pending: int = 1000
+    poll_interval: float = 5
+    heartbeat_interval: float = 10
+    stale_after: float = 60
+    max_attempts: int = 3
+    # What a new run does while another run of its thread is in progress.
+    thread_policy: Literal["queue", "reject", "interrupt"] = "queue"
+    # Seconds a streamed run waits for its thread before it is rejected.
+    thread_wait_timeout: float = 300
+
+    class Config:
+        env_prefix = "run_queue_"
+
+
+class RunQueueFull(Exception):
+    """Raised by `RunQueue.enqueue` when too many runs are pending."""
+
+
+class ThreadBusy(Exception):
+    """Raised when a run can't start while its thread is busy."""
+
+
+async def _cancel(task: asyncio.Task) -> None:
+    """Cancel a task and wait for it to finish.
+
+    Cancelling once isn't always enough: astream_events waits for the run it
+    streams when it is cancelled, and that wait has to be cancelled too.
+    """
+    while not task.done():
+        task.cancel()
+        await asyncio.wait([task], timeout=0.1)
+
+
+def _outcome(
+    task: asyncio.Task, *, disconnected: bool = False
+) -> tuple[str, Optional[str]]:
+    """The status and error to record of a finished run task."""
+    if task.cancelled():
+        return "cancelled", "Client disconnected" if disconnected else None
+    if (e := task.exception()) is not None:
+        logger.error("Run failed", exc_info=e)
+        # only the kind of error, the message may contain sensitive information
+        return "error", type(e).__name__
+    return "success", None
+
+
+class RunQueue:
+    """Queues runs in postgres and executes them with `execute`.
+
+    `flush` is called with the thread ID once a run has stopped, before its
+    thread is unlocked, eg. to write the checkpoints it queued in write-behind
+    mode. It runs outside of the run's task, so cancelling the run can't
+    interrupt it.
+    """
+
+    def __init__(
+        self,
+        execute: Callable[[Any, RunnableConfig], Awaitable[None]],
+        *,
+        flush: Optional[Callable[[str], Awaitable[None]]] = None,
+    ) -> None:
+        self.execute = execute
+        self.flush = flush
+        self.settings = RunSettings()
+        self._serde = CheckpointSerializer()
+        self._wakeup = asyncio.Event()
+        self._listener = Listener(
+            _NOTIFY_CHANNEL,
+            self._on_notify,
+            on_connect=self._wakeup.set,
+            on_lost=self._on_listener_lost,
+        )
+        self._tasks: list[asyncio.Task] = []
+        self._active: dict[str, asyncio.Task] = {}
+        """The task executing each run of this process, by run ID."""
+        self._background: set[asyncio.Task] = set()
+        self.locks = ThreadLocks(on_lost=self._on_locks_lost)
+        self._locked: dict[str, str] = {}
+        """The thread locked by each run of this process."""
+
+    async def enqueue(
+        self, user_id: str, thread_id: str, input_: Any, config: RunnableConfig
+    ) -> Run:
+        """Queue a run.
+
+        Only runs of the same thread are queued one at a time, so runs of
+        other threads queued at the same moment may take the number of pending
+        runs past `max_pending` by as many.
+
+        Raises:
+            RunQueueFull: If `max_pending` runs are waiting to start.
+            ThreadBusy: If the thread has runs in progress and the policy is
+                to reject.
+        """
+        if self.settings.thread_policy == "interrupt":
+            await self._interrupt(thread_id)
+        reject = self.settings.thread_policy == "reject"
+        async with get_pg_pool().acquire() as conn, conn.transaction():
+            await conn.execute(
+                "SELECT pg_advisory_xact_lock(hashtext($1 || $2::text))",
+                _ENQUEUE_LOCK_PREFIX,
+                thread_id,
+            )
+            run = await conn.fetchrow(
+                _ENQUEUE,
+                thread_id,
+                user_id,
+                self._serde.dumps(input_),
+                config,
+                self.settings.max_pending,
+                reject,
+            )
+            if run is None:
+                if reject and await conn.fetchval(
+                    "SELECT EXISTS (SELECT 1 FROM run WHERE thread_id = $1 "
+                    "AND status IN ('pending', 'running', 'cancelling'))",
+                    thread_id,
+                ):
+                    raise ThreadBusy()
+                raise RunQueueFull()
+            await conn.execute("SELECT pg_notify($1, '')", _NOTIFY_CHANNEL)
+        return run
+
+    async def begin_stream(
+        self, user_id: str, thread_id: str, input_: Any, config: RunnableConfig
+    ) -> Run:
+        """Lock the thread of a run and record the run.
+
+        The caller executes and relays the run with `stream`, and calls
+        `end_stream` once its response is done.
+
+        Raises:
+            ThreadBusy: If another run of the thread is in progress and the
+                policy is to reject, or it doesn't end within
+                `thread_wait_timeout` seconds. Also if a run of the thread is
+                recorded as in progress without holding its lock, eg. one a
+                worker has just claimed, or one of a process that died and
+                isn't abandoned yet.
+        """
+        if not await self.locks.try_acquire(thread_id):
+            if self.settings.thread_policy == "reject":
+                raise ThreadBusy()
+            if self.settings.thread_policy == "interrupt":
+                await self._interrupt(thread_id)
+            if not await self.locks.acquire(
+                thread_id, timeout=self.settings.thread_wait_timeout
+            ):
+                raise ThreadBusy()
+        try:
+            async with get_pg_pool().acquire() as conn:
+                run = await conn.fetchrow(
+                    "INSERT INTO run (thread_id, user_id, input, config, status, "
+                    "streamed, attempts, started_at, heartbeat_at) "
+                    "VALUES ($1, $2, $3, $4, 'running', true, 1, now(), now()) "
+                    f"RETURNING {RUN_FIELDS}",
+                    thread_id,
+                    user_id,
+                    self._serde.dumps(input_),
+                    config,
+                )
+        except asyncpg.UniqueViolationError:
+            await self.locks.release(thread_id)
+            raise ThreadBusy()
+        except BaseException:
+            await self.locks.release(thread_id)
+            raise
+        self._locked[run["run_id"]] = thread_id
+        return run
+
+    async def stream(self, run_id: str, messages: MessagesStream) -> MessagesStream:
+        """Relay the messages of a run started with `begin_stream`.
+
+        The run executes in a task of its own, which is cancelled if the
+        client goes away, ie. if this generator is closed before the end.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        end = object()
+
+        async def produce() -> None:
+            try:
+                async for chunk in messages:
+                    queue.put_nowait(chunk)
+            finally:
+                queue.put_nowait(end)
+
+        task = asyncio.create_task(produce())
+        self._active[run_id] = task
+        finished = False
+        try:
+            while (chunk := await queue.get()) is not end:
+                yield chunk
+            finished = True
+        finally:
+            # the client may be gone, and this generator cancelled, so the
+            # run is stopped and recorded in a task of its own
+            finish = self._in_background(
+                self._finish_stream(run_id, task, not finished)
+            )
+        # the run is recorded, and what it wrote flushed, before the stream ends
+        await asyncio.wait([finish])
+        if not task.cancelled() and (e := task.exception()) is not None:
+            raise e
+
+    async def end_stream(self, run_id: str) -> None:
+        """Record a streamed run whose stream never started, eg. because the
+        client went away first, and unlock its thread."""
+        if run_id in self._active or run_id not in self._locked:
+            # `stream` takes care of it
+            return
+        await self._finish(run_id, "cancelled", "Client disconnected")
+        await self._unlock(run_id)
+
+    async def cancel(self, user_id: str, run_id: str) -> Optional[Run]:
+        """Cancel a run of the user. Returns None if there is no such run.
+
+        Pending runs are cancelled right away. Running runs are cancelling
+        until the process that executes them has stopped them.
+        """
+        async with get_pg_pool().acquire() as conn:
+            run = await conn.fetchrow(_CANCEL, run_id, user_id)
+            if run is None:
+                # not found or already finished
+                return await self.get(user_id, run_id)
+            if run["status"] == "cancelling":
+                await conn.execute(
+                    "SELECT pg_notify($1, $2)",
+                    _NOTIFY_CHANNEL,
+                    f"{_CANCEL_PREFIX}{run_id}",
+                )
+        return run
+
+    async def _interrupt(self, thread_id: str) -> None:
+        """Cancel the runs of a thread."""
+        async with get_pg_pool().acquire() as conn:
+            runs = await conn.fetch(_INTERRUPT, thread_id)
+            for run in runs:
+                if run["status"] == "cancelling":
+                    await conn.execute(
+                        "SELECT pg_notify($1, $2)",
+                        _NOTIFY_CHANNEL,
+                        f"{_CANCEL_PREFIX}{run['run_id']}",
+                    )
+
+    async def get(self, user_id: str, run_id: str) -> Optional[Run]:
+        async with get_pg_pool().acquire() as conn:
+            return await conn.fetchrow(
+                f"SELECT {RUN_FIELDS} FROM run WHERE run_id = $1 AND user_id = $2",
+                run_id,
+                user_id,
+            )
+
+    async def start(self, settings: Optional[RunSettings] = None) -> None:
+        """Start listening for runs, and the workers of this process."""
+        self.settings = settings or RunSettings()
+        if self._tasks:
+            return
+        await self._listener.start()
+        self._tasks = [
+            asyncio.create_task(self._work())
+            for _ in range(max(self.settings.concurrency, 0))
+        ]
+        self._tasks.append(asyncio.create_task(self._heartbeat()))
+
+    async def stop(self) -> None:
+        """Stop the workers, putting the runs they execute back in the queue.
+
+        Streamed runs are cancelled.
+        """
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for run_id in list(self._active):
+            self._cancel_run(run_id)
+        # cancelling a streamed run starts the task that records it
+        while self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+        await self.locks.close()
+        await self._listener.stop()
+
+    def _in_background(self, coro: Awaitable[None]) -> asyncio.Task:
+        # keeps a reference, asyncio only keeps weak ones
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    def _cancel_run(self, run_id: str) -> None:
+        if (task := self._active.get(run_id)) is not None:
+            self._in_background(_cancel(task))
+
+    def _on_locks_lost(self, thread_ids: set[str]) -> None:
+        # another process may lock these threads now, so their runs are stopped
+        for run_id, thread_id in list(self._locked.items()):
+            if thread_id in thread_ids:
+                logger.warn(
+                    "Cancelling a run whose thread lock was lost", run_id=run_id
+                )
+                self._cancel_run(run_id)
+
+    def _on_notify(self, conn, pid: int, channel: str, payload: str) -> None:
+        if payload.startswith(_CANCEL_PREFIX):
+            self._cancel_run(payload[len(_CANCEL_PREFIX) :])
+        else:
+            self._wakeup.set()
+
+    def _on_listener_lost(self) -> None:
+        logger.warn("Run queue listener connection lost, polling until it's back.")
+
+    async def _work(self) -> None:
+        while True:
+            # cleared before claiming, so a run queued meanwhile isn't missed
+            self._wakeup.clear()
+            try:
+                async with get_pg_pool().acquire() as conn:
+                    run = await conn.fetchrow(
+                        _CLAIM, self.settings.stale_after, self.settings.max_attempts
+                    )
+            except asyncio.CancelledError:
+                raise
+            except asyncpg.UniqueViolationError:
+                # another run of its thread was started meanwhile
+                continue
+            except Exception:
+                logger.exception("Claiming a run failed")
+                run = None
+            if run is None:
+                try:
+                    await asyncio.wait_for(
+                        self._wakeup.wait(), self.settings.poll_interval
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._execute(run)
+
+    async def _execute(self, run: asyncpg.Record) -> None:
+        run_id, thread_id = run["run_id"], run["thread_id"]
+        if not await self.locks.try_acquire(thread_id):
+            # a run of the thread that isn't recorded as running yet, eg. a
+            # stream that is starting
+            await self._requeue(run_id, retry=True)
+            await asyncio.sleep(self.settings.poll_interval)
+            return
+        self._locked[run_id] = thread_id
+
+        async def execute() -> None:
+            await self.execute(
+                loads_untrusted(run["input"], revive=True), run["config"]
+            )
+
+        task = asyncio.create_task(execute())
+        self._active[run_id] = task
+        try:
+            # unlike awaiting the task, doesn't cancel it when the worker is
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            await _cancel(task)
+            await self._stopped(thread_id, task)
+            self._active.pop(run_id, None)
+            await self._requeue(run_id, retry=False)
+            raise
+        else:
+            outcome = await self._stopped(thread_id, task)
+        finally:
+            await self._unlock(run_id)
+        self._active.pop(run_id, None)
+        await self._finish(run_id, *outcome)
+
+    async def _stopped(
+        self, thread_id: str, task: asyncio.Task, *, disconnected: bool = False
+    ) -> tuple[str, Optional[str]]:
+        """Flush what a run whose task is done wrote, and return its outcome."""
+        status, error = _outcome(task, disconnected=disconnected)
+        if self.flush is not None:
+            try:
+                await self.flush(thread_id)
+            except Exception as e:
+                logger.error("Flushing a run failed", exc_info=e)
+                status, error = "error", type(e).__name__
+        return status, error
+
+    async def _requeue(self, run_id: str, *, retry: bool) -> None:
+        """Put a run back in the queue. A retry doesn't count as an attempt."""
+        async with get_pg_pool().acquire() as conn:
+            await conn.execute(_REQUEUE, run_id, 1 if retry else 0)
+
+    async def _finish_stream(
+        self, run_id: str, task: asyncio.Task, disconnected: bool
+    ) -> None:
+        if disconnected:
+            await _cancel(task)
+        else:
+            await asyncio.wait([task])
+        outcome = await self._stopped(
+            self._locked[run_id], task, disconnected=disconnected
+        )
+        await self._finish(run_id, *outcome)
+        await self._unlock(run_id)
+        # last, so `end_stream` leaves the run alone until it is recorded
+        self._active.pop(run_id, None)
+
+    async def _unlock(self, run_id: str) -> None:
+        if (thread_id := self._locked.pop(run_id, None)) is not None:
+            await self.locks.release(thread_id)
+
+    async def _finish(self, run_id: str, status: str, error: Optional[str]) -> None:
+        try:
+            async with get_pg_pool().acquire() as conn:
+                await conn.execute(_FINISH, run_id, status, error)
+        except Exception:
+            # left running, until it is abandoned
+            logger.exception("Recording the end of a run failed", run_id=run_id)
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.settings.heartbeat_interval)
+            try:
+                async with get_pg_pool().acquire() as conn:
+                    if self._active:
+                        runs = await conn.fetch(_HEARTBEAT, list(self._active))
+                        for run in runs:
+                            if run["status"] == "cancelling":
+                                self._cancel_run(run["run_id"])
+                    await conn.execute(
+                        _ABANDON,
+                        self.settings.stale_after,
+                        self.settings.max_attempts,
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Run heartbeat failed")
+
+
+async def _invoke(input_: Any, config: RunnableConfig) -> None:
+    await agent.ainvoke(input_, config)
+
+
+RUN_QUEUE = RunQueue(_invoke, flush=CHECKPOINTER.aflush)
@@ -42,3 +42,43 @@ class Thread(TypedDict):
     updated_at: datetime
     """The last time the thread was updated."""
     metadata: Optional[dict]
+    last_message: Optional[str]
+    """The start of the last message with text, if any."""
+    message_count: int
+    """The number of messages in the thread."""
+    last_run_at: Optional[datetime]
+    """The time of the latest state of the thread."""
+
+
+class ThreadSearchHit(Thread):
+    """A thread that matches a search, with its best matching message."""
+
+    message_id: str
+    """The ID of the message that matches best."""
+    snippet: str
+    """The matching part of the message, with the matches in <b> tags."""
+    rank: float
+    """How well the message matches. Results are ordered by it."""
+
+
+class Run(TypedDict):
+    """A run queued with POST /runs, or streamed with POST /runs/stream."""
+
+    run_id: str
+    """The ID of the run."""
+    thread_id: str
+    """The thread the run continues."""
+    user_id: str
+    """The ID of the user that created the run."""
+    status: str
+    """One of pending, running, cancelling, cancelled, success or error."""
+    error: Optional[str]
+    """The kind of error the run failed with, or why it was cancelled."""
+    attempts: int
+    """The number of times a worker started the run."""
+    created_at: datetime
+    """The time the run was queued."""
+    started_at: Optional[datetime]
+    """The time a worker last started the run."""
+    finished_at: Optional[datetime]
+    """The time the run succeeded or failed."""
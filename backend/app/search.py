@@ -0,0 +1,63 @@
+"""Full-text search over the messages of threads.
+
+PostgresCheckpoint copies the text of human and AI messages into the
+`thread_search` table as checkpoints are written, where a generated tsvector
+column and its GIN index make them searchable.
+"""
+from typing import Any
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+from app.queries import register
+
+# Text search configuration of the index. 'simple' doesn't stem, so it works
+# the same for every language.
+SEARCH_CONFIG = "simple"
+
+# Characters of a message that are indexed.
+MAX_INDEXED_LENGTH = 100_000
+
+# New and changed messages of a thread. Messages of threads that have no
+# thread row are skipped.
+INDEX = register(
+    "search_index",
+    """
+INSERT INTO thread_search (thread_id, message_id, content, created_at)
+SELECT $1::uuid, m.id, m.content, $4::timestamptz
+FROM unnest($2::text[], $3::text[]) AS m(id, content)
+WHERE EXISTS (SELECT 1 FROM thread WHERE thread_id = $1::uuid)
+ON CONFLICT (thread_id, message_id) DO UPDATE SET content = EXCLUDED.content
+WHERE thread_search.content <> EXCLUDED.content""",
+)
+
+
+def thread_messages(values: dict[str, Any]) -> list:
+    """The messages in the channel values of a checkpoint."""
+    # message graphs keep their messages in __root__, state graphs in messages
+    messages = values.get("__root__", values.get("messages"))
+    return messages if isinstance(messages, list) else []
+
+
+def message_text(message: BaseMessage) -> str:
+    if isinstance(message.content, str):
+        text = message.content
+    else:
+        text = " ".join(
+            part if isinstance(part, str) else part.get("text", "")
+            for part in message.content
+            if isinstance(part, (str, dict))
+        )
+    # postgres text can't hold NUL characters
+    return text.replace("\x00", "")
+
+
+def searchable_messages(values: dict[str, Any]) -> dict[str, str]:
+    """The text to index of each human and AI message, by message ID."""
+    texts = {}
+    for i, message in enumerate(thread_messages(values)):
+        if not isinstance(message, (HumanMessage, AIMessage)):
+            continue
+        if text := message_text(message)[:MAX_INDEXED_LENGTH]:
+            # messages from before IDs were assigned are identified by position
+            texts[message.id or f"#{i}"] = text
+    return texts
@@ -0,0 +1,329 @@
+import io
+import pickle
+import zlib
+from base64 import b64decode, b64encode
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from typing import Any, Callable, Collection, Optional
+from uuid import UUID
+
+import orjson
+from langchain_core.documents import Document
+from langchain_core.messages import (
+    AIMessage,
+    AIMessageChunk,
+    BaseMessage,
+    ChatMessage,
+    ChatMessageChunk,
+    FunctionMessage,
+    FunctionMessageChunk,
+    HumanMessage,
+    HumanMessageChunk,
+    SystemMessage,
+    SystemMessageChunk,
+    ToolMessage,
+    ToolMessageChunk,
+)
+from langgraph.checkpoint.base import SerializerProtocol
+from pydantic import BaseModel
+
+from app.message_types import LiberalFunctionMessage, LiberalToolMessage
+
+# Blobs written by `CheckpointSerializer` start with this header, followed by
+# a format version byte and a codec byte. 0xff is not a valid first byte of a
+# pickle, so blobs without the header are read as legacy pickles.
+MAGIC = b"\xffOGS"
+FORMAT_VERSION = 2
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+
+
+class BlobRef(BaseModel):
+    """Stands in for message content stored once in the checkpoint_blobs table."""
+
+    hash: str
+
+
+_TAG = "__t"
+_VALUE = "__v"
+
+_CLASSES: dict[str, type] = {
+    cls.__name__: cls
+    for cls in (
+        AIMessage,
+        AIMessageChunk,
+        ChatMessage,
+        ChatMessageChunk,
+        FunctionMessage,
+        FunctionMessageChunk,
+        HumanMessage,
+        HumanMessageChunk,
+        SystemMessage,
+        SystemMessageChunk,
+        ToolMessage,
+        ToolMessageChunk,
+        LiberalFunctionMessage,
+        LiberalToolMessage,
+        Document,
+        BlobRef,
+    )
+}
+
+# Values JSON has no type for, by tag, with how to write and read them. Dicts
+# are tagged when they have keys other than strings, or a key that would be
+# mistaken for a tag.
+_VALUES: dict[str, tuple[Callable[[Any], Any], Callable[[Any], Any]]] = {
+    "tuple": (lambda v: [_encode(i) for i in v], lambda v: tuple(_decode(v))),
+    "set": (lambda v: [_encode(i) for i in v], lambda v: set(_decode(v))),
+    "frozenset": (lambda v: [_encode(i) for i in v], lambda v: frozenset(_decode(v))),
+    "dict": (
+        lambda v: [[_encode(k), _encode(i)] for k, i in v.items()],
+        lambda v: {_decode(k): _decode(i) for k, i in v},
+    ),
+    "datetime": (datetime.isoformat, datetime.fromisoformat),
+    "date": (date.isoformat, date.fromisoformat),
+    "time": (time.isoformat, time.fromisoformat),
+    "timedelta": (timedelta.total_seconds, lambda v: timedelta(seconds=v)),
+    "uuid": (str, UUID),
+    "bytes": (lambda v: b64encode(v).decode(), b64decode),
+}
+_VALUE_TAGS: dict[type, str] = {
+    tuple: "tuple",
+    set: "set",
+    frozenset: "frozenset",
+    datetime: "datetime",
+    date: "date",
+    time: "time",
+    timedelta: "timedelta",
+    UUID: "uuid",
+    bytes: "bytes",
+}
+_JSON_TYPES = (str, int, float, bool, type(None))
+
+# Format 1 embedded a pickle for values without a tag. Those are only loaded
+# with `_SafeUnpickler`, as checkpoints of that format can't tell them apart
+# from dicts written by users.
+_PICKLE_TAG = "pickle"
+_PICKLE_CLASSES = {
+    ("builtins", "set"),
+    ("builtins", "frozenset"),
+    ("datetime", "datetime"),
+    ("datetime", "date"),
+    ("datetime", "time"),
+    ("datetime", "timedelta"),
+    ("datetime", "timezone"),
+    ("uuid", "UUID"),
+    ("zoneinfo", "ZoneInfo"),
+}
+
+
+def _seen_dict() -> defaultdict:
+    return defaultdict(int)
+
+
+def _rebuild_messages(value: Any) -> Any:
+    if isinstance(value, list) and all(isinstance(v, BaseMessage) for v in value):
+        return [v.__class__(**v.__dict__) for v in value]
+    return value
+
+
+class PickleSerializer(SerializerProtocol):
+    """The original checkpoint format: a raw pickle.
+
+    Messages are re-created on load so that pickles written by older versions
+    of langchain get the fields and defaults of the installed version.
+    """
+
+    def dumps(self, obj: Any) -> bytes:
+        return pickle.dumps(obj)
+
+    def loads_raw(self, data: bytes) -> Any:
+        return pickle.loads(data)
+
+    def loads(self, data: bytes) -> Any:
+        loaded = self.loads_raw(data)
+        for field in ("channel_values", "changed"):
+            for key, value in loaded.get(field, {}).items():
+                loaded[field][key] = _rebuild_messages(value)
+        for key, (prefix, tail) in loaded.get("extended", {}).items():
+            loaded["extended"][key] = (prefix, _rebuild_messages(tail))
+        return loaded
+
+
+class _SafeUnpickler(pickle.Unpickler):
+    def find_class(self, module: str, name: str) -> Any:
+        if (module, name) not in _PICKLE_CLASSES:
+            raise ValueError(f"Checkpoint contains a pickled {module}.{name}.")
+        return super().find_class(module, name)
+
+
+def _encode(value: Any) -> Any:
+    """Convert a value to JSON types, tagging the values JSON has no type for.
+
+    Raises:
+        TypeError: If the value contains an object of another type.
+    """
+    if isinstance(value, _JSON_TYPES):
+        return value
+    cls = type(value)
+    if cls is list:
+        return [_encode(v) for v in value]
+    if cls is dict or cls is defaultdict:
+        if _TAG in value or any(not isinstance(k, str) for k in value):
+            return {_TAG: "dict", _VALUE: _VALUES["dict"][0](value)}
+        return {k: _encode(v) for k, v in value.items()}
+    if (tag := _VALUE_TAGS.get(cls)) is not None:
+        return {_TAG: tag, _VALUE: _VALUES[tag][0](value)}
+    if _CLASSES.get(cls.__name__) is cls:
+        return {
+            _TAG: cls.__name__,
+            _VALUE: {k: _encode(v) for k, v in value.__dict__.items()},
+        }
+    raise TypeError(f"Can't store a {cls.__name__} in a checkpoint.")
+
+
+def _decode(value: Any) -> Any:
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if isinstance(value, dict):
+        tag = value.get(_TAG)
+        if tag is None:
+            return {k: _decode(v) for k, v in value.items()}
+        if (codec := _VALUES.get(tag)) is not None:
+            return codec[1](value[_VALUE])
+        if (cls := _CLASSES.get(tag)) is not None:
+            return cls.construct(**{k: _decode(v) for k, v in value[_VALUE].items()})
+        raise ValueError(f"Checkpoint contains a {tag} object.")
+    return value
+
+
+def _decode_v1(value: Any) -> Any:
+    """`_decode` for format 1, where only classes and pickles are tagged."""
+    if isinstance(value, list):
+        return [_decode_v1(v) for v in value]
+    if isinstance(value, dict):
+        tag = value.get(_TAG)
+        if tag is None:
+            return {k: _decode_v1(v) for k, v in value.items()}
+        if tag == _PICKLE_TAG:
+            return _SafeUnpickler(io.BytesIO(b64decode(value[_VALUE]))).load()
+        if (cls := _CLASSES.get(tag)) is not None:
+            return cls.construct(**{k: _decode_v1(v) for k, v in value[_VALUE].items()})
+        raise ValueError(f"Checkpoint contains a {tag} object.")
+    return value
+
+
+def _check_tags(value: Any, tags: Collection[str]) -> None:
+    if isinstance(value, list):
+        for v in value:
+            _check_tags(v, tags)
+    elif isinstance(value, dict):
+        tag = value.get(_TAG)
+        if tag is not None and tag not in tags:
+            raise ValueError(f"Checkpoint contains a {tag} object.")
+        for v in value.values():
+            _check_tags(v, tags)
+
+
+def _payload(data: bytes, *, max_size: Optional[int] = None) -> tuple[int, bytes]:
+    """The format version and decompressed payload of a blob."""
+    if not data.startswith(MAGIC) or len(data) < len(MAGIC) + 2:
+        raise ValueError("Checkpoint is not in the current format.")
+    version, codec = data[len(MAGIC)], data[len(MAGIC) + 1]
+    if version not in (1, FORMAT_VERSION):
+        raise ValueError(f"Unknown checkpoint format version {version}.")
+    payload = data[len(MAGIC) + 2 :]
+    if codec == CODEC_ZLIB:
+        if max_size is None:
+            return version, zlib.decompress(payload)
+        decompressor = zlib.decompressobj()
+        try:
+            payload = decompressor.decompress(payload, max_size)
+        except zlib.error as e:
+            raise ValueError("Checkpoint is not valid zlib.") from e
+        if decompressor.unconsumed_tail:
+            raise ValueError("Checkpoint is too large.")
+    elif codec != CODEC_NONE:
+        raise ValueError(f"Unknown checkpoint codec {codec}.")
+    if max_size is not None and len(payload) > max_size:
+        raise ValueError("Checkpoint is too large.")
+    return version, payload
+
+
+def loads_untrusted(
+    data: bytes, *, max_size: int = 64 * 1024 * 1024, revive: bool = False
+) -> Any:
+    """Check a blob from an untrusted source, eg. an import, and load it raw.
+
+    Only blobs written by `CheckpointSerializer` that contain nothing but
+    tagged values are accepted: legacy and embedded pickles would run
+    arbitrary code when loaded. Raises ValueError otherwise, or if the
+    payload is larger than `max_size` bytes once decompressed. With `revive`
+    the tagged values are constructed, as by `CheckpointSerializer.loads`.
+    """
+    version, payload = _payload(data, max_size=max_size)
+    try:
+        loaded = orjson.loads(payload)
+    except orjson.JSONDecodeError as e:
+        raise ValueError("Checkpoint is not valid JSON.") from e
+    _check_tags(loaded, _CLASSES.keys() | (_VALUES.keys() if version > 1 else set()))
+    if not revive:
+        return loaded
+    return _decode(loaded) if version > 1 else _decode_v1(loaded)
+
+
+class CheckpointSerializer(SerializerProtocol):
+    """Serializes checkpoints as orjson with a type tag per message class.
+
+    Tuples, sets, dates, UUIDs, bytes and dicts with keys other than strings
+    are tagged too, so they load as they were dumped. Other types can't be
+    stored, so loading a checkpoint never runs code it names. Payloads over
+    `compress_threshold` bytes are compressed with zlib. Blobs written by
+    `PickleSerializer` are still readable.
+    """
+
+    def __init__(self, *, compress_threshold: int = 1024, level: int = 1) -> None:
+        self.compress_threshold = compress_threshold
+        self.level = level
+        self._legacy = PickleSerializer()
+
+    def dumps(self, obj: Any) -> bytes:
+        payload = orjson.dumps(_encode(obj))
+        if len(payload) > self.compress_threshold:
+            return (
+                MAGIC
+                + bytes((FORMAT_VERSION, CODEC_ZLIB))
+                + zlib.compress(payload, self.level)
+            )
+        return MAGIC + bytes((FORMAT_VERSION, CODEC_NONE)) + payload
+
+    def loads(self, data: bytes) -> Any:
+        if not data.startswith(MAGIC):
+            return self._legacy.loads(data)
+        return self._load(data, revive=True)
+
+    def loads_raw(self, data: bytes) -> Any:
+        """Like `loads`, but leaves tagged objects (eg. messages) as dicts.
+
+        Enough to inspect channel versions without paying for the
+        construction of every message.
+        """
+        if not data.startswith(MAGIC):
+            return self._legacy.loads_raw(data)
+        return self._load(data, revive=False)
+
+    def _load(self, data: bytes, *, revive: bool) -> Any:
+        version, payload = _payload(data)
+        loaded = orjson.loads(payload)
+        if revive:
+            loaded = _decode(loaded) if version > 1 else _decode_v1(loaded)
+        # JSON has no defaultdicts, but langgraph relies on them when it
+        # computes the next tasks from a checkpoint.
+        if "channel_versions" in loaded:
+            loaded["channel_versions"] = defaultdict(int, loaded["channel_versions"])
+        if "versions_seen" in loaded:
+            loaded["versions_seen"] = defaultdict(
+                _seen_dict,
+                {k: defaultdict(int, v) for k, v in loaded["versions_seen"].items()},
+            )
+        return loaded
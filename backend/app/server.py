@@ -1,9 +1,11 @@
+import hmac
 import os
 from pathlib import Path
+from typing import Optional
 
 import orjson
 import structlog
-from fastapi import FastAPI, Form, UploadFile
+from fastapi import FastAPI, Form, Header, Query, UploadFile
 from fastapi.exceptions import HTTPException
 from fastapi.staticfiles import StaticFiles
 
@@ -11,6 +13,7 @@ import app.storage as storage
 from app.api import router as api_router
 from app.auth.handlers import AuthedUser
 from app.lifespan import lifespan
+from app.metrics import CHECKPOINT_METRICS
 from app.upload import convert_ingestion_input_to_blob, ingest_runnable
 
 logger = structlog.get_logger(__name__)
@@ -53,6 +56,25 @@ async def health() -> dict:
     return {"status": "ok"}
 
 
+@app.get("/metrics")
+async def metrics(
+    top: int = Query(20, ge=0, le=1000),
+    authorization: Optional[str] = Header(None),
+) -> dict:
+    """Checkpoint sizes and timings of this process, and its heaviest threads.
+
+    The heaviest threads, which belong to any user, are only listed for the
+    bearer token in METRICS_TOKEN. Other requests get the totals per operation.
+    """
+    snapshot = CHECKPOINT_METRICS.snapshot(top)
+    token = os.environ.get("METRICS_TOKEN")
+    if not token or not hmac.compare_digest(
+        (authorization or "").encode(), f"Bearer {token}".encode()
+    ):
+        return {"checkpoints": {"operations": snapshot["operations"]}}
+    return {"checkpoints": snapshot}
+
+
 ui_dir = str(ROOT / "ui")
 
 if os.path.exists(ui_dir):
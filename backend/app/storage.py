@@ -1,34 +1,184 @@
+import os
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from datetime import datetime, timezone
 from typing import Any, List, Optional, Sequence, Union
+from uuid import UUID, uuid4
+
+import orjson
 
 from langchain_core.messages import AnyMessage
 from langchain_core.runnables import RunnableConfig
 
-from app.agent import agent
-from app.lifespan import get_pg_pool
-from app.schema import Assistant, Thread, User
+from app.agent import CHECKPOINTER, agent
+from app.cache import AssistantCache, TTLCache
+from app.checkpoint import (
+    CONFIG_KEY_BEFORE,
+    CONFIG_KEY_LIMIT,
+    CONFIG_KEY_METADATA_ONLY,
+)
+from app.lifespan import get_pg_pool, get_pg_read_pool
+from app.queries import register
+from app.schema import Assistant, Thread, ThreadSearchHit, User
+from app.search import SEARCH_CONFIG
+
+
+ASSISTANT_CACHE = AssistantCache(
+    maxsize=int(os.environ.get("ASSISTANT_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("ASSISTANT_CACHE_TTL", 60)),
+)
+
+
+ASSISTANT_FIELDS = tuple(Assistant.__annotations__)
+THREAD_FIELDS = tuple(Thread.__annotations__)
+
+
+def _encode_cursor(row: dict, id_column: str) -> str:
+    return urlsafe_b64encode(
+        orjson.dumps([row["updated_at"], str(row[id_column])])
+    ).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[datetime, str]:
+    try:
+        updated_at, id_ = orjson.loads(urlsafe_b64decode(cursor))
+        return datetime.fromisoformat(updated_at), str(UUID(id_))
+    except Exception as e:
+        raise ValueError("Invalid cursor.") from e
+
+
+def _page_query(
+    table: str,
+    id_column: str,
+    fields: Optional[Sequence[str]],
+    allowed: Sequence[str],
+) -> str:
+    """A page of the rows of a user, most recently updated first.
+
+    Takes the user ID, the updated_at and ID of the last row of the previous
+    page (or NULLs) and the page size (or NULL for no limit).
+    """
+    if fields is None:
+        columns = "*"
+    else:
+        if unknown := set(fields) - set(allowed):
+            raise ValueError(f"Unknown fields {sorted(unknown)}.")
+        # needed for the cursor
+        columns = ", ".join(dict.fromkeys([id_column, "updated_at", *fields]))
+    return (
+        f"SELECT {columns} FROM {table} "
+        "WHERE user_id = $1 "
+        f"AND ($2::timestamptz IS NULL OR (updated_at, {id_column}) < ($2, $3::uuid)) "
+        f"ORDER BY updated_at DESC, {id_column} DESC LIMIT $4"
+    )
+
+
+async def _list_page(
+    table: str,
+    id_column: str,
+    allowed: Sequence[str],
+    user_id: str,
+    *,
+    limit: Optional[int],
+    cursor: Optional[str],
+    fields: Optional[Sequence[str]],
+) -> tuple[list, Optional[str]]:
+    query = _page_query(table, id_column, fields, allowed)
+    after_ts, after_id = _decode_cursor(cursor) if cursor else (None, None)
+    # may lag behind writes, by at most POSTGRES_REPLICA_MAX_LAG seconds
+    async with get_pg_read_pool().acquire() as conn:
+        rows = await conn.fetch(query, user_id, after_ts, after_id, limit)
+    next_cursor = (
+        _encode_cursor(rows[-1], id_column) if limit and len(rows) == limit else None
+    )
+    return rows, next_cursor
+
+
+register(
+    "list_assistants",
+    _page_query("assistant", "assistant_id", None, ASSISTANT_FIELDS),
+)
+register("list_threads", _page_query("thread", "thread_id", None, THREAD_FIELDS))
+
+_GET_ASSISTANT = register(
+    "get_assistant",
+    "SELECT * FROM assistant WHERE assistant_id = $1 AND (user_id = $2 OR public IS true)",
+)
+
+_GET_THREAD = register(
+    "get_thread", "SELECT * FROM thread WHERE thread_id = $1 AND user_id = $2"
+)
+
+_GET_THREAD_AND_ASSISTANT = register(
+    "get_thread_and_assistant",
+    "SELECT t.*, a.user_id AS a_user_id, a.name AS a_name, "
+    "a.config AS a_config, a.updated_at AS a_updated_at, a.public AS a_public, "
+    "a.assistant_id IS NOT NULL AS a_found "
+    "FROM thread t LEFT JOIN assistant a ON a.assistant_id = t.assistant_id "
+    "AND (a.user_id = $2 OR a.public IS true) "
+    "WHERE t.thread_id = $1 AND t.user_id = $2",
+)
+
+_GET_OR_CREATE_USER = register(
+    "get_or_create_user",
+    'WITH inserted AS (INSERT INTO "user" (sub) VALUES ($1) '
+    "ON CONFLICT (sub) DO NOTHING RETURNING *) "
+    "SELECT *, true AS created FROM inserted "
+    'UNION ALL SELECT *, false FROM "user" WHERE sub = $1 '
+    "LIMIT 1",
+)
+
+
+# Users are never updated, so they can be cached for a while.
+USER_CACHE: TTLCache[str, User] = TTLCache(
+    maxsize=int(os.environ.get("USER_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("USER_CACHE_TTL", 300)),
+)
 
 
 ### Assistants
-async def list_assistants(user_id: str) -> List[Assistant]:
-    """List all assistants for the current user."""
-    async with get_pg_pool().acquire() as conn:
-        return await conn.fetch("SELECT * FROM assistant WHERE user_id = $1", user_id)
+async def list_assistants(
+    user_id: str,
+    *,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[Sequence[str]] = None,
+) -> tuple[List[Assistant], Optional[str]]:
+    """List the assistants of the current user, most recently updated first.
+
+    Args:
+        limit: The maximum number of assistants to return.
+        cursor: The cursor returned with the previous page.
+        fields: Only return these fields, and the ID and updated_at.
+
+    Returns:
+        The assistants, and the cursor of the next page if there may be one.
+    """
+    return await _list_page(
+        "assistant",
+        "assistant_id",
+        ASSISTANT_FIELDS,
+        user_id,
+        limit=limit,
+        cursor=cursor,
+        fields=fields,
+    )
 
 
 async def get_assistant(user_id: str, assistant_id: str) -> Optional[Assistant]:
     """Get an assistant by ID."""
+    if assistant := ASSISTANT_CACHE.get(user_id, assistant_id):
+        return assistant
+    version = ASSISTANT_CACHE.version
     async with get_pg_pool().acquire() as conn:
-        return await conn.fetchrow(
-            "SELECT * FROM assistant WHERE assistant_id = $1 AND (user_id = $2 OR public IS true)",
-            assistant_id,
-            user_id,
-        )
+        assistant = await conn.fetchrow(_GET_ASSISTANT, assistant_id, user_id)
+    if assistant:
+        ASSISTANT_CACHE.put(assistant, version)
+    return assistant
 
 
 async def list_public_assistants() -> List[Assistant]:
     """List all the public assistants."""
-    async with get_pg_pool().acquire() as conn:
+    async with get_pg_read_pool().acquire() as conn:
         return await conn.fetch(("SELECT * FROM assistant WHERE public IS true;"))
 
 
@@ -67,6 +217,8 @@ async def put_assistant(
                 updated_at,
                 public,
             )
+        # after the commit, so the old row can't be cached again
+        await ASSISTANT_CACHE.ainvalidate(conn, assistant_id)
     return {
         "assistant_id": assistant_id,
         "user_id": user_id,
@@ -85,23 +237,134 @@ async def delete_assistant(user_id: str, assistant_id: str) -> None:
             assistant_id,
             user_id,
         )
+        await ASSISTANT_CACHE.ainvalidate(conn, assistant_id)
 
 
 ### Threads
-async def list_threads(user_id: str) -> List[Thread]:
-    """List all threads for the current user."""
-    async with get_pg_pool().acquire() as conn:
-        return await conn.fetch("SELECT * FROM thread WHERE user_id = $1", user_id)
+async def list_threads(
+    user_id: str,
+    *,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[Sequence[str]] = None,
+) -> tuple[List[Thread], Optional[str]]:
+    """List the threads of the current user, most recently updated first.
+
+    Args:
+        limit: The maximum number of threads to return.
+        cursor: The cursor returned with the previous page.
+        fields: Only return these fields, and the ID and updated_at.
+
+    Returns:
+        The threads, and the cursor of the next page if there may be one.
+    """
+    return await _list_page(
+        "thread",
+        "thread_id",
+        THREAD_FIELDS,
+        user_id,
+        limit=limit,
+        cursor=cursor,
+        fields=fields,
+    )
+
+
+# The best matching message of each matching thread of a user, ranked. Takes
+# the rank and ID of the last hit of the previous page (or NULLs) and the page
+# size. Snippets are only made for the returned page.
+_SEARCH_THREADS = register(
+    "search_threads",
+    """
+WITH best AS (
+    SELECT DISTINCT ON (s.thread_id)
+        s.thread_id, s.message_id, s.content, ts_rank(s.tsv, q) AS rank, q
+    FROM thread_search s
+    JOIN thread t ON t.thread_id = s.thread_id,
+    websearch_to_tsquery('{config}', $2) AS q
+    WHERE t.user_id = $1 AND s.tsv @@ q
+    ORDER BY s.thread_id, rank DESC
+)
+SELECT t.*, b.message_id, b.rank,
+    ts_headline('{config}', b.content, b.q, 'MaxFragments=1, MaxWords=30')
+        AS snippet
+FROM best b JOIN thread t ON t.thread_id = b.thread_id
+WHERE $3::real IS NULL OR (b.rank, b.thread_id) < ($3::real, $4::uuid)
+ORDER BY b.rank DESC, b.thread_id DESC
+LIMIT $5""".format(config=SEARCH_CONFIG),
+)
+
+
+async def search_threads(
+    user_id: str,
+    query: str,
+    *,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+) -> tuple[List[ThreadSearchHit], Optional[str]]:
+    """Search the messages of the threads of a user, best matches first.
+
+    Args:
+        query: Words to search for, in web search syntax ("quoted phrases",
+            or, -excluded).
+        limit: The maximum number of threads to return.
+        cursor: The cursor returned with the previous page.
+
+    Returns:
+        The matching threads, and the cursor of the next page if there may be
+        one.
+    """
+    after_rank, after_id = None, None
+    if cursor:
+        try:
+            after_rank, after_id = orjson.loads(urlsafe_b64decode(cursor))
+            after_rank, after_id = float(after_rank), str(UUID(after_id))
+        except Exception as e:
+            raise ValueError("Invalid cursor.") from e
+    async with get_pg_read_pool().acquire() as conn:
+        rows = await conn.fetch(
+            _SEARCH_THREADS, user_id, query, after_rank, after_id, limit
+        )
+    next_cursor = (
+        urlsafe_b64encode(
+            orjson.dumps([rows[-1]["rank"], str(rows[-1]["thread_id"])])
+        ).decode()
+        if len(rows) == limit
+        else None
+    )
+    return rows, next_cursor
 
 
 async def get_thread(user_id: str, thread_id: str) -> Optional[Thread]:
     """Get a thread by ID."""
     async with get_pg_pool().acquire() as conn:
-        return await conn.fetchrow(
-            "SELECT * FROM thread WHERE thread_id = $1 AND user_id = $2",
-            thread_id,
-            user_id,
-        )
+        return await conn.fetchrow(_GET_THREAD, thread_id, user_id)
+
+
+async def get_thread_and_assistant(
+    user_id: str, thread_id: str
+) -> tuple[Optional[Thread], Optional[Assistant]]:
+    """Get a thread by ID, and its assistant if the user can see it.
+
+    Same as `get_thread` followed by `get_assistant`, in a single query.
+    """
+    version = ASSISTANT_CACHE.version
+    async with get_pg_pool().acquire() as conn:
+        row = await conn.fetchrow(_GET_THREAD_AND_ASSISTANT, thread_id, user_id)
+    if row is None:
+        return None, None
+    thread = {k: v for k, v in row.items() if not k.startswith("a_")}
+    if not row["a_found"]:
+        return thread, None
+    assistant = {
+        "assistant_id": row["assistant_id"],
+        "user_id": row["a_user_id"],
+        "name": row["a_name"],
+        "config": row["a_config"],
+        "updated_at": row["a_updated_at"],
+        "public": row["a_public"],
+    }
+    ASSISTANT_CACHE.put(assistant, version)
+    return thread, assistant
 
 
 async def get_thread_state(*, user_id: str, thread_id: str, assistant: Assistant):
@@ -139,10 +402,49 @@ async def update_thread_state(
         },
         values,
     )
+    await CHECKPOINTER.aflush(config["configurable"]["thread_id"])
 
 
-async def get_thread_history(*, user_id: str, thread_id: str, assistant: Assistant):
-    """Get the history of a thread."""
+async def get_thread_history(
+    *,
+    user_id: str,
+    thread_id: str,
+    assistant: Assistant,
+    limit: Optional[int] = None,
+    before: Optional[datetime] = None,
+    metadata_only: bool = False,
+):
+    """Get the history of a thread, newest first.
+
+    Args:
+        limit: The maximum number of states to return.
+        before: Only return states older than this thread_ts. Pass the
+            thread_ts of the last state of a page to get the next page.
+        metadata_only: Only return the config, parent and next of each state.
+            The checkpoints are read without re-creating their messages or
+            reading offloaded tool outputs.
+    """
+    history = agent.aget_state_history(
+        {
+            "configurable": {
+                **assistant["config"]["configurable"],
+                "thread_id": thread_id,
+                "assistant_id": assistant["assistant_id"],
+                CONFIG_KEY_LIMIT: limit,
+                CONFIG_KEY_BEFORE: before,
+                CONFIG_KEY_METADATA_ONLY: metadata_only,
+            }
+        }
+    )
+    if metadata_only:
+        return [
+            {
+                "next": c.next,
+                "config": c.config,
+                "parent": c.parent_config,
+            }
+            async for c in history
+        ]
     return [
         {
             "values": c.values,
@@ -150,15 +452,7 @@ async def get_thread_history(*, user_id: str, thread_id: str, assistant: Assista
             "config": c.config,
             "parent": c.parent_config,
         }
-        async for c in agent.aget_state_history(
-            {
-                "configurable": {
-                    **assistant["config"]["configurable"],
-                    "thread_id": thread_id,
-                    "assistant_id": assistant["assistant_id"],
-                }
-            }
-        )
+        async for c in history
     ]
 
 
@@ -174,7 +468,7 @@ async def put_thread(
         else None
     )
     async with get_pg_pool().acquire() as conn:
-        await conn.execute(
+        return await conn.fetchrow(
             (
                 "INSERT INTO thread (thread_id, user_id, assistant_id, name, updated_at, metadata) VALUES ($1, $2, $3, $4, $5, $6) "
                 "ON CONFLICT (thread_id) DO UPDATE SET "
@@ -182,7 +476,8 @@ async def put_thread(
                 "assistant_id = EXCLUDED.assistant_id, "
                 "name = EXCLUDED.name, "
                 "updated_at = EXCLUDED.updated_at, "
-                "metadata = EXCLUDED.metadata;"
+                "metadata = EXCLUDED.metadata "
+                "RETURNING *;"
             ),
             thread_id,
             user_id,
@@ -191,14 +486,27 @@ async def put_thread(
             updated_at,
             metadata,
         )
-        return {
-            "thread_id": thread_id,
-            "user_id": user_id,
-            "assistant_id": assistant_id,
-            "name": name,
-            "updated_at": updated_at,
-            "metadata": metadata,
-        }
+
+
+async def fork_thread(
+    user_id: str, thread: Thread, *, thread_ts: Optional[datetime], name: str
+) -> Optional[Thread]:
+    """Create a thread starting from a state of another thread.
+
+    The state is not copied, so forking costs the same whatever the size of
+    the thread. Returns None if the thread has no state at `thread_ts`.
+    """
+    thread_id = str(uuid4())
+    if await CHECKPOINTER.afork(str(thread["thread_id"]), thread_id, thread_ts) is None:
+        return None
+    await put_thread(
+        user_id,
+        thread_id,
+        assistant_id=thread["assistant_id"],
+        name=name,
+    )
+    await CHECKPOINTER.arefresh_summary(thread_id)
+    return await get_thread(user_id, thread_id)
 
 
 async def delete_thread(user_id: str, thread_id: str):
@@ -214,10 +522,18 @@ async def delete_thread(user_id: str, thread_id: str):
 ### Users
 async def get_or_create_user(sub: str) -> tuple[User, bool]:
     """Returns a tuple of the user and a boolean indicating whether the user was created."""
+    if user := USER_CACHE.get(sub):
+        return user, False
     async with get_pg_pool().acquire() as conn:
-        if user := await conn.fetchrow('SELECT * FROM "user" WHERE sub = $1', sub):
-            return user, False
-        user = await conn.fetchrow(
-            'INSERT INTO "user" (sub) VALUES ($1) RETURNING *', sub
-        )
-        return user, True
+        for _ in range(2):
+            row = await conn.fetchrow(_GET_OR_CREATE_USER, sub)
+            if row is not None:
+                break
+            # inserted by a transaction that committed after this statement
+            # started, so the select didn't see it either
+        else:
+            # eg. deleted again between the two attempts
+            raise RuntimeError(f"Could not get or create the user {sub}.")
+    user = {k: v for k, v in row.items() if k != "created"}
+    USER_CACHE.set(sub, user)
+    return user, row["created"]
@@ -0,0 +1,117 @@
+import asyncio
+import struct
+import time
+from hashlib import blake2b
+from typing import Callable, Optional
+
+import asyncpg
+import structlog
+
+from app.lifespan import get_pg_session_pool
+
+logger = structlog.get_logger(__name__)
+
+_LOCK_PREFIX = "opengpts:thread:"
+
+
+def _lock_key(thread_id: str) -> tuple[int, int]:
+    """The two int4 keys of the advisory lock of a thread.
+
+    Together a 64-bit hash, so locks of different threads don't collide, in a
+    key space apart from the single-key locks taken elsewhere.
+    """
+    digest = blake2b((_LOCK_PREFIX + thread_id).encode(), digest_size=8).digest()
+    return struct.unpack("!ii", digest)
+
+
+class ThreadLocks:
+    """Mutual exclusion of the runs of a thread, across processes.
+
+    The locks are postgres session-level advisory locks, all held on one
+    connection of this process from `get_pg_session_pool`, so a run doesn't
+    pin a connection of its own. Advisory locks are reentrant within a
+    session, so the threads this process holds are also tracked here.
+    Postgres releases the locks if the connection is lost, and so does this,
+    calling `on_lost` with the threads it held so their runs can be stopped.
+    The next lock is taken on a new connection.
+    """
+
+    def __init__(
+        self,
+        *,
+        poll_interval: float = 0.2,
+        on_lost: Optional[Callable[[set[str]], None]] = None,
+    ) -> None:
+        self.poll_interval = poll_interval
+        self.on_lost = on_lost
+        self._conn: Optional[asyncpg.Connection] = None
+        self._lost: Optional[asyncpg.Connection] = None
+        self._mutex = asyncio.Lock()
+        self._held: set[str] = set()
+
+    async def try_acquire(self, thread_id: str) -> bool:
+        """Lock the thread if no run, in any process, holds it."""
+        async with self._mutex:
+            if thread_id in self._held:
+                return False
+            conn = await self._connection()
+            if not await conn.fetchval(
+                "SELECT pg_try_advisory_lock($1, $2)", *_lock_key(thread_id)
+            ):
+                return False
+            self._held.add(thread_id)
+            return True
+
+    async def acquire(self, thread_id: str, *, timeout: float) -> bool:
+        """Wait up to `timeout` seconds to lock the thread.
+
+        Returns whether the thread was locked.
+        """
+        deadline = time.monotonic() + timeout
+        while not await self.try_acquire(thread_id):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(self.poll_interval)
+        return True
+
+    async def release(self, thread_id: str) -> None:
+        async with self._mutex:
+            if thread_id not in self._held:
+                return
+            self._held.discard(thread_id)
+            if self._conn is not None:
+                await self._conn.execute(
+                    "SELECT pg_advisory_unlock($1, $2)", *_lock_key(thread_id)
+                )
+
+    async def close(self) -> None:
+        """Release every lock of this process."""
+        async with self._mutex:
+            self._held.clear()
+            await self._release_lost()
+            if self._conn is None:
+                return
+            conn, self._conn = self._conn, None
+            conn.remove_termination_listener(self._on_terminated)
+            # resetting the connection releases its advisory locks
+            await get_pg_session_pool().release(conn)
+
+    async def _connection(self) -> asyncpg.Connection:
+        if self._conn is None:
+            await self._release_lost()
+            self._conn = await get_pg_session_pool().acquire()
+            self._conn.add_termination_listener(self._on_terminated)
+        return self._conn
+
+    async def _release_lost(self) -> None:
+        # frees the pool's slot of a lost connection
+        if self._lost is not None:
+            lost, self._lost = self._lost, None
+            await get_pg_session_pool().release(lost)
+
+    def _on_terminated(self, conn) -> None:
+        logger.warn("Thread lock connection lost, its locks were released.")
+        self._conn, self._lost = None, conn
+        lost, self._held = self._held, set()
+        if lost and self.on_lost is not None:
+            self.on_lost(lost)
@@ -0,0 +1,368 @@
+"""Export and import the threads of a user, with their checkpoints, as NDJSON.
+
+An export is a header line followed by one line per thread, then one line
+per checkpoint. Each checkpoint is preceded by the offloaded tool outputs
+(blobs) it refers to, the first time they are referenced:
+
+    {"type": "header", "format": "opengpts-threads", "version": 1}
+    {"type": "thread", "data": {"thread_id": ..., "name": ..., ...}}
+    {"type": "blob", "data": {"hash": ..., "data": <base64>}}
+    {"type": "checkpoint", "data": {"thread_id": ..., "thread_ts": ...,
+        "parent_ts": ..., "parent_thread_id": ..., "delta": ...,
+        "checkpoint": <base64>}}
+
+Both directions stream: exports read through server-side cursors in one
+snapshot, imports COPY batches of lines into temporary tables and move them
+into place in one transaction.
+"""
+import base64
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import sha256
+from typing import Any, AsyncIterable, AsyncIterator, Optional
+from uuid import UUID
+
+import asyncpg
+import orjson
+import structlog
+
+from app.agent import CHECKPOINTER
+from app.checkpoint import _BLOBS
+from app.lifespan import get_pg_pool
+from app.serde import loads_untrusted
+
+logger = structlog.get_logger(__name__)
+
+FORMAT = "opengpts-threads"
+VERSION = 1
+
+# Lines are buffered up to this size before they are sent.
+_CHUNK_BYTES = 64 * 1024
+# Longest line an import accepts, which bounds the memory it needs.
+_MAX_LINE_BYTES = 64 * 1024 * 1024
+# Blobs already written to an export, so each is written once.
+_SEEN_BLOBS = 100_000
+
+_EXPORT_THREADS = """
+SELECT thread_id, assistant_id, name, updated_at, metadata,
+    last_message, message_count, last_run_at
+FROM thread WHERE user_id = $1 ORDER BY thread_id"""
+
+# blob_refs is NULL for checkpoints written before it was kept and not
+# backfilled yet, whose blobs are found by reading them.
+_EXPORT_CHECKPOINTS = """
+SELECT thread_id, thread_ts, parent_ts, parent_thread_id, delta, checkpoint,
+    blob_refs
+FROM checkpoints
+WHERE thread_id IN (SELECT thread_id::text FROM thread WHERE user_id = $1)
+ORDER BY thread_id, thread_ts"""
+
+_STAGE = """
+CREATE TEMPORARY TABLE import_thread (
+    thread_id TEXT, assistant_id TEXT, name TEXT, updated_at TIMESTAMPTZ,
+    metadata TEXT, last_message TEXT, message_count INTEGER,
+    last_run_at TIMESTAMPTZ
+) ON COMMIT DROP;
+CREATE TEMPORARY TABLE import_checkpoints (
+    thread_id TEXT, thread_ts TIMESTAMPTZ, parent_ts TIMESTAMPTZ,
+    parent_thread_id TEXT, delta BOOLEAN, checkpoint BYTEA, blob_refs TEXT[]
+) ON COMMIT DROP;
+CREATE TEMPORARY TABLE import_blobs (hash TEXT, data BYTEA) ON COMMIT DROP"""
+
+# Threads that already exist are left alone, and the assistant of a thread is
+# only kept if the importing user can see it. Returns the threads created.
+_IMPORT_THREADS = """
+INSERT INTO thread (
+    thread_id, assistant_id, user_id, name, updated_at, metadata,
+    last_message, message_count, last_run_at
+)
+SELECT
+    i.thread_id::uuid, a.assistant_id, $1, i.name, i.updated_at, i.metadata::jsonb,
+    i.last_message, i.message_count, i.last_run_at
+FROM import_thread i
+LEFT JOIN assistant a ON a.assistant_id = i.assistant_id::uuid
+    AND (a.user_id = $1 OR a.public IS true)
+ON CONFLICT (thread_id) DO NOTHING
+RETURNING thread_id::text"""
+
+# Checkpoints are only imported into the threads the import created ($2), so
+# the history of existing threads is never merged into, and can only fork
+# from threads of the importing user, so that an import can't read anyone
+# else's.
+_IMPORT_CHECKPOINTS = """
+WITH owned AS (SELECT thread_id::text FROM thread WHERE user_id = $1),
+inserted AS (
+    INSERT INTO checkpoints
+        (thread_id, thread_ts, parent_ts, parent_thread_id, checkpoint, delta,
+        blob_refs)
+    SELECT thread_id, thread_ts, parent_ts, parent_thread_id, checkpoint, delta,
+        blob_refs
+    FROM import_checkpoints
+    WHERE thread_id = ANY($2::text[])
+        AND (parent_thread_id IS NULL
+            OR parent_thread_id IN (SELECT thread_id FROM owned))
+    ON CONFLICT (thread_id, thread_ts) DO NOTHING
+    RETURNING thread_id
+)
+SELECT thread_id, count(*) FROM inserted GROUP BY thread_id"""
+
+# Only the blobs referenced by the imported checkpoints. Blobs that exist are
+# marked as stored now, so they aren't collected before the import commits.
+_IMPORT_BLOBS = """
+INSERT INTO checkpoint_blobs (hash, data, created_at)
+SELECT DISTINCT ON (hash) hash, data, now() FROM import_blobs
+WHERE hash IN (
+    SELECT unnest(blob_refs) FROM import_checkpoints
+    WHERE thread_id = ANY($1::text[])
+)
+ON CONFLICT (hash) DO UPDATE SET created_at = EXCLUDED.created_at"""
+
+_HEADER = orjson.dumps({"type": "header", "format": FORMAT, "version": VERSION})
+
+_COLUMNS = {
+    "import_thread": (
+        "thread_id",
+        "assistant_id",
+        "name",
+        "updated_at",
+        "metadata",
+        "last_message",
+        "message_count",
+        "last_run_at",
+    ),
+    "import_checkpoints": (
+        "thread_id",
+        "thread_ts",
+        "parent_ts",
+        "parent_thread_id",
+        "delta",
+        "checkpoint",
+        "blob_refs",
+    ),
+    "import_blobs": ("hash", "data"),
+}
+
+
+def _line(type: str, data: Any) -> bytes:
+    return orjson.dumps({"type": type, "data": data}) + b"\n"
+
+
+def _raw_blob_refs(value: Any) -> set[str]:
+    """Hashes of the BlobRefs in a checkpoint loaded with `loads_raw`."""
+    if isinstance(value, list):
+        return set().union(*(_raw_blob_refs(v) for v in value))
+    if isinstance(value, dict):
+        if value.get("__t") == "BlobRef":
+            return {value["__v"]["hash"]}
+        return set().union(*(_raw_blob_refs(v) for v in value.values()))
+    return set()
+
+
+async def export_threads(user_id: str) -> AsyncIterator[bytes]:
+    """Stream the threads of a user and their checkpoints as NDJSON chunks."""
+    await CHECKPOINTER.aflush()
+    loads_raw = getattr(CHECKPOINTER.serde, "loads_raw", None)
+    seen_blobs: OrderedDict[str, None] = OrderedDict()
+    chunk = [_HEADER + b"\n"]
+    size = 0
+    async with get_pg_pool().acquire() as conn:
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            async for row in conn.cursor(_EXPORT_THREADS, user_id):
+                chunk.append(_line("thread", dict(row)))
+                size += len(chunk[-1])
+                if size >= _CHUNK_BYTES:
+                    yield b"".join(chunk)
+                    chunk, size = [], 0
+            async for row in conn.cursor(_EXPORT_CHECKPOINTS, user_id):
+                row = dict(row)
+                blob_refs = row.pop("blob_refs")
+                blob = row["checkpoint"]
+                if blob_refs is not None:
+                    refs = set(blob_refs)
+                elif blob and loads_raw:
+                    refs = _raw_blob_refs(loads_raw(blob))
+                else:
+                    refs = set()
+                if refs := refs - seen_blobs.keys():
+                    for hash, data in await conn.fetch(_BLOBS, list(refs)):
+                        data = base64.b64encode(data).decode()
+                        chunk.append(_line("blob", {"hash": hash, "data": data}))
+                        size += len(chunk[-1])
+                    for hash in refs:
+                        seen_blobs[hash] = None
+                    while len(seen_blobs) > _SEEN_BLOBS:
+                        seen_blobs.popitem(last=False)
+                chunk.append(
+                    _line(
+                        "checkpoint",
+                        {
+                            **row,
+                            "checkpoint": blob and base64.b64encode(blob).decode(),
+                        },
+                    )
+                )
+                size += len(chunk[-1])
+                if size >= _CHUNK_BYTES:
+                    yield b"".join(chunk)
+                    chunk, size = [], 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+async def _lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    # the parts of the current line, joined once it is complete
+    parts: list[bytes] = []
+    size = 0
+    async for chunk in chunks:
+        *complete, rest = chunk.split(b"\n")
+        for tail in complete:
+            yield b"".join(parts) + tail
+            parts, size = [], 0
+        parts.append(rest)
+        size += len(rest)
+        if size > _MAX_LINE_BYTES:
+            raise ValueError("Line is too long.")
+    yield b"".join(parts)
+
+
+def _uuid(value: Any) -> Optional[str]:
+    return None if value is None else str(UUID(value))
+
+
+def _ts(value: Any) -> Optional[datetime]:
+    return None if value is None else datetime.fromisoformat(value)
+
+
+def _b64(value: Any) -> Optional[bytes]:
+    return None if value is None else base64.b64decode(value, validate=True)
+
+
+def _record(type: str, data: dict, trusted: bool) -> tuple[str, tuple]:
+    """The staging table and row of an import line."""
+    if type == "thread":
+        return "import_thread", (
+            _uuid(data["thread_id"]),
+            _uuid(data.get("assistant_id")),
+            str(data["name"]),
+            _ts(data["updated_at"]),
+            orjson.dumps(data.get("metadata")).decode(),
+            data.get("last_message"),
+            int(data.get("message_count", 0)),
+            _ts(data.get("last_run_at")),
+        )
+    if type == "checkpoint":
+        checkpoint = _b64(data["checkpoint"])
+        if checkpoint is None and not data.get("parent_thread_id"):
+            raise ValueError("Only the first checkpoint of a fork can be empty.")
+        refs: set[str] = set()
+        if checkpoint is not None:
+            if not trusted:
+                refs = _raw_blob_refs(loads_untrusted(checkpoint))
+            elif loads_raw := getattr(CHECKPOINTER.serde, "loads_raw", None):
+                refs = _raw_blob_refs(loads_raw(checkpoint))
+        return "import_checkpoints", (
+            _uuid(data["thread_id"]),
+            _ts(data["thread_ts"]),
+            _ts(data.get("parent_ts")),
+            _uuid(data.get("parent_thread_id")),
+            bool(data["delta"]),
+            checkpoint,
+            sorted(refs),
+        )
+    if type == "blob":
+        blob = _b64(data["data"])
+        if sha256(blob).hexdigest() != data["hash"]:
+            raise ValueError("Blob doesn't match its hash.")
+        if not trusted:
+            loads_untrusted(blob)
+        return "import_blobs", (data["hash"], blob)
+    raise ValueError(f"Unknown line type {type}.")
+
+
+async def _copy(conn: asyncpg.Connection, batches: dict[str, list[tuple]]) -> None:
+    for table, records in batches.items():
+        if records:
+            await conn.copy_records_to_table(
+                table, records=records, columns=_COLUMNS[table]
+            )
+            records.clear()
+
+
+async def import_threads(
+    user_id: str,
+    chunks: AsyncIterable[bytes],
+    *,
+    trusted: bool = False,
+    batch_size: int = 1000,
+    batch_bytes: int = 16 * 1024 * 1024,
+) -> dict[str, int]:
+    """Import an export of `export_threads` for a user.
+
+    Threads that already exist are skipped with their checkpoints, so the
+    history of an existing thread is never merged into. Either everything
+    else is imported or nothing is.
+
+    Args:
+        chunks: The export, in chunks of any size.
+        trusted: Accept checkpoints that contain pickles, which run arbitrary
+            code when they are loaded. Only for exports from a trusted source.
+        batch_size: Lines per COPY into the staging tables.
+        batch_bytes: Bytes of checkpoints per COPY into the staging tables.
+
+    Returns:
+        The number of threads, checkpoints and blobs imported, and of threads
+        and checkpoints skipped.
+
+    Raises:
+        ValueError: If the export is malformed, or contains pickles and is
+            not trusted.
+    """
+    batches: dict[str, list[tuple]] = {table: [] for table in _COLUMNS}
+    header = orjson.loads(_HEADER)
+    async with get_pg_pool().acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(_STAGE)
+            number = size = 0
+            async for line in _lines(chunks):
+                number += 1
+                if not line.strip():
+                    continue
+                try:
+                    value = orjson.loads(line)
+                    if header is not None:
+                        if value != header:
+                            raise ValueError(f"Not a {FORMAT} v{VERSION} export.")
+                        header = None
+                        continue
+                    table, record = _record(value["type"], value["data"], trusted)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    raise ValueError(f"Line {number}: {e}") from e
+                batches[table].append(record)
+                size += len(line)
+                if len(batches[table]) >= batch_size or size >= batch_bytes:
+                    await _copy(conn, batches)
+                    size = 0
+            if header is not None:
+                raise ValueError("Export is empty.")
+            await _copy(conn, batches)
+
+            staged = await conn.fetchrow(
+                "SELECT (SELECT count(*) FROM import_thread) AS threads, "
+                "(SELECT count(*) FROM import_checkpoints) AS checkpoints"
+            )
+            threads = [row[0] for row in await conn.fetch(_IMPORT_THREADS, user_id)]
+            checkpoints = await conn.fetch(_IMPORT_CHECKPOINTS, user_id, threads)
+            blobs = await conn.execute(_IMPORT_BLOBS, threads)
+    await CHECKPOINTER.aforget([row["thread_id"] for row in checkpoints])
+    if CHECKPOINTER.search:
+        for row in checkpoints:
+            await CHECKPOINTER.areindex(row["thread_id"])
+    imported = {
+        "threads": len(threads),
+        "checkpoints": sum(row["count"] for row in checkpoints),
+        "blobs": int(blobs.split()[-1]),
+    }
+    imported["skipped_threads"] = staged["threads"] - imported["threads"]
+    imported["skipped_checkpoints"] = staged["checkpoints"] - imported["checkpoints"]
+    logger.info("Imported threads", user_id=user_id, **imported)
+    return imported
@@ -0,0 +1,164 @@
+"""Compare latest-checkpoint lookups on the single and partitioned layouts.
+
+Fills a scratch schema per layout with synthetic checkpoints, then times the
+queries PostgresCheckpoint runs to read the latest checkpoint of a thread and
+to list its history metadata. Uses the POSTGRES_* environment variables and
+drops the scratch schemas when done.
+
+Usage (from the backend directory):
+
+    poetry run python -m benchmarks.checkpoint_latest --rows 10000000
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+import asyncpg
+
+from app.checkpoint import _CHAIN_LATEST
+
+_LAYOUTS = {
+    "single": """
+CREATE TABLE checkpoints (
+    thread_id TEXT NOT NULL,
+    thread_ts TIMESTAMPTZ NOT NULL,
+    parent_ts TIMESTAMPTZ,
+    parent_thread_id TEXT,
+    checkpoint BYTEA,
+    delta BOOLEAN NOT NULL DEFAULT false,
+    PRIMARY KEY (thread_id, thread_ts)
+)""",
+    "partitioned": """
+CREATE TABLE checkpoints (
+    thread_id TEXT NOT NULL,
+    thread_ts TIMESTAMPTZ NOT NULL,
+    parent_ts TIMESTAMPTZ,
+    parent_thread_id TEXT,
+    checkpoint BYTEA,
+    delta BOOLEAN NOT NULL DEFAULT false,
+    size INTEGER GENERATED ALWAYS AS (octet_length(checkpoint)) STORED,
+    PRIMARY KEY (thread_id, thread_ts) INCLUDE (parent_ts, delta, size)
+) PARTITION BY HASH (thread_id);
+DO $$
+BEGIN
+    FOR i IN 0..15 LOOP
+        EXECUTE format(
+            'CREATE TABLE checkpoints_p%s PARTITION OF checkpoints '
+            'FOR VALUES WITH (MODULUS 16, REMAINDER %s)',
+            lpad(i::text, 2, '0'),
+            i
+        );
+    END LOOP;
+END $$""",
+}
+
+_METADATA = {
+    "single": "SELECT thread_ts, parent_ts, delta, octet_length(checkpoint) "
+    "FROM checkpoints WHERE thread_id = $1 ORDER BY thread_ts DESC LIMIT 20",
+    "partitioned": "SELECT thread_ts, parent_ts, delta, size FROM checkpoints "
+    "WHERE thread_id = $1 ORDER BY thread_ts DESC LIMIT 20",
+}
+
+# Every thread gets `per_thread` checkpoints a second apart, parented on the
+# previous one. Rows are inserted in thread order, one batch per statement.
+_FILL = """
+INSERT INTO checkpoints (thread_id, thread_ts, parent_ts, checkpoint, delta)
+SELECT
+    'thread-' || t,
+    timestamptz '2024-01-01' + s * interval '1 second',
+    CASE WHEN s > 0 THEN timestamptz '2024-01-01' + (s - 1) * interval '1 second' END,
+    convert_to(repeat('x', $3), 'UTF8'),
+    false
+FROM generate_series($1::int, $2::int - 1) AS t, generate_series(0, $4::int - 1) AS s"""
+
+
+async def connect() -> asyncpg.Connection:
+    return await asyncpg.connect(
+        user=os.environ["POSTGRES_USER"],
+        password=os.environ["POSTGRES_PASSWORD"],
+        host=os.environ["POSTGRES_HOST"],
+        port=os.environ["POSTGRES_PORT"],
+        database=os.environ["POSTGRES_DB"],
+    )
+
+
+async def fill(conn: asyncpg.Connection, layout: str, args: argparse.Namespace) -> int:
+    schema = f"bench_{layout}"
+    await conn.execute(
+        f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}"
+    )
+    await conn.execute(f"SET search_path TO {schema}")
+    await conn.execute(_LAYOUTS[layout])
+    threads = args.rows // args.per_thread
+    batch = max(1, args.batch_rows // args.per_thread)
+    start = time.perf_counter()
+    for first in range(0, threads, batch):
+        await conn.execute(
+            _FILL, first, min(first + batch, threads), args.blob_bytes, args.per_thread
+        )
+    await conn.execute("VACUUM ANALYZE checkpoints")
+    elapsed = time.perf_counter() - start
+    print(f"{layout}: filled {threads * args.per_thread:,} rows in {elapsed:.0f}s")
+    return threads
+
+
+async def timeit(
+    conn: asyncpg.Connection, query: str, thread_ids: list[str]
+) -> list[float]:
+    stmt = await conn.prepare(query)
+    for thread_id in thread_ids[:100]:
+        await stmt.fetch(thread_id)
+    times = []
+    for thread_id in thread_ids:
+        start = time.perf_counter()
+        await stmt.fetch(thread_id)
+        times.append((time.perf_counter() - start) * 1000)
+    return sorted(times)
+
+
+def report(name: str, times: list[float]) -> None:
+    p50 = times[len(times) // 2]
+    p99 = times[int(len(times) * 0.99)]
+    print(f"{name:<32} {p50:>10.3f} {p99:>10.3f}")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--per-thread", type=int, default=50)
+    parser.add_argument("--blob-bytes", type=int, default=256)
+    parser.add_argument("--batch-rows", type=int, default=500_000)
+    parser.add_argument("--lookups", type=int, default=5000)
+    parser.add_argument(
+        "--layouts", nargs="+", default=list(_LAYOUTS), choices=list(_LAYOUTS)
+    )
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch schemas.")
+    args = parser.parse_args()
+
+    conn = await connect()
+    try:
+        results = {}
+        for layout in args.layouts:
+            threads = await fill(conn, layout, args)
+            thread_ids = [
+                f"thread-{random.randrange(threads)}" for _ in range(args.lookups)
+            ]
+            results[layout] = (
+                await timeit(conn, _CHAIN_LATEST, thread_ids),
+                await timeit(conn, _METADATA[layout], thread_ids),
+            )
+        print(f"\n{'query (ms)':<32} {'p50':>10} {'p99':>10}")
+        for layout, (latest, metadata) in results.items():
+            report(f"{layout} latest checkpoint", latest)
+            report(f"{layout} history metadata", metadata)
+    finally:
+        if not args.keep:
+            for layout in args.layouts:
+                await conn.execute(f"DROP SCHEMA IF EXISTS bench_{layout} CASCADE")
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+"""Compare checkpoint serializers on a synthetic agent thread.
+
+Usage (from the backend directory):
+
+    poetry run python -m benchmarks.checkpoint_serde --messages 200
+"""
+import argparse
+import time
+from typing import Callable
+
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.base import SerializerProtocol, empty_checkpoint
+
+from app.message_types import LiberalToolMessage
+from app.serde import CheckpointSerializer, PickleSerializer
+
+
+def make_checkpoint(n_messages: int) -> dict:
+    messages = []
+    for i in range(n_messages // 4):
+        messages.append(HumanMessage(content=f"Question number {i}? " * 5))
+        messages.append(
+            AIMessage(
+                content="",
+                tool_calls=[{"id": f"call_{i}", "name": "retrieval", "args": {"q": i}}],
+            )
+        )
+        messages.append(
+            LiberalToolMessage(
+                tool_call_id=f"call_{i}",
+                name="retrieval",
+                content=[
+                    Document(
+                        page_content="Lorem ipsum dolor sit amet. " * 30,
+                        metadata={"source": f"doc{j}"},
+                    )
+                    for j in range(4)
+                ],
+            )
+        )
+        messages.append(AIMessage(content="Here is what I found. " * 20))
+    checkpoint = empty_checkpoint()
+    checkpoint["channel_values"] = {"__root__": messages}
+    checkpoint["channel_versions"]["__root__"] = n_messages
+    checkpoint["versions_seen"]["agent"]["__root__"] = n_messages
+    return checkpoint
+
+
+def timeit(fn: Callable[[], object], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def bench(name: str, serde: SerializerProtocol, checkpoint: dict, repeat: int) -> None:
+    blob = serde.dumps(checkpoint)
+    loaded = serde.loads(blob)
+    assert loaded["channel_values"] == checkpoint["channel_values"]
+    encode = timeit(lambda: serde.dumps(checkpoint), repeat)
+    decode = timeit(lambda: serde.loads(blob), repeat)
+    print(f"{name:<12} {len(blob):>12,} {encode:>12.2f} {decode:>12.2f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, nargs="+", default=[20, 200, 1000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    for n_messages in args.messages:
+        checkpoint = make_checkpoint(n_messages)
+        print(f"\n{n_messages} messages")
+        print(f"{'serializer':<12} {'bytes':>12} {'encode ms':>12} {'decode ms':>12}")
+        bench("pickle", PickleSerializer(), checkpoint, args.repeat)
+        bench(
+            "orjson",
+            CheckpointSerializer(compress_threshold=float("inf")),
+            checkpoint,
+            args.repeat,
+        )
+        bench("orjson+zlib", CheckpointSerializer(), checkpoint, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
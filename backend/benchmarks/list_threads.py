@@ -0,0 +1,131 @@
+"""Compare listing all threads of a user with keyset pages.
+
+Fills a scratch schema with the threads of one heavy user (and of other
+users), with and without the (user_id, updated_at) index, then times the
+old `SELECT *` of every thread against the first and a deep page of the
+queries storage.list_threads runs. Uses the POSTGRES_* environment variables
+and drops the scratch schemas when done.
+
+Usage (from the backend directory):
+
+    poetry run python -m benchmarks.list_threads --threads 100000
+"""
+import argparse
+import asyncio
+import os
+import time
+from uuid import uuid4
+
+import asyncpg
+
+from app.storage import THREAD_FIELDS, _decode_cursor, _encode_cursor, _page_query
+
+_LAYOUTS = {
+    "no index": "",
+    "indexed": "CREATE INDEX ON thread (user_id, updated_at DESC, thread_id DESC)",
+}
+
+_FILL = """
+INSERT INTO thread (thread_id, assistant_id, user_id, name, updated_at, metadata)
+SELECT
+    uuid_generate_v4(),
+    NULL,
+    $1::uuid,
+    'Thread ' || i,
+    timestamptz '2024-01-01' + i * interval '1 minute',
+    '{"assistant_type": "agent"}'::jsonb
+FROM generate_series(1, $2::int) AS i"""
+
+
+async def connect() -> asyncpg.Connection:
+    return await asyncpg.connect(
+        user=os.environ["POSTGRES_USER"],
+        password=os.environ["POSTGRES_PASSWORD"],
+        host=os.environ["POSTGRES_HOST"],
+        port=os.environ["POSTGRES_PORT"],
+        database=os.environ["POSTGRES_DB"],
+    )
+
+
+async def fill(conn: asyncpg.Connection, layout: str, args: argparse.Namespace) -> str:
+    schema = "bench_" + layout.replace(" ", "_")
+    await conn.execute(
+        f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}"
+    )
+    await conn.execute(f"SET search_path TO {schema}, public")
+    await conn.execute(
+        "CREATE TABLE thread (LIKE public.thread INCLUDING DEFAULTS, "
+        "PRIMARY KEY (thread_id))"
+    )
+    if _LAYOUTS[layout]:
+        await conn.execute(_LAYOUTS[layout])
+    user_id = str(uuid4())
+    await conn.execute(_FILL, user_id, args.threads)
+    for _ in range(args.other_users):
+        await conn.execute(_FILL, str(uuid4()), args.threads // 10)
+    await conn.execute("VACUUM ANALYZE thread")
+    return user_id
+
+
+async def timeit(
+    conn: asyncpg.Connection, query: str, *params, repeat: int
+) -> tuple[float, int]:
+    stmt = await conn.prepare(query)
+    rows = await stmt.fetch(*params)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await stmt.fetch(*params)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, len(rows)
+
+
+async def bench(
+    conn: asyncpg.Connection, layout: str, args: argparse.Namespace
+) -> None:
+    user_id = await fill(conn, layout, args)
+    # a cursor half way through the user's threads
+    middle = await conn.fetchrow(
+        "SELECT thread_id, updated_at FROM thread WHERE user_id = $1 "
+        "ORDER BY updated_at DESC, thread_id DESC OFFSET $2 LIMIT 1",
+        user_id,
+        args.threads // 2,
+    )
+    after = _decode_cursor(_encode_cursor(middle, "thread_id"))
+    full = _page_query("thread", "thread_id", None, THREAD_FIELDS)
+    projected = _page_query("thread", "thread_id", ["name"], THREAD_FIELDS)
+    cases = [
+        ("all threads (old)", "SELECT * FROM thread WHERE user_id = $1", (user_id,)),
+        ("first page", full, (user_id, None, None, args.page)),
+        ("first page, name only", projected, (user_id, None, None, args.page)),
+        ("middle page", full, (user_id, *after, args.page)),
+    ]
+    for name, query, params in cases:
+        ms, count = await timeit(conn, query, *params, repeat=args.repeat)
+        print(f"{layout:<10} {name:<24} {count:>8,} {ms:>10.2f}")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, default=100_000)
+    parser.add_argument("--other-users", type=int, default=50)
+    parser.add_argument("--page", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch schemas.")
+    args = parser.parse_args()
+
+    conn = await connect()
+    try:
+        print(f"{'layout':<10} {'query':<24} {'rows':>8} {'best ms':>10}")
+        for layout in _LAYOUTS:
+            await bench(conn, layout, args)
+    finally:
+        if not args.keep:
+            for layout in _LAYOUTS:
+                schema = "bench_" + layout.replace(" ", "_")
+                await conn.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
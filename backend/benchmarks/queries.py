@@ -0,0 +1,123 @@
+"""Compare the throughput of the hot queries with and without preparing them.
+
+Runs the registered lookups the API makes on every request (the thread and
+its assistant, the latest checkpoint, an assistant) from concurrent workers,
+on three pools:
+
+- ad hoc: no statement cache, which is how asyncpg had to run behind
+  pgbouncer in transaction mode, so every query is parsed and planned again;
+- registry: no statement cache, the registered queries prepared on every
+  connection (POSTGRES_POOL_MODE=transaction);
+- asyncpg cache: asyncpg's own statement cache, for reference.
+
+Uses the POSTGRES_* environment variables and the threads already in the
+database, or random IDs if there are none.
+
+Usage (from the backend directory):
+
+    poetry run python -m benchmarks.queries --workers 20 --seconds 10
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+from uuid import uuid4
+
+import asyncpg
+
+from app.checkpoint import _CHAIN_LATEST
+from app.lifespan import _init_connection
+from app.queries import PreparedConnection
+from app.storage import _GET_ASSISTANT, _GET_THREAD_AND_ASSISTANT
+
+
+class AdHocConnection(PreparedConnection):
+    """Runs every query as it comes, like a plain asyncpg connection."""
+
+    async def prepare_registered(self) -> None:
+        pass
+
+
+_POOLS = {
+    "ad hoc": {"statement_cache_size": 0, "connection_class": AdHocConnection},
+    "registry": {"statement_cache_size": 0, "connection_class": PreparedConnection},
+    "asyncpg cache": {"connection_class": AdHocConnection},
+}
+
+
+async def create_pool(options: dict, size: int) -> asyncpg.Pool:
+    return await asyncpg.create_pool(
+        user=os.environ["POSTGRES_USER"],
+        password=os.environ["POSTGRES_PASSWORD"],
+        host=os.environ["POSTGRES_HOST"],
+        port=os.environ["POSTGRES_PORT"],
+        database=os.environ["POSTGRES_DB"],
+        min_size=size,
+        max_size=size,
+        init=_init_connection,
+        **options,
+    )
+
+
+async def samples(pool: asyncpg.Pool, count: int) -> list[tuple[str, str, str]]:
+    """(user ID, thread ID, assistant ID) of existing threads, or random IDs."""
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT user_id, thread_id, assistant_id FROM thread LIMIT $1", count
+        )
+    return [
+        (str(r["user_id"]), str(r["thread_id"]), str(r["assistant_id"] or uuid4()))
+        for r in rows
+    ] or [(str(uuid4()), str(uuid4()), str(uuid4())) for _ in range(count)]
+
+
+async def worker(
+    pool: asyncpg.Pool, ids: list[tuple[str, str, str]], deadline: float
+) -> int:
+    done = 0
+    while time.perf_counter() < deadline:
+        user_id, thread_id, assistant_id = random.choice(ids)
+        async with pool.acquire() as conn:
+            await conn.fetchrow(_GET_THREAD_AND_ASSISTANT, thread_id, user_id)
+            await conn.fetch(_CHAIN_LATEST, thread_id)
+            await conn.fetchrow(_GET_ASSISTANT, assistant_id, user_id)
+        done += 3
+    return done
+
+
+async def bench(name: str, args: argparse.Namespace) -> float:
+    pool = await create_pool(_POOLS[name], args.workers)
+    try:
+        ids = await samples(pool, args.samples)
+        # warm up, so that asyncpg's cache is filled
+        await asyncio.gather(
+            *(worker(pool, ids, time.perf_counter() + 1) for _ in range(args.workers))
+        )
+        deadline = time.perf_counter() + args.seconds
+        counts = await asyncio.gather(
+            *(worker(pool, ids, deadline) for _ in range(args.workers))
+        )
+        return sum(counts) / args.seconds
+    finally:
+        await pool.close()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=20)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument(
+        "--pools", nargs="+", default=list(_POOLS), choices=list(_POOLS)
+    )
+    args = parser.parse_args()
+
+    print(f"{'pool':<16} {'queries/s':>12}")
+    for name in args.pools:
+        qps = await bench(name, args)
+        print(f"{name:<16} {qps:>12,.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
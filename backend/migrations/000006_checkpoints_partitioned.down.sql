@@ -0,0 +1,5 @@
+DROP PROCEDURE IF EXISTS checkpoints_copy_batches;
+DROP TABLE IF EXISTS checkpoints_copy_progress;
+DROP TRIGGER IF EXISTS checkpoints_sync_partitioned ON checkpoints;
+DROP FUNCTION IF EXISTS checkpoints_sync_partitioned;
+DROP TABLE IF EXISTS checkpoints_partitioned;
@@ -0,0 +1,86 @@
+-- Moves checkpoints back to a single table, leaving the partitioned table
+-- and its sync trigger as the previous migration does. Blocks writes while
+-- copying.
+
+LOCK TABLE checkpoints IN ACCESS EXCLUSIVE MODE;
+
+ALTER TABLE checkpoints RENAME TO checkpoints_partitioned;
+ALTER INDEX checkpoints_pkey RENAME TO checkpoints_partitioned_pkey;
+
+CREATE TABLE checkpoints (
+    thread_id TEXT NOT NULL,
+    thread_ts TIMESTAMPTZ NOT NULL,
+    parent_ts TIMESTAMPTZ,
+    checkpoint BYTEA,
+    delta BOOLEAN NOT NULL DEFAULT false,
+    PRIMARY KEY (thread_id, thread_ts)
+);
+
+INSERT INTO checkpoints (thread_id, thread_ts, parent_ts, checkpoint, delta)
+SELECT thread_id, thread_ts, parent_ts, checkpoint, delta FROM checkpoints_partitioned;
+
+CREATE OR REPLACE FUNCTION checkpoints_sync_partitioned() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM checkpoints_partitioned
+        WHERE thread_id = OLD.thread_id AND thread_ts = OLD.thread_ts;
+        RETURN OLD;
+    END IF;
+    INSERT INTO checkpoints_partitioned (thread_id, thread_ts, parent_ts, checkpoint, delta)
+    VALUES (NEW.thread_id, NEW.thread_ts, NEW.parent_ts, NEW.checkpoint, NEW.delta)
+    ON CONFLICT (thread_id, thread_ts)
+    DO UPDATE SET parent_ts = EXCLUDED.parent_ts, checkpoint = EXCLUDED.checkpoint, delta = EXCLUDED.delta;
+    RETURN NEW;
+END $$;
+
+DROP TRIGGER IF EXISTS checkpoints_sync_partitioned ON checkpoints;
+CREATE TRIGGER checkpoints_sync_partitioned
+    AFTER INSERT OR UPDATE OR DELETE ON checkpoints
+    FOR EACH ROW EXECUTE FUNCTION checkpoints_sync_partitioned();
+
+-- Everything is copied already.
+CREATE TABLE checkpoints_copy_progress (
+    thread_id TEXT,
+    thread_ts TIMESTAMPTZ
+);
+INSERT INTO checkpoints_copy_progress
+SELECT thread_id, thread_ts FROM checkpoints ORDER BY thread_id DESC, thread_ts DESC LIMIT 1;
+INSERT INTO checkpoints_copy_progress
+SELECT NULL, NULL
+WHERE NOT EXISTS (SELECT 1 FROM checkpoints_copy_progress);
+
+CREATE OR REPLACE PROCEDURE checkpoints_copy_batches(
+    batch_size INTEGER DEFAULT 10000,
+    pause FLOAT DEFAULT 0.01
+)
+LANGUAGE plpgsql AS $$
+DECLARE
+    last_id TEXT;
+    last_ts TIMESTAMPTZ;
+BEGIN
+    SELECT thread_id, thread_ts INTO last_id, last_ts FROM checkpoints_copy_progress;
+    LOOP
+        -- Rows written since the trigger was created are already there, and
+        -- may be newer than what is read here, so existing rows are kept.
+        WITH batch AS (
+            SELECT thread_id, thread_ts, parent_ts, checkpoint, delta
+            FROM checkpoints
+            WHERE last_id IS NULL OR (thread_id, thread_ts) > (last_id, last_ts)
+            ORDER BY thread_id, thread_ts
+            LIMIT batch_size
+        ), copied AS (
+            INSERT INTO checkpoints_partitioned (thread_id, thread_ts, parent_ts, checkpoint, delta)
+            SELECT * FROM batch
+            ON CONFLICT (thread_id, thread_ts) DO NOTHING
+        )
+        SELECT thread_id, thread_ts INTO last_id, last_ts
+        FROM batch
+        ORDER BY thread_id DESC, thread_ts DESC
+        LIMIT 1;
+        EXIT WHEN last_id IS NULL;
+        UPDATE checkpoints_copy_progress SET thread_id = last_id, thread_ts = last_ts;
+        COMMIT;
+        PERFORM pg_sleep(pause);
+    END LOOP;
+END $$;
@@ -0,0 +1,21 @@
+-- Makes the partitioned table created by the previous migration the
+-- checkpoints table. Rows that checkpoints_copy_batches has not copied yet
+-- are copied here, while writes are blocked, so on a large table call it
+-- first to keep this short.
+
+LOCK TABLE checkpoints IN ACCESS EXCLUSIVE MODE;
+
+INSERT INTO checkpoints_partitioned (thread_id, thread_ts, parent_ts, checkpoint, delta)
+SELECT c.thread_id, c.thread_ts, c.parent_ts, c.checkpoint, c.delta
+FROM checkpoints c, checkpoints_copy_progress p
+WHERE p.thread_id IS NULL OR (c.thread_id, c.thread_ts) > (p.thread_id, p.thread_ts)
+ON CONFLICT (thread_id, thread_ts) DO NOTHING;
+
+DROP PROCEDURE checkpoints_copy_batches;
+DROP TABLE checkpoints_copy_progress;
+DROP TRIGGER checkpoints_sync_partitioned ON checkpoints;
+DROP FUNCTION checkpoints_sync_partitioned;
+DROP TABLE checkpoints;
+
+ALTER TABLE checkpoints_partitioned RENAME TO checkpoints;
+ALTER INDEX checkpoints_partitioned_pkey RENAME TO checkpoints_pkey;
@@ -0,0 +1,7 @@
+-- Tool outputs stored once by PostgresCheckpoint and referenced by hash from
+-- checkpoints, instead of being repeated in every checkpoint of a thread.
+CREATE TABLE IF NOT EXISTS checkpoint_blobs (
+    hash TEXT PRIMARY KEY,
+    data BYTEA NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+);
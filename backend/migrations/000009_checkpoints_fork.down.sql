@@ -0,0 +1,4 @@
+DROP INDEX IF EXISTS checkpoints_forks_idx;
+
+ALTER TABLE checkpoints
+    DROP COLUMN IF EXISTS parent_thread_id;
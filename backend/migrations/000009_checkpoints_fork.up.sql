@@ -0,0 +1,9 @@
+-- Set on the first checkpoint of a thread forked from another one: parent_ts
+-- is then a checkpoint of that thread.
+ALTER TABLE checkpoints
+    ADD COLUMN IF NOT EXISTS parent_thread_id TEXT;
+
+-- Lets pruning find the checkpoints other threads were forked from.
+CREATE INDEX IF NOT EXISTS checkpoints_forks_idx
+    ON checkpoints (parent_thread_id, parent_ts)
+    WHERE parent_thread_id IS NOT NULL;
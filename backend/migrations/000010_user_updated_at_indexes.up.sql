@@ -0,0 +1,6 @@
+-- Keyset pagination of a user's threads and assistants, newest first.
+CREATE INDEX IF NOT EXISTS thread_user_id_updated_at_idx
+    ON thread (user_id, updated_at DESC, thread_id DESC);
+
+CREATE INDEX IF NOT EXISTS assistant_user_id_updated_at_idx
+    ON assistant (user_id, updated_at DESC, assistant_id DESC);
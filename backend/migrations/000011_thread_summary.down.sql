@@ -0,0 +1,4 @@
+ALTER TABLE thread
+    DROP COLUMN IF EXISTS last_message,
+    DROP COLUMN IF EXISTS message_count,
+    DROP COLUMN IF EXISTS last_run_at;
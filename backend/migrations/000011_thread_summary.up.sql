@@ -0,0 +1,7 @@
+-- A preview of each thread, kept in step with its latest checkpoint by
+-- PostgresCheckpoint, so thread lists don't have to read checkpoints.
+-- Existing threads are filled in by a background job at startup.
+ALTER TABLE thread
+    ADD COLUMN IF NOT EXISTS last_message TEXT,
+    ADD COLUMN IF NOT EXISTS message_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS last_run_at TIMESTAMP WITH TIME ZONE;
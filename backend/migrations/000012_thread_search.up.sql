@@ -0,0 +1,13 @@
+-- The text of the human and AI messages of each thread, indexed for full-text
+-- search. Written by PostgresCheckpoint as checkpoints are, and filled in for
+-- existing threads by a background job at startup.
+CREATE TABLE IF NOT EXISTS thread_search (
+    thread_id UUID NOT NULL REFERENCES thread(thread_id) ON DELETE CASCADE,
+    message_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED,
+    PRIMARY KEY (thread_id, message_id)
+);
+
+CREATE INDEX IF NOT EXISTS thread_search_tsv_idx ON thread_search USING GIN (tsv);
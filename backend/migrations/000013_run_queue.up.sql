@@ -0,0 +1,24 @@
+-- Runs created with POST /runs, queued until a worker process claims one
+-- with FOR UPDATE SKIP LOCKED. Status is one of pending, running, success or
+-- error. A running run whose worker stopped sending heartbeats is claimed
+-- again by another worker.
+CREATE TABLE IF NOT EXISTS run (
+    run_id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    thread_id UUID NOT NULL REFERENCES thread(thread_id) ON DELETE CASCADE,
+    user_id UUID NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    input BYTEA NOT NULL,
+    config JSONB NOT NULL,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP WITH TIME ZONE,
+    finished_at TIMESTAMP WITH TIME ZONE,
+    heartbeat_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Runs still to be done, oldest first.
+CREATE INDEX IF NOT EXISTS run_queue_idx
+    ON run (created_at) WHERE status IN ('pending', 'running');
+
+CREATE INDEX IF NOT EXISTS run_thread_id_idx ON run (thread_id);
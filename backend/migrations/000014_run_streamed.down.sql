@@ -0,0 +1 @@
+ALTER TABLE run DROP COLUMN IF EXISTS streamed;
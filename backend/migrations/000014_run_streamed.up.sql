@@ -0,0 +1,4 @@
+-- Runs streamed with POST /runs/stream are recorded too, so they can be
+-- cancelled. They are executed by the request that streams them, never by a
+-- queue worker.
+ALTER TABLE run ADD COLUMN IF NOT EXISTS streamed BOOLEAN NOT NULL DEFAULT false;
@@ -0,0 +1,2 @@
+DROP INDEX IF EXISTS checkpoints_blob_refs_null_idx;
+ALTER TABLE checkpoints DROP COLUMN IF EXISTS blob_refs;
@@ -0,0 +1,7 @@
+-- The offloaded tool outputs each checkpoint refers to, so that blobs no
+-- checkpoint refers to anymore can be deleted. Existing checkpoints are
+-- filled in by a background job at startup, until then no blob is deleted.
+ALTER TABLE checkpoints ADD COLUMN IF NOT EXISTS blob_refs TEXT[];
+UPDATE checkpoints SET blob_refs = '{}' WHERE checkpoint IS NULL;
+CREATE INDEX IF NOT EXISTS checkpoints_blob_refs_null_idx
+    ON checkpoints (thread_id) WHERE blob_refs IS NULL;
@@ -0,0 +1 @@
+DROP INDEX IF EXISTS run_thread_in_progress_idx;
@@ -0,0 +1,3 @@
+-- At most one run of a thread is in progress, whichever process started it.
+CREATE UNIQUE INDEX IF NOT EXISTS run_thread_in_progress_idx
+    ON run (thread_id) WHERE status IN ('running', 'cancelling');
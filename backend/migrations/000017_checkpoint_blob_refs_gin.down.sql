@@ -0,0 +1 @@
+DROP INDEX IF EXISTS checkpoints_blob_refs_idx;
@@ -0,0 +1,4 @@
+-- Finds the checkpoints that refer to a blob, so that collecting blobs checks
+-- each candidate blob instead of expanding the references of every checkpoint.
+CREATE INDEX IF NOT EXISTS checkpoints_blob_refs_idx
+    ON checkpoints USING GIN (blob_refs);
@@ -0,0 +1,5 @@
+-- The backfills that ran to completion, which later maintenance runs skip.
+CREATE TABLE IF NOT EXISTS backfill (
+    name TEXT PRIMARY KEY,
+    completed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
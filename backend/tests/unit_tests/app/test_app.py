@@ -1,10 +1,17 @@
 """Test the server and client together."""
 
+import base64
+import pickle
 from typing import Optional, Sequence
 from uuid import uuid4
 
 import asyncpg
+import orjson
+from langchain_core.messages import HumanMessage
+from langgraph.checkpoint.base import empty_checkpoint
 
+from app.agent import CHECKPOINTER
+from app.api.runs import AGENT_TYPES, _input_schema
 from tests.unit_tests.app.helpers import get_client
 
 
@@ -107,6 +114,30 @@ async def test_threads() -> None:
         assert response.status_code == 200
         assert response.json() == {"values": None, "next": []}
 
+        response = await client.get(
+            f"/threads/{tid}/history",
+            params={"metadata_only": True, "before": "2024-01-01T00:00:00+00:00"},
+            headers=headers,
+        )
+        assert response.status_code == 200
+        assert response.json() == []
+
+        response = await client.get(
+            f"/threads/{tid}/history", params={"before": "yesterday"}, headers=headers
+        )
+        assert response.status_code == 422
+
+        response = await client.post(
+            f"/threads/{tid}/fork", json={"thread_ts": "latest"}, headers=headers
+        )
+        assert response.status_code == 422
+        response = await client.post(
+            f"/threads/{tid}/fork",
+            json={"thread_ts": "2024-01-01T00:00:00+00:00"},
+            headers=headers,
+        )
+        assert response.status_code == 404
+
         response = await client.get("/threads/", headers=headers)
 
         assert response.status_code == 200
@@ -118,6 +149,9 @@ async def test_threads() -> None:
                 "name": "bobby",
                 "thread_id": tid,
                 "metadata": {"assistant_type": "chatbot"},
+                "last_message": None,
+                "message_count": 0,
+                "last_run_at": None,
             }
         ]
 
@@ -126,3 +160,246 @@ async def test_threads() -> None:
             headers={"Cookie": "opengpts_user_id=2"},
         )
         assert response.status_code == 422
+
+
+async def test_list_threads_pages() -> None:
+    """Threads are listed newest first, in pages, with only some fields."""
+    headers = {"Cookie": "opengpts_user_id=3"}
+    aid = str(uuid4())
+    tids = [str(uuid4()) for _ in range(3)]
+
+    async with get_client() as client:
+        await client.put(
+            f"/assistants/{aid}",
+            json={"name": "assistant", "config": {}, "public": False},
+            headers=headers,
+        )
+        for tid in tids:
+            response = await client.put(
+                f"/threads/{tid}",
+                json={"name": tid, "assistant_id": aid},
+                headers=headers,
+            )
+            assert response.status_code == 200, response.text
+
+        response = await client.get(
+            "/threads/", params={"limit": 2, "fields": "name"}, headers=headers
+        )
+        assert response.status_code == 200, response.text
+        assert [_project(d, exclude_keys=["updated_at"]) for d in response.json()] == [
+            {"thread_id": tid, "name": tid} for tid in tids[::-1][:2]
+        ]
+
+        response = await client.get(
+            "/threads/",
+            params={"limit": 2, "cursor": response.headers["X-Next-Cursor"]},
+            headers=headers,
+        )
+        assert [d["thread_id"] for d in response.json()] == tids[:1]
+        assert "X-Next-Cursor" not in response.headers
+
+        response = await client.get(
+            "/threads/", params={"fields": "password"}, headers=headers
+        )
+        assert response.status_code == 422
+
+
+async def test_export_import_threads(pool: asyncpg.pool.Pool) -> None:
+    """Threads move between users with their history, and pickles are refused."""
+    headers = {"Cookie": "opengpts_user_id=6"}
+    aid, tid = str(uuid4()), str(uuid4())
+
+    async with get_client() as client:
+        await client.put(
+            f"/assistants/{aid}",
+            json={"name": "assistant", "config": {}, "public": False},
+            headers=headers,
+        )
+        await client.put(
+            f"/threads/{tid}",
+            json={"name": "exported", "assistant_id": aid},
+            headers=headers,
+        )
+        config = {"configurable": {"thread_id": tid}}
+        for i in range(2):
+            checkpoint = empty_checkpoint()
+            checkpoint["channel_values"] = {
+                "__root__": [HumanMessage(content=f"hi {j}") for j in range(i + 1)]
+            }
+            config = await CHECKPOINTER.aput(config, checkpoint)
+
+        response = await client.get("/threads/export", headers=headers)
+        assert response.status_code == 200, response.text
+        export = response.content
+        assert [orjson.loads(line)["type"] for line in export.splitlines()] == [
+            "header",
+            "thread",
+            "checkpoint",
+            "checkpoint",
+        ]
+
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM checkpoints")
+            await conn.execute("DELETE FROM thread")
+
+        other = {"Cookie": "opengpts_user_id=7"}
+        response = await client.post("/threads/import", content=export, headers=other)
+        assert response.status_code == 200, response.text
+        assert response.json() == {
+            "threads": 1,
+            "checkpoints": 2,
+            "blobs": 0,
+            "skipped_threads": 0,
+            "skipped_checkpoints": 0,
+        }
+        # again, nothing new
+        response = await client.post("/threads/import", content=export, headers=other)
+        assert response.json() == {
+            "threads": 0,
+            "checkpoints": 0,
+            "blobs": 0,
+            "skipped_threads": 1,
+            "skipped_checkpoints": 2,
+        }
+
+        response = await client.get(f"/threads/{tid}", headers=other)
+        assert response.json()["name"] == "exported"
+        # the assistant belongs to the exporting user
+        assert response.json()["assistant_id"] is None
+        state = await CHECKPOINTER.aget_tuple({"configurable": {"thread_id": tid}})
+        assert state.checkpoint["channel_values"]["__root__"] == [
+            HumanMessage(content="hi 0"),
+            HumanMessage(content="hi 1"),
+        ]
+
+        header, thread, line, _ = export.splitlines()
+        # the history of a thread the user already has is left alone
+        checkpoint = orjson.loads(line)
+        checkpoint["data"]["thread_ts"] = "2000-01-01T00:00:00+00:00"
+        response = await client.post(
+            "/threads/import",
+            content=b"\n".join([header, thread, orjson.dumps(checkpoint)]),
+            headers=other,
+        )
+        assert response.json()["skipped_checkpoints"] == 1
+
+        checkpoint["data"]["checkpoint"] = base64.b64encode(
+            pickle.dumps(empty_checkpoint())
+        ).decode()
+        response = await client.post(
+            "/threads/import",
+            content=b"\n".join([header, orjson.dumps(checkpoint)]),
+            headers=other,
+        )
+        assert response.status_code == 422
+
+
+async def test_search_threads() -> None:
+    """Threads are found by the text of their messages, best match first."""
+    headers = {"Cookie": "opengpts_user_id=8"}
+    tids = [str(uuid4()) for _ in range(3)]
+    texts = [
+        "how do I bake sourdough bread",
+        "bread, bread and more bread",
+        "unrelated question about taxes",
+    ]
+
+    aid = str(uuid4())
+
+    async with get_client() as client:
+        await client.put(
+            f"/assistants/{aid}",
+            json={"name": "assistant", "config": {}, "public": False},
+            headers=headers,
+        )
+        for tid, text in zip(tids, texts):
+            await client.put(
+                f"/threads/{tid}",
+                json={"name": text, "assistant_id": aid},
+                headers=headers,
+            )
+            checkpoint = empty_checkpoint()
+            checkpoint["channel_values"] = {
+                "__root__": [HumanMessage(content=text, id="m1")]
+            }
+            await CHECKPOINTER.aput({"configurable": {"thread_id": tid}}, checkpoint)
+
+        response = await client.get(
+            "/threads/search", params={"q": "bread", "limit": 1}, headers=headers
+        )
+        assert response.status_code == 200, response.text
+        assert [hit["thread_id"] for hit in response.json()] == [tids[1]]
+        assert "<b>bread</b>" in response.json()[0]["snippet"]
+
+        response = await client.get(
+            "/threads/search",
+            params={"q": "bread", "cursor": response.headers["X-Next-Cursor"]},
+            headers=headers,
+        )
+        assert [hit["thread_id"] for hit in response.json()] == [tids[0]]
+        assert "X-Next-Cursor" not in response.headers
+
+        # only the user's own threads
+        response = await client.get(
+            "/threads/search",
+            params={"q": "bread"},
+            headers={"Cookie": "opengpts_user_id=9"},
+        )
+        assert response.json() == []
+
+
+async def test_run_schemas() -> None:
+    """Schemas are built once, and runs are still validated against them."""
+    headers = {"Cookie": "opengpts_user_id=10"}
+    aid = str(uuid4())
+    tid = str(uuid4())
+
+    async with get_client() as client:
+        for kind in ("input", "output", "config"):
+            response = await client.get(f"/runs/{kind}_schema")
+            assert response.status_code == 200
+            assert response.json() == (await client.get(f"/runs/{kind}_schema")).json()
+
+        await client.put(
+            f"/assistants/{aid}",
+            json={
+                "name": "assistant",
+                "config": {"configurable": {"type": "chatbot"}},
+                "public": False,
+            },
+            headers=headers,
+        )
+        await client.put(
+            f"/threads/{tid}",
+            json={"name": "bobby", "assistant_id": aid},
+            headers=headers,
+        )
+        # the types are those of the agent, the default first
+        assert AGENT_TYPES == ("agent", "chatbot", "chat_retrieval")
+        hits = _input_schema.cache_info().hits
+        response = await client.post(
+            "/runs",
+            json={"thread_id": tid, "input": {"foo": "bar"}},
+            headers=headers,
+        )
+        assert response.status_code == 422
+        assert _input_schema.cache_info().hits == hits + 1
+
+
+async def test_metrics(monkeypatch) -> None:
+    """The heaviest threads are only listed for the metrics token."""
+    monkeypatch.setenv("METRICS_TOKEN", "secret")
+    async with get_client() as client:
+        response = await client.get("/metrics")
+        assert response.status_code == 200
+        assert list(response.json()["checkpoints"]) == ["operations"]
+
+        response = await client.get(
+            "/metrics", headers={"Authorization": "Bearer wrong"}
+        )
+        assert list(response.json()["checkpoints"]) == ["operations"]
+
+        response = await client.get(
+            "/metrics", headers={"Authorization": "Bearer secret"}
+        )
+        assert "top_threads_by_bytes" in response.json()["checkpoints"]
@@ -1,9 +1,15 @@
+import json
+import threading
 from base64 import b64encode
 from datetime import datetime, timedelta, timezone
-from typing import Optional
-from unittest.mock import MagicMock, patch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Optional
+from unittest.mock import patch
 
 import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
 
 from app.auth.handlers import AuthedUser, get_auth_handler
 from app.auth.settings import (
@@ -23,6 +29,63 @@ async def me(user: AuthedUser) -> dict:
     return user
 
 
+class _JWKSServer(ThreadingHTTPServer):
+    """Local stand-in for an OIDC issuer, serving discovery and its JWKS."""
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), _JWKSRequestHandler)
+        self.issuer = f"http://127.0.0.1:{self.server_address[1]}"
+        self.keys: dict[str, rsa.RSAPrivateKey] = {}
+        self.requests: list[str] = []
+
+    def add_key(self, kid: str) -> rsa.RSAPrivateKey:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.keys[kid] = key
+        return key
+
+
+class _JWKSRequestHandler(BaseHTTPRequestHandler):
+    server: _JWKSServer
+
+    def do_GET(self) -> None:
+        self.server.requests.append(self.path)
+        if self.path == "/.well-known/openid-configuration":
+            issuer = self.server.issuer
+            body = {"issuer": issuer, "jwks_uri": f"{issuer}/jwks"}
+        elif self.path == "/jwks":
+            body = {
+                "keys": [
+                    {
+                        **json.loads(RSAAlgorithm.to_jwk(key.public_key())),
+                        "kid": kid,
+                        "use": "sig",
+                        "alg": "RS256",
+                    }
+                    for kid, key in self.server.keys.items()
+                ]
+            }
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode())
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def jwks_server() -> Iterator[_JWKSServer]:
+    server = _JWKSServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
 def _create_jwt(
     key: str, alg: str, payload: dict, headers: Optional[dict] = None
 ) -> str:
@@ -68,41 +131,82 @@ async def test_jwt_local():
         assert response.status_code == 200
         assert response.json()["sub"] == sub
 
+    # Verified tokens aren't verified again
+    with patch.object(get_auth_handler(), "decode_token", side_effect=AssertionError):
+        async with get_client() as client:
+            response = await client.get(
+                "/me", headers={"Authorization": f"Bearer {token}"}
+            )
+            assert response.status_code == 200
+
     # Test invalid token
     async with get_client() as client:
         response = await client.get("/me", headers={"Authorization": "Bearer xyz"})
         assert response.status_code == 401
 
 
-async def test_jwt_oidc():
+async def test_jwt_oidc(jwks_server: _JWKSServer):
     get_auth_handler.cache_clear()
     auth_settings.auth_type = AuthType.JWT_OIDC
-    auth_settings.jwt_oidc = JWTSettingsOIDC(iss="issuer", aud="audience")
-    sub = "user_jwt_oidc"
-    key = "key"
-    alg = "HS256"
-
-    token = _create_jwt(
-        key=key,
-        alg=alg,
-        payload={
-            "sub": sub,
-            "iss": auth_settings.jwt_oidc.iss,
-            "aud": auth_settings.jwt_oidc.aud,
-            "exp": datetime.now(timezone.utc) + timedelta(days=1),
-        },
-        headers={"kid": "kid", "alg": alg},
+    auth_settings.jwt_oidc = JWTSettingsOIDC(
+        iss=jwks_server.issuer, aud="audience", jwks_min_refetch_interval=0
     )
+    sub = "user_jwt_oidc"
+    alg = "RS256"
+    payload = {
+        "sub": sub,
+        "iss": auth_settings.jwt_oidc.iss,
+        "aud": auth_settings.jwt_oidc.aud,
+        "exp": datetime.now(timezone.utc) + timedelta(days=1),
+    }
+    key = jwks_server.add_key("kid")
+    token = _create_jwt(key=key, alg=alg, payload=payload, headers={"kid": "kid"})
+
+    # keys are fetched at startup
+    handler = get_auth_handler()
+    await handler.start()
+    try:
+        assert jwks_server.requests == ["/.well-known/openid-configuration", "/jwks"]
 
-    mock_jwk_client = MagicMock()
-    mock_jwk_client.get_signing_key.return_value = MagicMock(key=key)
-
-    with patch(
-        "app.auth.handlers.JWTAuthOIDC._get_jwk_client", return_value=mock_jwk_client
-    ):
         async with get_client() as client:
             response = await client.get(
                 "/me", headers={"Authorization": f"Bearer {token}"}
             )
             assert response.status_code == 200
             assert response.json()["sub"] == sub
+        assert len(jwks_server.requests) == 2
+
+        # a rotated in key is fetched on first use
+        key = jwks_server.add_key("rotated")
+        token = _create_jwt(
+            key=key, alg=alg, payload=payload, headers={"kid": "rotated"}
+        )
+        async with get_client() as client:
+            response = await client.get(
+                "/me", headers={"Authorization": f"Bearer {token}"}
+            )
+            assert response.status_code == 200
+        assert jwks_server.requests[2:] == ["/jwks"]
+
+        # unknown keys and other issuers are rejected
+        token = _create_jwt(
+            key=rsa.generate_private_key(public_exponent=65537, key_size=2048),
+            alg=alg,
+            payload=payload,
+            headers={"kid": "unknown"},
+        )
+        other = _create_jwt(
+            key=key,
+            alg=alg,
+            payload={**payload, "iss": "http://127.0.0.1:1"},
+            headers={"kid": "rotated"},
+        )
+        async with get_client() as client:
+            for bad in (token, other):
+                response = await client.get(
+                    "/me", headers={"Authorization": f"Bearer {bad}"}
+                )
+                assert response.status_code == 401
+        assert jwks_server.requests[3:] == ["/jwks"]
+    finally:
+        await handler.stop()
@@ -0,0 +1,93 @@
+"""Test the assistant cache."""
+
+import asyncio
+from unittest.mock import patch
+from uuid import uuid4
+
+import asyncpg
+
+import app.storage as storage
+from app.cache import TTLCache
+
+
+def test_ttl_cache_entry_ttl() -> None:
+    """Entries expire at their own TTL when it is below the cache's."""
+    cache: TTLCache[str, int] = TTLCache(ttl=60)
+    with patch("app.cache.time.monotonic", return_value=100):
+        cache.set("short", 1, ttl=5)
+        cache.set("long", 2, ttl=600)
+        cache.set("expired", 3, ttl=-1)
+    with patch("app.cache.time.monotonic", return_value=110):
+        assert cache.get("short") is None
+        assert cache.get("long") == 2
+        assert cache.get("expired") is None
+    with patch("app.cache.time.monotonic", return_value=161):
+        assert cache.get("long") is None
+
+
+async def test_assistant_cache(pool: asyncpg.pool.Pool) -> None:
+    """Assistants are served from memory until written anywhere."""
+    user_id, _ = await storage.get_or_create_user("cache-user")
+    user_id = str(user_id["user_id"])
+    aid = str(uuid4())
+    await storage.put_assistant(user_id, aid, name="a", config={})
+
+    assert (await storage.get_assistant(user_id, aid))["name"] == "a"
+    assert await storage.get_assistant(str(uuid4()), aid) is None
+
+    # written without telling the cache
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE assistant SET name = 'b' WHERE assistant_id = $1", aid
+        )
+    assert (await storage.get_assistant(user_id, aid))["name"] == "a"
+
+    # written by another process
+    async with pool.acquire() as conn:
+        await conn.execute("SELECT pg_notify('assistants', $1)", f"other:{aid}")
+    for _ in range(50):
+        if (await storage.get_assistant(user_id, aid))["name"] == "b":
+            break
+        await asyncio.sleep(0.01)
+    assert (await storage.get_assistant(user_id, aid))["name"] == "b"
+
+    await storage.put_assistant(user_id, aid, name="c", config={}, public=True)
+    assert (await storage.get_assistant(str(uuid4()), aid))["name"] == "c"
+
+    await storage.delete_assistant(user_id, aid)
+    assert await storage.get_assistant(user_id, aid) is None
+
+
+async def test_get_or_create_user(pool: asyncpg.pool.Pool) -> None:
+    """Users are created once and then served from memory."""
+    sub = str(uuid4())
+    results = await asyncio.gather(*(storage.get_or_create_user(sub) for _ in range(5)))
+    assert sum(created for _, created in results) == 1
+    assert len({str(user["user_id"]) for user, _ in results}) == 1
+
+    async with pool.acquire() as conn:
+        await conn.execute('DELETE FROM "user" WHERE sub = $1', sub)
+    user, created = await storage.get_or_create_user(sub)
+    assert not created
+    assert user == results[0][0]
+
+
+async def test_assistant_cache_listener_reconnects(pool: asyncpg.pool.Pool) -> None:
+    """The cache is off while its listener is down, and back once it reconnects."""
+    cache = storage.ASSISTANT_CACHE
+    assert cache.enabled
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "SELECT pg_terminate_backend($1)",
+            cache._listener._conn.get_server_pid(),
+        )
+    for _ in range(100):
+        if not cache.enabled:
+            break
+        await asyncio.sleep(0.05)
+    assert not cache.enabled
+    for _ in range(100):
+        if cache.enabled:
+            break
+        await asyncio.sleep(0.05)
+    assert cache.enabled
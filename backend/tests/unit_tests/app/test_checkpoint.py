@@ -0,0 +1,463 @@
+"""Test the postgres checkpointer."""
+
+import asyncio
+from datetime import datetime, timedelta
+from typing import Optional
+from unittest.mock import patch
+from uuid import uuid4
+
+import asyncpg
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.base import empty_checkpoint
+
+import app.storage as storage
+from app.backfill import BackfillSettings, _run, backfill_summaries
+from app.checkpoint import CONFIG_KEY_LIMIT, SUMMARY_SNIPPET_LENGTH, PostgresCheckpoint
+from app.message_types import LiberalToolMessage
+from app.metrics import CheckpointMetrics
+
+
+def _checkpoint(messages: list, version: int) -> dict:
+    checkpoint = empty_checkpoint()
+    checkpoint["channel_values"] = {"__root__": messages}
+    checkpoint["channel_versions"]["__root__"] = version
+    return checkpoint
+
+
+async def test_delta_checkpoints(pool: asyncpg.pool.Pool) -> None:
+    """Deltas are written between snapshots and read back as full checkpoints."""
+    saver = PostgresCheckpoint(delta=True, snapshot_interval=3)
+    thread_id = str(uuid4())
+    config = {"configurable": {"thread_id": thread_id}}
+
+    messages = []
+    for i in range(5):
+        messages = messages + [HumanMessage(content=f"hi {i}"), AIMessage(content="yo")]
+        config = await saver.aput(config, _checkpoint(messages, i + 1))
+
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT delta FROM checkpoints WHERE thread_id = $1 ORDER BY thread_ts",
+            thread_id,
+        )
+    assert [r["delta"] for r in rows] == [False, True, True, False, True]
+
+    saver._latest.clear()
+    latest = await saver.aget_tuple({"configurable": {"thread_id": thread_id}})
+    assert latest.checkpoint["channel_values"]["__root__"] == messages
+
+    history = [c async for c in saver.alist({"configurable": {"thread_id": thread_id}})]
+    assert [len(c.checkpoint["channel_values"]["__root__"]) for c in history] == [
+        10,
+        8,
+        6,
+        4,
+        2,
+    ]
+    assert history[1].parent_config == history[2].config
+
+
+async def test_latest_checkpoint_cache(pool: asyncpg.pool.Pool) -> None:
+    """Latest checkpoints are served from memory and evicted on remote writes."""
+    saver = PostgresCheckpoint(cache_latest=True, notify=True)
+    other = PostgresCheckpoint(notify=True)
+    await saver.start_listener()
+    try:
+        thread_id = str(uuid4())
+        config = {"configurable": {"thread_id": thread_id}}
+        written = await saver.aput(config, _checkpoint([HumanMessage(content="hi")], 1))
+
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "DELETE FROM checkpoints WHERE thread_id = $1", thread_id
+            )
+        cached = await saver.aget_tuple(config)
+        assert cached.checkpoint["ts"] == written["configurable"]["thread_ts"]
+
+        written = await other.aput(config, _checkpoint([AIMessage(content="yo")], 2))
+        for _ in range(50):
+            if thread_id not in saver._latest:
+                break
+            await asyncio.sleep(0.01)
+        latest = await saver.aget_tuple(config)
+        assert latest.checkpoint["ts"] == written["configurable"]["thread_ts"]
+    finally:
+        await saver.stop_listener()
+
+
+async def test_list_pages(pool: asyncpg.pool.Pool) -> None:
+    """alist can be paged with limit and a thread_ts cursor."""
+    saver = PostgresCheckpoint()
+    config = {"configurable": {"thread_id": str(uuid4())}}
+    for i in range(5):
+        config = await saver.aput(config, _checkpoint([HumanMessage(content="hi")], i))
+
+    pages, before = [], None
+    while page := [c async for c in saver.alist(config, before=before, limit=2)]:
+        pages.append(page)
+        before = page[-1].config["configurable"]["thread_ts"]
+    assert [len(page) for page in pages] == [2, 2, 1]
+
+    listed = [
+        c
+        async for c in saver.alist(
+            {"configurable": {**config["configurable"], CONFIG_KEY_LIMIT: 1}},
+            metadata_only=True,
+        )
+    ]
+    assert listed[0].config == pages[0][0].config
+    # messages are left serialized
+    assert isinstance(listed[0].checkpoint["channel_values"]["__root__"][0], dict)
+
+
+async def test_list_metadata(pool: asyncpg.pool.Pool) -> None:
+    """alist_metadata lists parents, delta flags and blob sizes."""
+    saver = PostgresCheckpoint(delta=True)
+    thread_id = str(uuid4())
+    config = {"configurable": {"thread_id": thread_id}}
+    messages = []
+    for i in range(3):
+        messages = messages + [HumanMessage(content=f"hi {i}")]
+        config = await saver.aput(config, _checkpoint(messages, i + 1))
+
+    rows = await saver.alist_metadata(thread_id)
+    assert [r["delta"] for r in rows] == [True, True, False]
+    assert [r["parent_ts"] for r in rows[:2]] == [r["thread_ts"] for r in rows[1:]]
+    async with pool.acquire() as conn:
+        sizes = await conn.fetch(
+            "SELECT octet_length(checkpoint) AS size FROM checkpoints "
+            "WHERE thread_id = $1 ORDER BY thread_ts DESC",
+            thread_id,
+        )
+    assert [r["size"] for r in rows] == [r["size"] for r in sizes]
+
+    older = await saver.alist_metadata(thread_id, before=rows[0]["thread_ts"], limit=1)
+    assert [r["thread_ts"] for r in older] == [rows[1]["thread_ts"]]
+
+
+async def test_history_read_your_writes(pool: asyncpg.pool.Pool) -> None:
+    """History is read from a replica only if it has every write to the thread."""
+    saver = PostgresCheckpoint(write_behind=True, notify=True)
+    await saver.start_listener()
+    thread_id = str(uuid4())
+    config = {"configurable": {"thread_id": thread_id}}
+    config = await saver.aput(config, _checkpoint([HumanMessage(content="hi")], 1))
+    await saver.aflush(thread_id)
+    written = saver._written[thread_id]
+
+    with patch("app.checkpoint.get_pg_read_pool", return_value=object()) as read:
+        # the checkpoint was only just flushed
+        assert saver._history_pool(thread_id, True) is pool
+        assert saver._history_pool(thread_id, False) is read.return_value
+        read.assert_called_with(since=written)
+        # writes by other processes are seen through their notifications
+        saver._on_notify(None, 0, "", f"other:{thread_id}")
+        saver._history_pool(thread_id, False)
+        assert read.call_args.kwargs["since"] > written
+
+        await saver.stop_listener()
+        assert saver._history_pool(thread_id, False) is pool
+    history = [c async for c in saver.alist(config)]
+    assert len(history) == 1
+
+
+async def test_prune(pool: asyncpg.pool.Pool) -> None:
+    """Pruning keeps the newest checkpoints and branch points readable."""
+    saver = PostgresCheckpoint(delta=True, snapshot_interval=10)
+    thread_id = str(uuid4())
+    config = {"configurable": {"thread_id": thread_id}}
+
+    messages, configs = [], []
+    for i in range(6):
+        messages = messages + [HumanMessage(content=f"hi {i}")]
+        config = await saver.aput(config, _checkpoint(messages, i + 1))
+        configs.append(config)
+    # fork from the second checkpoint, making it a branch point
+    await saver.aput(configs[1], _checkpoint([AIMessage(content="fork")], 9))
+
+    deleted = await saver.aprune(thread_id, keep_last=2, min_age=timedelta(0))
+    assert deleted == 4
+
+    saver._latest.clear()
+    history = [c async for c in saver.alist({"configurable": {"thread_id": thread_id}})]
+    assert [len(c.checkpoint["channel_values"]["__root__"]) for c in history] == [
+        1,
+        6,
+        2,
+    ]
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT delta FROM checkpoints WHERE thread_id = $1 ORDER BY thread_ts",
+            thread_id,
+        )
+    assert [r["delta"] for r in rows] == [False, False, False]
+
+    # a delta against a base pruned by someone else is stored as a snapshot
+    await saver.aget_tuple({"configurable": {"thread_id": thread_id}})
+    async with pool.acquire() as conn:
+        await conn.execute("DELETE FROM checkpoints WHERE thread_id = $1", thread_id)
+    config = await saver.aput(
+        {"configurable": {"thread_id": thread_id}}, _checkpoint(messages, 10)
+    )
+    saver._latest.clear()
+    latest = await saver.aget_tuple(config)
+    assert latest.checkpoint["channel_values"]["__root__"] == messages
+
+
+async def test_write_behind(pool: asyncpg.pool.Pool) -> None:
+    """Queued checkpoints are written in one batch and before reads."""
+    saver = PostgresCheckpoint(delta=True, write_behind=True, write_behind_max=4)
+    thread_id = str(uuid4())
+    config = {"configurable": {"thread_id": thread_id}}
+
+    async def count() -> int:
+        async with pool.acquire() as conn:
+            return await conn.fetchval(
+                "SELECT count(*) FROM checkpoints WHERE thread_id = $1", thread_id
+            )
+
+    messages = []
+    for i in range(6):
+        messages = messages + [HumanMessage(content=f"hi {i}")]
+        config = await saver.aput(config, _checkpoint(messages, i + 1))
+        assert await count() == (4 if i >= 3 else 0)
+
+    await saver.aflush(thread_id)
+    assert await count() == 6
+
+    # the first queued delta is rewritten as a snapshot if its base is gone
+    await saver.aput(config, _checkpoint(messages, 7))
+    async with pool.acquire() as conn:
+        await conn.execute("DELETE FROM checkpoints WHERE thread_id = $1", thread_id)
+    config = await saver.aput(config, _checkpoint(messages[:1], 8))
+    saver._latest.clear()
+    history = [c async for c in saver.alist(config)]
+    assert [len(c.checkpoint["channel_values"]["__root__"]) for c in history] == [
+        1,
+        6,
+    ]
+
+
+async def test_search_index_marked_after_write(pool: asyncpg.pool.Pool) -> None:
+    """Messages count as indexed only once the index is written."""
+    saver = PostgresCheckpoint(search=True, write_behind=True)
+    thread_id = str(uuid4())
+    config = {"configurable": {"thread_id": thread_id}}
+    messages = [HumanMessage(content="hi", id="1")]
+    await saver.aput(config, _checkpoint(messages, 1))
+    messages = messages + [AIMessage(content="yo", id="2")]
+    await saver.aput(config, _checkpoint(messages, 2))
+    assert thread_id not in saver._indexed
+    assert saver._pending[thread_id].search == {"1": "hi", "2": "yo"}
+
+    with patch("app.checkpoint._SEARCH_INDEX", "SELECT no_such_function()"):
+        with pytest.raises(asyncpg.PostgresError):
+            await saver.aflush(thread_id)
+    assert thread_id not in saver._indexed
+    search, _ = saver._unindexed(thread_id, _checkpoint(messages, 2))
+    assert search == {"1": "hi", "2": "yo"}
+
+    await saver.aput(config, _checkpoint(messages, 3))
+    await saver.aflush(thread_id)
+    assert set(saver._indexed[thread_id]) == {"1", "2"}
+
+
+async def test_metrics(pool: asyncpg.pool.Pool) -> None:
+    """Reads and writes are recorded per operation and per thread."""
+    metrics = CheckpointMetrics()
+    saver = PostgresCheckpoint(metrics=metrics)
+    thread_id = str(uuid4())
+    config = {"configurable": {"thread_id": thread_id}}
+    messages = [HumanMessage(content="hi"), AIMessage(content="hello")]
+    config = await saver.aput(config, _checkpoint(messages, 1))
+    await saver.aget_tuple({"configurable": {"thread_id": thread_id}})
+    assert len([c async for c in saver.alist(config)]) == 1
+
+    snapshot = metrics.snapshot()
+    operations = snapshot["operations"]
+    assert {op: totals["count"] for op, totals in operations.items()} == {
+        "put": 1,
+        "get": 1,
+        "list": 1,
+    }
+    assert operations["put"]["bytes"] == operations["get"]["bytes"] > 0
+    assert operations["get"]["messages"] == 2
+    assert operations["put"]["db_ms"] > 0
+    [thread] = snapshot["top_threads_by_bytes"]
+    assert thread["thread_id"] == thread_id
+    assert thread["count"] == 3
+
+
+async def test_offload_tool_outputs(pool: asyncpg.pool.Pool) -> None:
+    """Large tool outputs are stored once and read back transparently."""
+    saver = PostgresCheckpoint(offload_threshold=1000)
+    thread_id = str(uuid4())
+    config = {"configurable": {"thread_id": thread_id}}
+    messages = [
+        HumanMessage(content="search"),
+        LiberalToolMessage(tool_call_id="1", name="search", content=["x" * 5000]),
+    ]
+    config = await saver.aput(config, _checkpoint(messages, 1))
+    messages = messages + [AIMessage(content="found it")]
+    config = await saver.aput(config, _checkpoint(messages, 2))
+
+    async with pool.acquire() as conn:
+        assert await conn.fetchval("SELECT count(*) FROM checkpoint_blobs") == 1
+        sizes = await conn.fetch(
+            "SELECT octet_length(checkpoint) FROM checkpoints WHERE thread_id = $1",
+            thread_id,
+        )
+    assert all(size[0] < 1000 for size in sizes)
+
+    latest = await saver.aget_tuple({"configurable": {"thread_id": thread_id}})
+    assert latest.checkpoint["channel_values"]["__root__"] == messages
+    history = [c async for c in saver.alist(config)]
+    assert history[1].checkpoint["channel_values"]["__root__"] == messages[:2]
+    # metadata-only listing doesn't read the blobs
+    [raw, _] = [c async for c in saver.alist(config, metadata_only=True)]
+    tool_message = raw.checkpoint["channel_values"]["__root__"][1]
+    assert tool_message["__v"]["content"]["__t"] == "BlobRef"
+
+
+async def test_collect_blobs(pool: asyncpg.pool.Pool) -> None:
+    """Blobs are deleted once no checkpoint refers to them."""
+    saver = PostgresCheckpoint(offload_threshold=1000, blob_recheck_interval=0)
+    thread_id = str(uuid4())
+    config = {"configurable": {"thread_id": thread_id}}
+    messages = [
+        HumanMessage(content="search"),
+        LiberalToolMessage(tool_call_id="1", name="search", content=["x" * 5000]),
+    ]
+    config = await saver.aput(config, _checkpoint(messages, 1))
+    config = await saver.aput(config, _checkpoint([AIMessage(content="hi")], 2))
+
+    # the first checkpoint still refers to it
+    assert await saver.acollect_blobs(min_age=timedelta(0)) == 0
+    assert await saver.aprune(thread_id, keep_last=1, min_age=timedelta(0)) == 1
+    # checkpoints written before references were kept hold collection back
+    async with pool.acquire() as conn:
+        await conn.execute("UPDATE checkpoints SET blob_refs = NULL")
+    assert await saver.acollect_blobs(min_age=timedelta(0)) == 0
+    assert await saver.abackfill_blob_refs(10) == 1
+    assert await saver.acollect_blobs(min_age=timedelta(0)) == 1
+    async with pool.acquire() as conn:
+        assert await conn.fetchval("SELECT count(*) FROM checkpoint_blobs") == 0
+
+
+async def test_fork(pool: asyncpg.pool.Pool) -> None:
+    """Forks read through to the source thread, which keeps what they need."""
+    saver = PostgresCheckpoint(delta=True)
+    source_id, fork_id = str(uuid4()), str(uuid4())
+    config = {"configurable": {"thread_id": source_id}}
+    messages, configs = [], []
+    for i in range(3):
+        messages = messages + [HumanMessage(content=f"hi {i}")]
+        config = await saver.aput(config, _checkpoint(messages, i + 1))
+        configs.append(config)
+
+    forked = await saver.afork(
+        source_id, fork_id, configs[1]["configurable"]["thread_ts"]
+    )
+    missing = await saver.afork(source_id, str(uuid4()), "2000-01-01T00:00:00+00:00")
+    assert missing is None
+    latest = await saver.aget_tuple({"configurable": {"thread_id": fork_id}})
+    assert latest.config == forked
+    assert latest.parent_config["configurable"] == {
+        "thread_id": source_id,
+        "thread_ts": datetime.fromisoformat(configs[1]["configurable"]["thread_ts"]),
+    }
+    assert latest.checkpoint["channel_values"]["__root__"] == messages[:2]
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT checkpoint FROM checkpoints WHERE thread_id = $1", fork_id
+        )
+    assert row["checkpoint"] is None
+
+    fork_messages = messages[:2] + [AIMessage(content="forked")]
+    await saver.aput(forked, _checkpoint(fork_messages, 9))
+    await saver.aprune(source_id, keep_last=0, min_age=timedelta(0))
+    rows = await saver.alist_metadata(fork_id)
+    assert [r["parent_thread_id"] for r in rows] == [None, source_id]
+
+    saver._latest.clear()
+    history = [c async for c in saver.alist({"configurable": {"thread_id": fork_id}})]
+    assert [c.checkpoint["channel_values"]["__root__"] for c in history] == [
+        fork_messages,
+        messages[:2],
+    ]
+
+
+async def test_thread_summary(pool: asyncpg.pool.Pool) -> None:
+    """The thread row follows the latest checkpoint, and is backfilled."""
+    user, _ = await storage.get_or_create_user("summary-user")
+    user_id = str(user["user_id"])
+    thread_id = str(uuid4())
+    await storage.put_thread(user_id, thread_id, assistant_id=None, name="t")
+
+    async def _row() -> dict:
+        async with pool.acquire() as conn:
+            return await conn.fetchrow(
+                "SELECT last_message, message_count, last_run_at FROM thread "
+                "WHERE thread_id = $1",
+                thread_id,
+            )
+
+    saver = PostgresCheckpoint(summarize=True)
+    config = {"configurable": {"thread_id": thread_id}}
+    old = _checkpoint([HumanMessage(content="hi")], 1)
+    config = await saver.aput(config, old)
+    long = "a  long\nanswer " * 100
+    latest = _checkpoint([HumanMessage(content="hi"), AIMessage(content=long)], 2)
+    await saver.aput(config, latest)
+    row = await _row()
+    assert row["last_message"] == " ".join(long.split())[:SUMMARY_SNIPPET_LENGTH]
+    assert row["message_count"] == 2
+    assert row["last_run_at"] == datetime.fromisoformat(latest["ts"])
+
+    # written late, and older than the summary
+    await saver.aput({"configurable": {"thread_id": thread_id}}, old)
+    assert (await _row())["message_count"] == 2
+
+    queued = PostgresCheckpoint(summarize=True, write_behind=True)
+    newest = _checkpoint([AIMessage(content="bye")], 3)
+    await queued.aput(config, newest)
+    assert (await _row())["message_count"] == 2
+    await queued.aflush()
+    assert (await _row())["last_message"] == "bye"
+
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE thread SET last_message = NULL, message_count = 0, "
+            "last_run_at = NULL"
+        )
+    assert await backfill_summaries(saver, BackfillSettings(pause=0)) == 1
+    assert (await _row())["last_message"] == "bye"
+
+
+async def test_backfill_runs_once(pool: asyncpg.pool.Pool) -> None:
+    """Completed backfills are recorded, and skipped by later runs."""
+    assert not BackfillSettings().enabled
+    user, _ = await storage.get_or_create_user("backfill-user")
+    thread_id = str(uuid4())
+    await storage.put_thread(
+        str(user["user_id"]), thread_id, assistant_id=None, name="t"
+    )
+    saver = PostgresCheckpoint(summarize=True, search=False)
+    config = {"configurable": {"thread_id": thread_id}}
+    await saver.aput(config, _checkpoint([HumanMessage(content="hi")], 1))
+
+    async def _backfill() -> Optional[str]:
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE thread SET last_message = NULL, last_run_at = NULL"
+            )
+        await _run(saver, BackfillSettings(enabled=True, pause=0))
+        async with pool.acquire() as conn:
+            return await conn.fetchval("SELECT last_message FROM thread")
+
+    assert await _backfill() == "hi"
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("SELECT name FROM backfill ORDER BY name")
+    assert [row["name"] for row in rows] == ["blob_refs", "summaries"]
+    assert await _backfill() is None
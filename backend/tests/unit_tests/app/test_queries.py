@@ -0,0 +1,44 @@
+"""Test the prepared query registry."""
+
+from datetime import datetime, timezone
+from uuid import uuid4
+
+import asyncpg
+import pytest
+
+import app.storage as storage
+from app.checkpoint import _CHAIN_LATEST, _SUMMARY
+from app.queries import PreparedConnection, register
+
+
+def test_register() -> None:
+    assert register("get_thread", storage._GET_THREAD) == storage._GET_THREAD
+    with pytest.raises(ValueError):
+        register("get_thread", "SELECT 1")
+
+
+async def test_prepared_queries(pool: asyncpg.pool.Pool) -> None:
+    """Registered queries run through the statements prepared for them."""
+    async with pool.acquire() as conn:
+        conn = conn._con
+        assert isinstance(conn, PreparedConnection)
+        assert _CHAIN_LATEST in conn._prepared
+        assert storage._GET_OR_CREATE_USER in conn._prepared
+        assert await conn.fetch(_CHAIN_LATEST, "missing") == []
+        now = datetime.now(timezone.utc)
+        assert await conn.execute(_SUMMARY, uuid4(), None, 0, now) == "UPDATE 0"
+        assert conn._prepared[_SUMMARY].get_statusmsg() == "UPDATE 0"
+
+    user, created = await storage.get_or_create_user("prepared-user")
+    assert created
+    assert (await storage.get_or_create_user("prepared-user"))[0] == user
+
+    # the schema changed under the prepared statement
+    async with pool.acquire() as conn:
+        await conn.execute('ALTER TABLE "user" ADD COLUMN extra TEXT')
+        try:
+            assert await conn.fetchrow(storage._GET_THREAD, uuid4(), uuid4()) is None
+            row = await conn.fetchrow(storage._GET_OR_CREATE_USER, "prepared-user")
+            assert "extra" in row
+        finally:
+            await conn.execute('ALTER TABLE "user" DROP COLUMN extra')
@@ -0,0 +1,36 @@
+"""Test read replica routing."""
+
+import asyncpg
+
+from app.lifespan import get_pg_read_pool
+from app.replicas import ReplicaSet, ReplicaSettings
+
+
+async def test_replica_set(pool: asyncpg.pool.Pool) -> None:
+    """Reads go to the replicas that are close enough behind, in turn."""
+    assert get_pg_read_pool() is pool
+    settings = ReplicaSettings(hosts="")
+    assert (
+        await ReplicaSet.create(settings, primary=pool, default_port="", connect=None)
+        is None
+    )
+
+    a, b, c = object(), object(), object()
+    replicas = ReplicaSet([a, b, c], primary=pool, max_lag=5, check_interval=1)
+    assert replicas.pick() is None
+
+    replicas.lags = [0, 10, 2.5]
+    assert {replicas.pick() for _ in range(4)} == {a, c}
+
+    # only replicas that caught up with the primary since have a write
+    replicas.synced = [1.0, 3.0, 2.0]
+    assert {replicas.pick(since=1.5) for _ in range(4)} == {c}
+    assert replicas.pick(since=2.0) is None
+
+    replicas.lags = [None, 10, None]
+    assert replicas.pick() is None
+
+    # the primary is not in recovery, so it isn't taken for a replica
+    replicas = ReplicaSet([pool], primary=pool, max_lag=5, check_interval=1)
+    await replicas.check()
+    assert replicas.lags == [None]
@@ -0,0 +1,296 @@
+"""Test the run queue."""
+
+import asyncio
+from uuid import uuid4
+
+import asyncpg
+import pytest
+from langchain_core.messages import HumanMessage
+
+import app.storage as storage
+from app.run_queue import RunQueue, RunQueueFull, RunSettings, ThreadBusy
+from app.thread_locks import ThreadLocks
+from tests.unit_tests.app.helpers import get_client
+
+
+async def _wait_for_status(queue: RunQueue, user_id: str, run_id: str, status: str):
+    for _ in range(100):
+        run = await queue.get(user_id, run_id)
+        if run["status"] == status:
+            return run
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"Run is {run['status']}, not {status}")
+
+
+async def test_runs_api() -> None:
+    """Runs are queued and visible to their user only."""
+    headers = {"Cookie": "opengpts_user_id=runs"}
+    aid = str(uuid4())
+    tid = str(uuid4())
+
+    async with get_client() as client:
+        response = await client.put(
+            f"/assistants/{aid}",
+            json={
+                "name": "assistant",
+                "config": {"configurable": {"type": "chatbot"}},
+                "public": False,
+            },
+            headers=headers,
+        )
+        response = await client.put(
+            f"/threads/{tid}",
+            json={"name": "bobby", "assistant_id": aid},
+            headers=headers,
+        )
+        assert response.status_code == 200, response.text
+
+        response = await client.post(
+            "/runs",
+            json={"thread_id": tid, "input": [{"type": "human", "content": "hi"}]},
+            headers=headers,
+        )
+        assert response.status_code == 200, response.text
+        run = response.json()
+        assert run["thread_id"] == tid
+        assert run["status"] == "pending"
+        assert run["attempts"] == 0
+
+        response = await client.get(f"/runs/{run['run_id']}", headers=headers)
+        assert response.status_code == 200
+        assert response.json() == run
+
+        response = await client.get(
+            f"/runs/{run['run_id']}", headers={"Cookie": "opengpts_user_id=other"}
+        )
+        assert response.status_code == 404
+        response = await client.post(
+            f"/runs/{run['run_id']}/cancel",
+            headers={"Cookie": "opengpts_user_id=other"},
+        )
+        assert response.status_code == 404
+
+        response = await client.post(f"/runs/{run['run_id']}/cancel", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["status"] == "cancelled"
+
+
+async def test_run_queue(pool: asyncpg.pool.Pool) -> None:
+    """Workers execute queued runs and take over abandoned ones."""
+    user_id, _ = await storage.get_or_create_user("run-queue-user")
+    user_id = str(user_id["user_id"])
+    thread_id = str(uuid4())
+    await storage.put_thread(user_id, thread_id, assistant_id=None, name="t")
+    config = {"configurable": {"thread_id": thread_id}}
+    executed = []
+
+    async def execute(input_, config) -> None:
+        executed.append(input_)
+        if input_ == "fail":
+            raise RuntimeError("secret details")
+
+    queue = RunQueue(execute)
+    settings = RunSettings(
+        concurrency=2, max_pending=1, poll_interval=0.05, stale_after=1
+    )
+    await queue.start(settings)
+    try:
+        messages = [HumanMessage(content="hi", id="1")]
+        run = await queue.enqueue(user_id, thread_id, messages, config)
+        run = await _wait_for_status(queue, user_id, run["run_id"], "success")
+        assert run["attempts"] == 1
+        assert run["finished_at"] is not None
+        assert executed == [messages]
+
+        run = await queue.enqueue(user_id, thread_id, "fail", config)
+        run = await _wait_for_status(queue, user_id, run["run_id"], "error")
+        assert run["error"] == "RuntimeError"
+
+        # the worker of this run died
+        async with pool.acquire() as conn:
+            run_id = await conn.fetchval(
+                "INSERT INTO run "
+                "(thread_id, user_id, input, config, status, attempts, heartbeat_at)"
+                " VALUES ($1, $2, $3, $4, 'running', 1, now() - interval '1 hour')"
+                " RETURNING run_id",
+                thread_id,
+                user_id,
+                queue._serde.dumps("retried"),
+                config,
+            )
+        run = await _wait_for_status(queue, user_id, run_id, "success")
+        assert run["attempts"] == 2
+        assert executed[-1] == "retried"
+    finally:
+        await queue.stop()
+
+    # without workers runs stay pending, until too many are, even when they
+    # are queued at once
+    runs = await asyncio.gather(
+        *(queue.enqueue(user_id, thread_id, "later", config) for _ in range(3)),
+        return_exceptions=True,
+    )
+    [run] = [run for run in runs if not isinstance(run, RunQueueFull)]
+    assert (await queue.get(user_id, run["run_id"]))["status"] == "pending"
+
+
+async def test_cancel_runs(pool: asyncpg.pool.Pool) -> None:
+    """Running runs are cancelled on request, streamed ones also on disconnect.
+
+    What they wrote is flushed once they have stopped.
+    """
+    user_id, _ = await storage.get_or_create_user("run-cancel-user")
+    user_id = str(user_id["user_id"])
+    thread_id = str(uuid4())
+    await storage.put_thread(user_id, thread_id, assistant_id=None, name="t")
+    config = {"configurable": {"thread_id": thread_id}}
+    stopped = []
+
+    async def execute(input_, config) -> None:
+        try:
+            await asyncio.Event().wait()
+        finally:
+            stopped.append(input_)
+
+    flushed = []
+
+    async def flush(thread_id) -> None:
+        flushed.append((thread_id, list(stopped)))
+
+    queue = RunQueue(execute, flush=flush)
+    await queue.start(RunSettings(concurrency=1, poll_interval=0.05))
+    try:
+        run = await queue.enqueue(user_id, thread_id, "queued", config)
+        await _wait_for_status(queue, user_id, run["run_id"], "running")
+        run = await queue.cancel(user_id, run["run_id"])
+        assert run["status"] == "cancelling"
+        run = await _wait_for_status(queue, user_id, run["run_id"], "cancelled")
+        assert run["error"] is None
+        assert stopped == ["queued"]
+        assert flushed == [(thread_id, ["queued"])]
+
+        async def messages():
+            yield "root-run-id"
+            await execute("streamed", config)
+
+        run = await queue.begin_stream(user_id, thread_id, "streamed", config)
+        assert run["status"] == "running"
+        stream = queue.stream(run["run_id"], messages())
+        assert await stream.__anext__() == "root-run-id"
+        # the client goes away
+        await stream.aclose()
+        run = await _wait_for_status(queue, user_id, run["run_id"], "cancelled")
+        assert run["error"] == "Client disconnected"
+        assert stopped == ["queued", "streamed"]
+        assert flushed[-1] == (thread_id, ["queued", "streamed"])
+
+        # the lock of its thread is lost, another process may run it now
+        run = await queue.enqueue(user_id, thread_id, "unlocked", config)
+        await _wait_for_status(queue, user_id, run["run_id"], "running")
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "SELECT pg_terminate_backend($1)", queue.locks._conn.get_server_pid()
+            )
+        await _wait_for_status(queue, user_id, run["run_id"], "cancelled")
+        assert stopped[-1] == "unlocked"
+    finally:
+        await queue.stop()
+
+
+async def test_thread_locks(pool: asyncpg.pool.Pool) -> None:
+    """A thread is locked by one run at a time, in any process."""
+    thread_id = str(uuid4())
+    # two processes
+    a, b = ThreadLocks(), ThreadLocks()
+    try:
+        assert await a.try_acquire(thread_id)
+        assert not await a.try_acquire(thread_id)
+        assert not await b.acquire(thread_id, timeout=0.1)
+        await a.release(thread_id)
+        assert await b.try_acquire(thread_id)
+        assert not await a.try_acquire(thread_id)
+    finally:
+        await a.close()
+        await b.close()
+    # closing releases the locks
+    a = ThreadLocks()
+    try:
+        assert await a.try_acquire(thread_id)
+    finally:
+        await a.close()
+
+    # so does losing the connection, which is reported
+    lost = []
+    a, b = ThreadLocks(on_lost=lost.append), ThreadLocks()
+    try:
+        assert await a.try_acquire(thread_id)
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "SELECT pg_terminate_backend($1)", a._conn.get_server_pid()
+            )
+        for _ in range(100):
+            if lost:
+                break
+            await asyncio.sleep(0.05)
+        assert lost == [{thread_id}]
+        assert await b.try_acquire(thread_id)
+    finally:
+        await a.close()
+        await b.close()
+
+
+async def test_thread_policies() -> None:
+    """New runs of a busy thread are rejected, or interrupt the running one."""
+    user_id, _ = await storage.get_or_create_user("run-policy-user")
+    user_id = str(user_id["user_id"])
+    thread_id = str(uuid4())
+    await storage.put_thread(user_id, thread_id, assistant_id=None, name="t")
+    config = {"configurable": {"thread_id": thread_id}}
+
+    async def messages():
+        yield "root-run-id"
+        await asyncio.Event().wait()
+
+    queue = RunQueue(None)
+    await queue.start(RunSettings(concurrency=0, thread_policy="reject"))
+    try:
+        first = await queue.begin_stream(user_id, thread_id, "first", config)
+        with pytest.raises(ThreadBusy):
+            await queue.begin_stream(user_id, thread_id, "second", config)
+        with pytest.raises(ThreadBusy):
+            await queue.enqueue(user_id, thread_id, "second", config)
+        # of runs of an idle thread queued at once, one is
+        idle_id = str(uuid4())
+        await storage.put_thread(user_id, idle_id, assistant_id=None, name="t")
+        idle = {"configurable": {"thread_id": idle_id}}
+        runs = await asyncio.gather(
+            *(queue.enqueue(user_id, idle_id, "idle", idle) for _ in range(3)),
+            return_exceptions=True,
+        )
+        assert sum(isinstance(run, ThreadBusy) for run in runs) == 2
+
+        # the stream of the first run never started
+        await queue.end_stream(first["run_id"])
+        first = await queue.get(user_id, first["run_id"])
+        assert first["status"] == "cancelled"
+        assert first["error"] == "Client disconnected"
+
+        second = await queue.begin_stream(user_id, thread_id, "second", config)
+        stream = queue.stream(second["run_id"], messages())
+        assert await stream.__anext__() == "root-run-id"
+
+        queue.settings = RunSettings(
+            concurrency=0, thread_policy="interrupt", thread_wait_timeout=5
+        )
+        third = asyncio.create_task(
+            queue.begin_stream(user_id, thread_id, "third", config)
+        )
+        # the second run is cancelled, which ends its stream
+        assert [chunk async for chunk in stream] == []
+        third = await third
+        second = await queue.get(user_id, second["run_id"])
+        assert second["status"] == "cancelled"
+        assert second["error"] is None
+        await queue.end_stream(third["run_id"])
+    finally:
+        await queue.stop()
@@ -0,0 +1,103 @@
+"""Test the checkpoint serializers."""
+
+import os
+import pickle
+from base64 import b64encode
+from datetime import datetime, timezone
+from uuid import uuid4
+
+import pytest
+
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.base import empty_checkpoint
+
+from app.message_types import LiberalToolMessage
+from app.serde import MAGIC, CheckpointSerializer, loads_untrusted
+
+
+def _checkpoint() -> dict:
+    checkpoint = empty_checkpoint()
+    checkpoint["channel_values"] = {
+        "messages": [
+            HumanMessage(content="hi", id="1"),
+            AIMessage(
+                content="",
+                id="2",
+                tool_calls=[{"id": "call", "name": "retrieval", "args": {"q": "x"}}],
+            ),
+            LiberalToolMessage(
+                content=[Document(page_content="doc", metadata={"source": "a"})],
+                tool_call_id="call",
+                id="3",
+            ),
+        ],
+        "msg_count": 3,
+        "when": datetime.now(timezone.utc),
+    }
+    checkpoint["channel_versions"]["messages"] = 2
+    checkpoint["versions_seen"]["agent"]["messages"] = 1
+    return checkpoint
+
+
+def test_roundtrip() -> None:
+    serde = CheckpointSerializer(compress_threshold=0)
+    checkpoint = _checkpoint()
+
+    blob = serde.dumps(checkpoint)
+    assert blob.startswith(MAGIC)
+
+    loaded = serde.loads(blob)
+    assert loaded == checkpoint
+    assert [type(m) for m in loaded["channel_values"]["messages"]] == [
+        HumanMessage,
+        AIMessage,
+        LiberalToolMessage,
+    ]
+    # langgraph reads unseen channels and nodes from these defaultdicts
+    assert loaded["channel_versions"]["unknown"] == 0
+    assert loaded["versions_seen"]["unknown"]["messages"] == 0
+
+
+def test_loads_legacy_pickle() -> None:
+    checkpoint = _checkpoint()
+    loaded = CheckpointSerializer().loads(pickle.dumps(checkpoint))
+    assert loaded == checkpoint
+
+
+def test_roundtrip_types() -> None:
+    serde = CheckpointSerializer()
+    values = {
+        "tuple": (1, "a"),
+        "set": {1, 2},
+        "keys": {1: "a", ("b", 2): "c"},
+        "id": uuid4(),
+        "raw": b"\x00\xff",
+    }
+    assert serde.loads(serde.dumps(values)) == values
+
+
+def test_user_tags_are_data() -> None:
+    serde = CheckpointSerializer()
+    content = [{"__t": "pickle", "__v": b64encode(pickle.dumps(os.getcwd)).decode()}]
+    message = HumanMessage(content=content, additional_kwargs={"__t": "HumanMessage"})
+
+    blob = serde.dumps({"messages": [message]})
+    assert serde.loads(blob) == {"messages": [message]}
+    assert loads_untrusted(blob, revive=True) == {"messages": [message]}
+
+
+def test_loads_rejects_unknown_tags() -> None:
+    serde = CheckpointSerializer()
+    with pytest.raises(ValueError):
+        serde.loads(MAGIC + bytes([2, 0]) + b'{"a": {"__t": "os", "__v": {}}}')
+    # format 1 embedded pickles, which may only hold plain values
+    pickled = b64encode(pickle.dumps(os.getcwd)).decode()
+    blob = MAGIC + bytes([1, 0]) + b'{"a": {"__t": "pickle", "__v": "%s"}}'
+    with pytest.raises(ValueError):
+        serde.loads(blob % pickled.encode())
+
+
+def test_dumps_rejects_unknown_types() -> None:
+    with pytest.raises(TypeError):
+        CheckpointSerializer().dumps({"a": object()})
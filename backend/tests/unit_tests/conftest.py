@@ -9,11 +9,16 @@ from app.auth.settings import AuthType
 from app.auth.settings import settings as auth_settings
 from app.lifespan import get_pg_pool, lifespan
 from app.server import app
+from app.storage import ASSISTANT_CACHE, USER_CACHE
 
 auth_settings.auth_type = AuthType.NOOP
 
 # Temporary handling of environment variables for testing
 os.environ["OPENAI_API_KEY"] = "test"
+# Backfills are tested directly, not raced against the tests
+os.environ["BACKFILL_ENABLED"] = "false"
+# Queued runs stay pending unless a test starts workers
+os.environ["RUN_QUEUE_CONCURRENCY"] = "0"
 
 TEST_DB = "test"
 assert os.environ["POSTGRES_DB"] != TEST_DB, "Test and main database conflict."
@@ -79,6 +84,8 @@ async def clear_test_db(pool):
         $$;
         """
         await conn.execute(query)
+    ASSISTANT_CACHE.clear()
+    USER_CACHE.clear()
 
 
 @pytest.fixture(scope="session")
@@ -0,0 +1,70 @@
+"""Export the threads of a user, with their history, as NDJSON, or import them.
+
+Moves users between environments, or archives them. Uses the POSTGRES_*
+environment variables of the database to read from or write to.
+
+Usage (from the backend directory):
+
+    PYTHONPATH=. poetry run python ../tools/threads_ndjson/threads_ndjson.py \\
+        export --sub <sub> > threads.ndjson
+    PYTHONPATH=. poetry run python ../tools/threads_ndjson/threads_ndjson.py \\
+        import --sub <sub> < threads.ndjson
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from typing import AsyncIterator, BinaryIO
+
+from app.lifespan import lifespan
+from app.server import app
+from app.storage import get_or_create_user
+from app.transfer import export_threads, import_threads
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+
+async def read_chunks(file: BinaryIO, size: int = 1024 * 1024) -> AsyncIterator[bytes]:
+    while chunk := file.read(size):
+        yield chunk
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument(
+        "--sub", required=True, help="The sub of the user, as in their JWT."
+    )
+    parser.add_argument(
+        "--file", help="The file to write to or read from. Defaults to stdout/stdin."
+    )
+    parser.add_argument(
+        "--trusted",
+        action="store_true",
+        help="Import checkpoints that contain pickles. Only for trusted exports.",
+    )
+    args = parser.parse_args()
+
+    async with lifespan(app):
+        user, _ = await get_or_create_user(args.sub)
+        user_id = str(user["user_id"])
+        if args.command == "export":
+            out = open(args.file, "wb") if args.file else sys.stdout.buffer
+            with out:
+                async for chunk in export_threads(user_id):
+                    out.write(chunk)
+            logger.info(f"Exported the threads of user {args.sub}.")
+        else:
+            file = open(args.file, "rb") if args.file else sys.stdin.buffer
+            with file:
+                imported = await import_threads(
+                    user_id, read_chunks(file), trusted=args.trusted
+                )
+            logger.info(f"Imported {imported} for user {args.sub}.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())